@@ -1,18 +1,47 @@
-from flask import Blueprint, render_template, request, redirect, session, send_file
-import sqlite3
-import io
+from flask import Blueprint, Response, render_template, request, redirect, session, jsonify
+import calendar
+import hmac
+import os
 from datetime import datetime
-import pytz
-from collections import defaultdict, deque
-from openpyxl import Workbook
-from openpyxl.styles import Alignment, Font
+from location_writer import writer
+from line_dispatcher import dispatcher
+import location_cache
+import location_filter
+import calendar_index
+import qr_cache
+import identity_cache
+import metrics
+import compaction
+import analytics
+import export_jobs
+import location_partitions
+from db_pool import connection, stats as pool_stats
 
 admin_bp = Blueprint("admin", __name__)
-DB_PATH = 'checkin.db'
-tz = pytz.timezone("Asia/Taipei")
 
 ADMIN_USERNAME = 'admin'
 ADMIN_PASSWORD = 'admin'
+USERS_PER_PAGE = int(os.getenv("ADMIN_USERS_PER_PAGE", "50"))
+# /admin/metrics 供 Prometheus 抓取用的權杖，未設定時只能以後台登入查看
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+def parse_daterange(daterange):
+    # 支援「YYYY-MM-DD - YYYY-MM-DD」與「YYYY-MM」兩種格式，格式錯誤時回傳 None
+    try:
+        if " - " in daterange:
+            start_date, end_date = [d.strip() for d in daterange.split(" - ")]
+            datetime.strptime(start_date, "%Y-%m-%d")
+            datetime.strptime(end_date, "%Y-%m-%d")
+        elif len(daterange) == 7:
+            month = datetime.strptime(daterange, "%Y-%m")
+            last_day = calendar.monthrange(month.year, month.month)[1]
+            start_date = f"{daterange}-01"
+            end_date = f"{daterange}-{last_day:02d}"
+        else:
+            return None
+    except ValueError:
+        return None
+    return start_date, end_date
 
 @admin_bp.route("/login", methods=["GET", "POST"])
 def login():
@@ -33,167 +62,167 @@ def logout():
 def dashboard():
     if not session.get("admin"):
         return redirect("/admin/login")
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT employee_id, name, bind_time FROM users")
-    users = cursor.fetchall()
-    cursor.execute("SELECT DISTINCT DATE(timestamp) FROM checkins ORDER BY timestamp DESC")
-    checkin_dates = [r[0] for r in cursor.fetchall()]
-    cursor.execute("SELECT DISTINCT DATE(timestamp) FROM location_logs ORDER BY timestamp DESC")
-    location_dates = [r[0] for r in cursor.fetchall()]
-    checkin_months = sorted({d[:7] for d in checkin_dates}, reverse=True)
-    location_months = sorted({d[:7] for d in location_dates}, reverse=True)
-    conn.close()
+    keyword = (request.args.get("q") or "").strip()
+    page = max(request.args.get("page", 1, type=int), 1)
+    with connection() as conn:
+        users, total = search_users(conn, keyword, page)
+        # 日期與月份選單取自日曆索引（小表），不再掃描 checkins / location_logs
+        checkin_dates = calendar_index.dates(conn, "checkin")
+        location_dates = calendar_index.dates(conn, "location")
+        checkin_months = calendar_index.months(conn, "checkin")
+        location_months = calendar_index.months(conn, "location")
+    pages = max((total + USERS_PER_PAGE - 1) // USERS_PER_PAGE, 1)
     return render_template("admin_dashboard.html", users=users, checkin_dates=checkin_dates,
                            location_dates=location_dates, checkin_months=checkin_months,
-                           location_months=location_months)
+                           location_months=location_months, keyword=keyword, page=min(page, pages),
+                           pages=pages, total=total)
+
+def search_users(conn, keyword, page):
+    # 伺服器端分頁；關鍵字比對工號開頭或姓名任一部分，回傳 (該頁員工, 符合總數)
+    where, params = "", ()
+    if keyword:
+        escaped = keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where = "WHERE employee_id LIKE ? ESCAPE '\\' OR name LIKE ? ESCAPE '\\'"
+        params = (f"{escaped}%", f"%{escaped}%")
+    total = conn.execute(f"SELECT COUNT(*) FROM users {where}", params).fetchone()[0]
+    pages = max((total + USERS_PER_PAGE - 1) // USERS_PER_PAGE, 1)
+    offset = (min(page, pages) - 1) * USERS_PER_PAGE
+    cursor = conn.execute(f"SELECT employee_id, name, bind_time FROM users {where} ORDER BY id LIMIT ? OFFSET ?",
+                          (*params, USERS_PER_PAGE, offset))
+    return cursor.fetchall(), total
+
+@admin_bp.route("/stats")
+def stats():
+    if not session.get("admin"):
+        return redirect("/admin/login")
+    return jsonify({
+        "location_writer": writer.stats(),
+        "db_pool": pool_stats(),
+        "line_dispatcher": dispatcher.stats(),
+        "latest_location": location_cache.stats(),
+        "location_filter": location_filter.stats(),
+        "qr_cache": qr_cache.stats(),
+        "identity_cache": identity_cache.stats(),
+    })
+
+@admin_bp.route("/metrics")
+def metrics_endpoint():
+    # Prometheus 抓取時以 Authorization: Bearer <METRICS_TOKEN> 驗證，瀏覽器則沿用後台登入
+    if not session.get("admin"):
+        auth = request.headers.get("Authorization", "")
+        if not METRICS_TOKEN or not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}"):
+            if auth:
+                return "Unauthorized", 401
+            return redirect("/admin/login")
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 @admin_bp.route("/delete_user/<employee_id>")
 def delete_user(employee_id):
     if not session.get("admin"):
         return redirect("/admin/login")
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE employee_id=?", (employee_id,))
-    cursor.execute("DELETE FROM user_states WHERE temp_employee_id=?", (employee_id,))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        conn.execute("DELETE FROM users WHERE employee_id=?", (employee_id,))
+        conn.execute("DELETE FROM user_states WHERE temp_employee_id=?", (employee_id,))
+        identity_cache.invalidate(conn)
     return redirect("/admin/dashboard")
 
 @admin_bp.route("/export_checkins_excel", methods=["POST"])
 def export_checkins_excel():
-    if not session.get("admin"):
-        return redirect("/admin/login")
-    daterange = request.form.get("daterange") or ""
-    if " - " in daterange:
-        start_date, end_date = [d.strip() for d in daterange.split(" - ")]
-    elif len(daterange) == 7:
-        start_date = f"{daterange}-01"
-        end_date = f"{daterange}-31"
-    else:
-        return "無效的日期格式", 400
-
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''SELECT employee_id, name, timestamp, check_type FROM checkins
-                      WHERE DATE(timestamp) BETWEEN ? AND ?
-                      ORDER BY employee_id, timestamp''', (start_date, end_date))
-    records = cursor.fetchall()
-    conn.close()
-
-    grouped = defaultdict(deque)
-    for emp_id, name, ts, ctype in records:
-        dt = tz.localize(datetime.strptime(ts, "%Y-%m-%d %H:%M:%S"))
-        grouped[(emp_id, name)].append((dt, ctype))
-
-    structured = defaultdict(lambda: defaultdict(lambda: {"上班": "", "下班": ""}))
-    all_dates = set()
-    for key, events in grouped.items():
-        i = 0
-        while i < len(events):
-            dt, ctype = events[i]
-            if ctype == "上班":
-                date_str = dt.strftime("%Y/%m/%d")
-                structured[key][date_str]["上班"] = dt.strftime("%H:%M")
-                if i + 1 < len(events):
-                    next_dt, next_type = events[i + 1]
-                    if next_type == "下班":
-                        structured[key][date_str]["下班"] = next_dt.strftime("%H:%M")
-                        i += 1
-                all_dates.add(date_str)
-            i += 1
-
-    sorted_dates = sorted(all_dates)
-    employees = list(structured.keys())
-    groups = [employees[i:i + 3] for i in range(0, len(employees), 3)]
-
-    wb = Workbook()
-    wb.remove(wb.active)
-    for idx, group in enumerate(groups):
-        ws = wb.create_sheet(title=f"第{idx + 1}頁")
-        for i, (emp_id, name) in enumerate(group):
-            col = i * 4 + 1
-            ws.merge_cells(start_row=1, start_column=col, end_row=1, end_column=col + 2)
-            ws.cell(row=1, column=col, value=f"工號：{emp_id} 姓名：{name}").font = Font(bold=True)
-            ws.cell(row=2, column=col, value="日期").alignment = Alignment(horizontal="center")
-            ws.cell(row=2, column=col+1, value="上班").alignment = Alignment(horizontal="center")
-            ws.cell(row=2, column=col+2, value="下班").alignment = Alignment(horizontal="center")
-            for row_idx, date in enumerate(sorted_dates, start=3):
-                ws.cell(row=row_idx, column=col, value=date)
-                ws.cell(row=row_idx, column=col+1, value=structured[(emp_id, name)][date]["上班"])
-                ws.cell(row=row_idx, column=col+2, value=structured[(emp_id, name)][date]["下班"])
-
-    out = io.BytesIO()
-    wb.save(out)
-    out.seek(0)
-    filename = f"打卡紀錄_{start_date}_to_{end_date}.xlsx"
-    return send_file(out, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                     as_attachment=True, download_name=filename)
+    return start_export("checkins")
 
 @admin_bp.route("/export_locations_excel", methods=["POST"])
 def export_locations_excel():
+    return start_export("locations")
+
+def start_export(kind):
+    # 後台表單：送出背景匯出工作；快取命中時直接下載，否則顯示進度頁，完成後自動下載
     if not session.get("admin"):
         return redirect("/admin/login")
-    daterange = request.form.get("daterange") or ""
-    if " - " in daterange:
-        start_date, end_date = [d.strip() for d in daterange.split(" - ")]
-    elif len(daterange) == 7:
-        start_date = f"{daterange}-01"
-        end_date = f"{daterange}-31"
-    else:
+    parsed = parse_daterange(request.form.get("daterange") or "")
+    if not parsed:
         return "無效的日期格式", 400
+    job = export_jobs.submit(kind, *parsed)
+    if job["status"] == "done":
+        return export_jobs.send(job)
+    return render_template("export_job.html", job=job_json(job))
+
+def job_json(job):
+    data = {key: job[key] for key in ("kind", "start_date", "end_date", "status", "progress", "error")}
+    data["job_id"] = job["id"]
+    data["cached"] = bool(job["version"])
+    if job["status"] == "done":
+        data["download_url"] = f"/admin/exports/{job['id']}/download"
+    return data
+
+@admin_bp.route("/api/exports", methods=["POST"])
+def submit_export():
+    # 參數 kind（checkins / locations）與 daterange，表單或 JSON 皆可；回傳 job id，之後以 GET 查詢進度
+    if not session.get("admin"):
+        return redirect("/admin/login")
+    params = request.get_json(silent=True) or request.form
+    kind = params.get("kind") or ""
+    parsed = parse_daterange(params.get("daterange") or "")
+    if kind not in export_jobs.KINDS or not parsed:
+        return jsonify({"error": "無效的匯出種類或日期格式"}), 400
+    job = export_jobs.submit(kind, *parsed)
+    return jsonify(job_json(job)), 200 if job["status"] == "done" else 202
+
+@admin_bp.route("/api/exports/<job_id>")
+def export_status(job_id):
+    if not session.get("admin"):
+        return redirect("/admin/login")
+    job = export_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "找不到匯出工作"}), 404
+    return jsonify(job_json(job))
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''SELECT employee_id, name, timestamp, latitude, longitude FROM location_logs
-                      WHERE DATE(timestamp) BETWEEN ? AND ?
-                      ORDER BY employee_id, timestamp''', (start_date, end_date))
-    records = cursor.fetchall()
-    conn.close()
-
-    data = defaultdict(lambda: defaultdict(lambda: {"lat": "", "lng": ""}))
-    all_dates = set()
-    for emp_id, name, ts, lat, lng in records:
-        dt = tz.localize(datetime.strptime(ts, "%Y-%m-%d %H:%M:%S"))
-        date_str = dt.strftime("%Y/%m/%d")
-        data[(emp_id, name)][date_str] = {"lat": lat, "lng": lng}
-        all_dates.add(date_str)
-
-    sorted_dates = sorted(all_dates)
-    employees = list(data.keys())
-    groups = [employees[i:i + 3] for i in range(0, len(employees), 3)]
-
-    wb = Workbook()
-    wb.remove(wb.active)
-    for idx, group in enumerate(groups):
-        ws = wb.create_sheet(title=f"定位{idx + 1}")
-        for i, (emp_id, name) in enumerate(group):
-            col = i * 4 + 1
-            ws.merge_cells(start_row=1, start_column=col, end_row=1, end_column=col + 2)
-            ws.cell(row=1, column=col, value=f"工號：{emp_id} 姓名：{name}").font = Font(bold=True)
-            ws.cell(row=2, column=col, value="日期").alignment = Alignment(horizontal="center")
-            ws.cell(row=2, column=col+1, value="緯度").alignment = Alignment(horizontal="center")
-            ws.cell(row=2, column=col+2, value="經度").alignment = Alignment(horizontal="center")
-            for row_idx, date in enumerate(sorted_dates, start=3):
-                ws.cell(row=row_idx, column=col, value=date)
-                ws.cell(row=row_idx, column=col+1, value=data[(emp_id, name)][date]["lat"])
-                ws.cell(row=row_idx, column=col+2, value=data[(emp_id, name)][date]["lng"])
-
-    out = io.BytesIO()
-    wb.save(out)
-    out.seek(0)
-    filename = f"定位紀錄_{start_date}_to_{end_date}.xlsx"
-    return send_file(out, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                     as_attachment=True, download_name=filename)
+@admin_bp.route("/exports/<job_id>/download")
+def download_export(job_id):
+    if not session.get("admin"):
+        return redirect("/admin/login")
+    job = export_jobs.get(job_id)
+    if not job:
+        return "找不到匯出工作", 404
+    if job["status"] != "done":
+        return job["error"] or "匯出尚未完成", 409
+    return export_jobs.send(job)
+
+@admin_bp.route("/api/onsite")
+def onsite():
+    # 工地在場時間（每人每天每個工地一列），只讀預先計算好的 onsite_daily；新定位由背景排程補上（見 analytics.py）
+    if not session.get("admin"):
+        return redirect("/admin/login")
+    parsed = parse_daterange(request.args.get("daterange") or "")
+    if not parsed:
+        return jsonify({"error": "無效的日期格式"}), 400
+    start_date, end_date = parsed
+    with connection() as conn:
+        rows = analytics.daily(conn, start_date, end_date, request.args.get("employee_id") or None)
+    return jsonify({
+        "start_date": start_date,
+        "end_date": end_date,
+        "rows": [
+            {"employee_id": employee_id, "name": name, "date": date, "site_id": site_id, "site": site,
+             "seconds": seconds, "visits": visits, "first_arrival": first_arrival, "last_departure": last_departure}
+            for employee_id, name, date, site_id, site, seconds, visits, first_arrival, last_departure in rows
+        ],
+    })
 
 @admin_bp.route("/clear_data")
 def clear_data():
     if not session.get("admin"):
         return redirect("/admin/login")
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM checkins;")
-    cursor.execute("DELETE FROM location_logs;")
-    conn.commit()
-    conn.close()
+    # 打卡分批刪除，每批一個短交易，清空期間仍可寫入；定位直接 DROP 各月份表
+    compaction.delete_in_chunks("checkins")
+    with connection() as conn:
+        location_partitions.drop_all(conn)
+        conn.execute("DELETE FROM daily_attendance;")
+        conn.execute("DELETE FROM latest_location;")
+        conn.execute("DELETE FROM compaction_log;")
+        analytics.clear(conn)
+        export_jobs.clear(conn)
+        calendar_index.clear(conn)
+    compaction.remove_archives()
+    location_cache.clear()
+    location_filter.clear()
     return "\u2705 所有打卡與定位紀錄已清空"
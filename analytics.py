@@ -0,0 +1,281 @@
+import argparse
+import fcntl
+import os
+import threading
+import time
+from datetime import datetime
+
+import data_version
+import db_pool
+import geofence
+import location_partitions
+import pg_backend
+from applog import log
+from db import day_bounds
+from db_pool import connection
+
+# 工地在場時間分析：依時間順序走過每位員工的定位點，以工地範圍判斷進出，
+# 累計每人每天每個工地的停留秒數、進入次數、最早到達與最晚離開，存到 onsite_daily。
+#   相鄰兩點間隔不超過 MAX_GAP_SECONDS 且在同一天時，這段時間算在前一點所在的工地（不跨過午夜）；
+#   間隔過長（例如關機或沒有訊號）的那段不計入，下一個在工地內的點視為重新進入。
+#   最晚離開為最後一段停留的結束時間（離開後的第一個點，或最後一個在工地內的點）。
+# 增量處理：每張月份表記錄已處理到的 id（location_partitions.analyzed_id），每次只讀之後新增的點，
+# 並從每位員工上次處理到的最後一點（onsite_state）接著累計；
+# 補傳的舊點（時間早於上次處理到的點）會讓該員工受影響的日期由原始定位重新計算。
+# 查詢與匯出只讀 onsite_daily，整個月的結果也只是員工數 × 天數列。
+# 工地設定變更後以 python analytics.py rebuild 起 迄 重新計算；已封存的日期沒有原始定位，維持原本的結果，
+# 已抽稀的日期重新計算時只剩保留下來的點，結果會較粗略。
+MAX_GAP_SECONDS = int(os.getenv("ONSITE_MAX_GAP_SECONDS", "900"))
+CHUNK_SIZE = int(os.getenv("ANALYTICS_CHUNK_SIZE", "20000"))
+# 背景排程間隔（分鐘，0 表示不排程）；後台查詢前也會先處理最多 REFRESH_MAX_ROWS 筆新定位
+INTERVAL_MINUTES = float(os.getenv("ANALYTICS_INTERVAL_MINUTES", "10"))
+REFRESH_MAX_ROWS = int(os.getenv("ANALYTICS_REFRESH_MAX_ROWS", "50000"))
+LOCK_PATH = os.getenv("ANALYTICS_LOCK_PATH", "analytics.lock")
+LOOKUP_CHUNK = 500
+
+
+def _seconds_between(start, end):
+    return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+
+
+def accumulate(points, prev, totals):
+    # points: 依時間排序的 (timestamp, site_id)，site_id 為 -1 表示不在任何工地；prev 為上一點（或 None）
+    # totals: {(日期, site_id): [秒數, 進入次數, 最早到達, 最晚離開]}，就地累加；回傳最後一點
+    for ts, site in points:
+        continuous = False
+        if prev is not None:
+            prev_ts, prev_site = prev
+            gap = _seconds_between(prev_ts, ts)
+            continuous = prev_ts[:10] == ts[:10] and gap <= MAX_GAP_SECONDS
+            if continuous and prev_site >= 0:
+                total = totals.setdefault((prev_ts[:10], prev_site), [0, 0, prev_ts, prev_ts])
+                total[0] += gap
+                total[3] = max(total[3], ts)
+        if site >= 0:
+            total = totals.setdefault((ts[:10], site), [0, 0, ts, ts])
+            if not (continuous and prev[1] == site):
+                total[1] += 1
+            total[2] = min(total[2], ts)
+            total[3] = max(total[3], ts)
+        prev = (ts, site)
+    return prev
+
+
+def _save(conn, employee_id, totals):
+    conn.executemany("""
+        INSERT INTO onsite_daily (employee_id, date, site_id, seconds, visits, first_arrival, last_departure)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (employee_id, date, site_id) DO UPDATE SET
+            seconds = onsite_daily.seconds + excluded.seconds,
+            visits = onsite_daily.visits + excluded.visits,
+            first_arrival = CASE WHEN excluded.first_arrival < onsite_daily.first_arrival
+                                 THEN excluded.first_arrival ELSE onsite_daily.first_arrival END,
+            last_departure = CASE WHEN excluded.last_departure > onsite_daily.last_departure
+                                  THEN excluded.last_departure ELSE onsite_daily.last_departure END
+    """, [(employee_id, date, site, int(seconds), visits, first, last)
+          for (date, site), (seconds, visits, first, last) in totals.items()])
+    # 定位匯出含工地停留工作表
+    data_version.touch(conn, "location", (date for date, _ in totals))
+
+
+def _load_states(conn, employee_ids):
+    states = {}
+    for i in range(0, len(employee_ids), LOOKUP_CHUNK):
+        chunk = employee_ids[i:i + LOOKUP_CHUNK]
+        cursor = conn.execute(
+            f"SELECT employee_id, last_ts, site_id FROM onsite_state WHERE employee_id IN ({','.join('?' * len(chunk))})",
+            chunk)
+        for employee_id, last_ts, site_id in cursor.fetchall():
+            states[employee_id] = (last_ts, site_id)
+    return states
+
+
+def _match(index, rows, lat_index):
+    site_ids, _ = index.match_many([r[lat_index] for r in rows], [r[lat_index + 1] for r in rows])
+    return site_ids.tolist()
+
+
+def _recompute(conn, index, employee_id, first_day, last_day, limits):
+    # 由原始定位重新計算員工在 [first_day, last_day] 有定位的日期；limits 為各月份已處理到的 id，之後的點留給下一批
+    start, end = day_bounds(first_day, last_day)
+    rows = []
+    for month, analyzed_id in sorted(limits.items()):
+        month_start, month_end = location_partitions.month_bounds(month)
+        if month_end <= start or month_start >= end:
+            continue
+        rows.extend(conn.execute(f"""
+            SELECT timestamp, latitude, longitude FROM {location_partitions.table_name(month)}
+            WHERE employee_id = ? AND timestamp >= ? AND timestamp < ? AND id <= ? ORDER BY timestamp
+        """, (employee_id, start, end, analyzed_id)).fetchall())
+    if not rows:
+        return 0
+    days = sorted({row[0][:10] for row in rows})
+    for i in range(0, len(days), LOOKUP_CHUNK):
+        chunk = days[i:i + LOOKUP_CHUNK]
+        conn.execute(f"DELETE FROM onsite_daily WHERE employee_id = ? AND date IN ({','.join('?' * len(chunk))})",
+                     (employee_id, *chunk))
+    totals = {}
+    accumulate(sorted((row[0], site) for row, site in zip(rows, _match(index, rows, 1))), None, totals)
+    _save(conn, employee_id, totals)
+    return len(days)
+
+
+def _process(conn, index, rows, limits, report):
+    # rows: 同一張月份表中新的 (id, employee_id, timestamp, latitude, longitude)
+    by_employee = {}
+    for row, site in zip(rows, _match(index, rows, 3)):
+        if row[1]:  # 尚未綁定工號的定位無法歸到員工，只推進進度
+            by_employee.setdefault(row[1], []).append((row[2], site))
+    states = _load_states(conn, list(by_employee))
+    for employee_id, points in by_employee.items():
+        points.sort()
+        state = states.get(employee_id)
+        if state and points[0][0] < state[0]:
+            # 有補傳的舊點：從最早的舊點那天到目前處理到的最後一天重新計算
+            report["recomputed_days"] += _recompute(conn, index, employee_id, points[0][0][:10],
+                                                    max(state[0], points[-1][0])[:10], limits)
+        else:
+            totals = {}
+            accumulate(points, state, totals)
+            _save(conn, employee_id, totals)
+        latest = max(state, points[-1]) if state else points[-1]
+        conn.execute("""
+            INSERT INTO onsite_state (employee_id, last_ts, site_id) VALUES (?, ?, ?)
+            ON CONFLICT (employee_id) DO UPDATE SET last_ts = excluded.last_ts, site_id = excluded.site_id
+        """, (employee_id, *latest))
+    report["employees"] += len(by_employee)
+
+
+def run(max_rows=None):
+    # 處理各月份表中尚未分析的定位，每批 CHUNK_SIZE 筆一個交易（結果與進度一起提交）；回傳統計
+    report = {"rows": 0, "employees": 0, "recomputed_days": 0}
+    index = geofence.get_index()
+    with connection() as conn:
+        limits = dict(conn.execute("SELECT month, analyzed_id FROM location_partitions").fetchall())
+    for month in sorted(limits):
+        table = location_partitions.table_name(month)
+        while max_rows is None or report["rows"] < max_rows:
+            with connection() as conn:
+                rows = conn.execute(f"""
+                    SELECT id, employee_id, timestamp, latitude, longitude FROM {table}
+                    WHERE id > ? ORDER BY id LIMIT ?
+                """, (limits[month], CHUNK_SIZE)).fetchall()
+                if not rows:
+                    break
+                limits[month] = rows[-1][0]
+                _process(conn, index, rows, limits, report)
+                conn.execute("UPDATE location_partitions SET analyzed_id = ? WHERE month = ?", (limits[month], month))
+            report["rows"] += len(rows)
+            if len(rows) < CHUNK_SIZE:
+                break
+    return report
+
+
+def run_locked(max_rows=None):
+    # 同一時間只有一個行程在分析（同一批點不會被累計兩次）；取不到鎖時回傳 None
+    if db_pool.BACKEND == "postgres":
+        with pg_backend.advisory_lock("analytics") as locked:
+            return run(max_rows) if locked else None
+    with open(LOCK_PATH, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        return run(max_rows)
+
+
+def refresh():
+    # 產生匯出前（背景工作內）先處理少量新定位；另一個行程正在分析或發生錯誤時直接使用現有結果
+    try:
+        return run_locked(max_rows=REFRESH_MAX_ROWS)
+    except db_pool.OperationalError as e:
+        log("analytics.refresh_error", "warning", error=str(e))
+        return None
+
+
+def rebuild(start_date, end_date):
+    # 以目前的工地設定重新計算 [start_date, end_date] 內每位員工有定位的日期，回傳重新計算的天數
+    index = geofence.get_index()
+    bounds = day_bounds(start_date, end_date)
+    days = 0
+    with connection() as conn:
+        limits = dict(conn.execute("SELECT month, analyzed_id FROM location_partitions").fetchall())
+        employee_ids = set()
+        for table in location_partitions.tables(conn, *bounds):
+            employee_ids.update(r[0] for r in conn.execute(
+                f"SELECT DISTINCT employee_id FROM {table} WHERE timestamp >= ? AND timestamp < ?", bounds))
+    for employee_id in sorted(employee_ids):
+        with connection() as conn:
+            days += _recompute(conn, index, employee_id, start_date, end_date, limits)
+    return days
+
+
+def daily(conn, start_date, end_date, employee_id=None):
+    # 每人每天每個工地一列：(工號, 姓名, 日期, 工地 id, 工地名稱, 停留秒數, 進入次數, 最早到達, 最晚離開)
+    where, params = "", (start_date, end_date)
+    if employee_id:
+        where, params = "AND o.employee_id = ?", (*params, employee_id)
+    return conn.execute(f"""
+        SELECT o.employee_id, u.name, o.date, o.site_id, s.name, o.seconds, o.visits, o.first_arrival, o.last_departure
+        FROM onsite_daily o
+        LEFT JOIN users u ON u.employee_id = o.employee_id
+        LEFT JOIN sites s ON s.id = o.site_id
+        WHERE o.date >= ? AND o.date <= ? {where}
+        ORDER BY o.employee_id, o.date, o.site_id
+    """, params).fetchall()
+
+
+def clear(conn):
+    conn.execute("DELETE FROM onsite_daily")
+    conn.execute("DELETE FROM onsite_state")
+    conn.execute("UPDATE location_partitions SET analyzed_id = 0")
+
+
+_scheduler_pid = None
+
+
+def start_scheduler():
+    # 與壓縮排程相同：每個行程各一個排程執行緒，實際執行由鎖互斥
+    global _scheduler_pid
+    if not INTERVAL_MINUTES or _scheduler_pid == os.getpid():
+        return
+    _scheduler_pid = os.getpid()
+
+    def loop():
+        while True:
+            time.sleep(INTERVAL_MINUTES * 60)
+            try:
+                report = run_locked()
+                if report and report["rows"]:
+                    log("analytics.done", **report)
+            except Exception as e:
+                log("analytics.error", "error", error=str(e))
+    threading.Thread(target=loop, name="analytics", daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="工地在場時間分析")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("run", help="處理尚未分析的定位")
+    rebuild_parser = sub.add_parser("rebuild", help="以目前工地設定重新計算日期區間（工地異動後使用）")
+    rebuild_parser.add_argument("start_date")
+    rebuild_parser.add_argument("end_date")
+    args = parser.parse_args()
+
+    from db import init_db
+    init_db()
+    started = time.perf_counter()
+    if args.command == "run":
+        report = run_locked()
+        if report is None:
+            print("⚠️ 另一個分析程序正在執行")
+            return
+        print(f"✅ 處理 {report['rows']:,} 筆定位、{report['employees']:,} 位員工次，"
+              f"重新計算 {report['recomputed_days']:,} 天，耗時 {time.perf_counter() - started:.2f} s")
+    else:
+        days = rebuild(args.start_date, args.end_date)
+        print(f"✅ 重新計算 {days:,} 個員工日，耗時 {time.perf_counter() - started:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,36 +4,56 @@ from db import init_db
 from line_utils import handle_event
 from location_webhook import location_bp
 from admin_routes import admin_bp
+from qr_cache import qr_bp
+import compaction
+import location_cache
+import location_partitions
+import analytics
+import metrics
+from applog import log
 import os
 from flask import request, abort
 
 # 載入 .env 設定
 load_dotenv()
 
-# ✅ 確保 static/qr 資料夾存在
-os.makedirs("static/qr", exist_ok=True)
-
-# 初始化資料庫
+# 初始化資料庫（結構已是最新時只查詢一次版本；gunicorn preload 時只在 master 執行一次，見 gunicorn.conf.py）
 init_db()
 
 # 建立 Flask App
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "default_secret_key")
+# 每個路由的延遲統計（/admin/metrics）
+metrics.init_app(app)
+
+# 背景排程在第一個請求時才於各 worker 啟動（preload 時 master 不會處理請求，也就不會在 fork 前建立執行緒）：
+# 定位壓縮（COMPACTION_INTERVAL_HOURS 未設定時不啟動）、工地在場時間分析（ANALYTICS_INTERVAL_MINUTES=0 時不啟動）、
+# 預先建立定位月份表（LOCATION_PARTITION_PREPARE_HOURS=0 時不啟動）
+@app.before_request
+def start_schedulers():
+    compaction.start_scheduler()
+    analytics.start_scheduler()
+    location_partitions.start_scheduler()
 
 # LINE Webhook
 @app.route("/callback", methods=["POST"])
 def callback():
     try:
         body = request.get_data(as_text=True)
-        handle_event(body)
+        if handle_event(body):
+            # 失敗的事件已撤銷登記，回 500 讓 LINE 重送（已處理的事件重送時會略過）
+            return "Retry", 500
         return "OK"
     except Exception as e:
-        print("LINE webhook 處理失敗：", str(e))
+        log("line.callback_error", "error", error=str(e))
         abort(400)
 
 # Blueprint 路由
 app.register_blueprint(location_bp, url_prefix="/location")
 app.register_blueprint(admin_bp, url_prefix="/admin")
+app.register_blueprint(qr_bp, url_prefix="/qr")
 
 if __name__ == "__main__":
+    # gunicorn 由 post_fork 載入（見 gunicorn.conf.py）
+    location_cache.warm()
     app.run()
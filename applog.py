@@ -0,0 +1,33 @@
+import json
+import os
+import random
+import sys
+import threading
+from datetime import datetime
+
+import metrics
+
+# 結構化紀錄：每行一個 JSON 物件（時間、等級、事件名稱與欄位），不再把整包定位資料印到 stdout。
+# 每筆定位、每次推播這類高頻事件以 sampled=True 呼叫，只輸出 LOG_SAMPLE_RATE 比例；警告與錯誤一律輸出。
+# 不論有沒有輸出，事件次數都會計入 yls_log_events_total（/admin/metrics）。
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_LEVEL = LEVELS.get(os.getenv("LOG_LEVEL", "info").lower(), LEVELS["info"])
+SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+_lock = threading.Lock()
+
+
+def log(event, level="info", sampled=False, **fields):
+    metrics.LOG_EVENTS.inc(event, level)
+    severity = LEVELS[level]
+    if severity < LOG_LEVEL:
+        return
+    if sampled and severity < LEVELS["warning"]:
+        if random.random() >= SAMPLE_RATE:
+            return
+        fields["sample_rate"] = SAMPLE_RATE
+    record = {"ts": datetime.now().isoformat(timespec="milliseconds"), "level": level, "event": event, **fields}
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
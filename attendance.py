@@ -0,0 +1,150 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+
+import calendar_index
+import data_version
+from db_pool import connection
+
+# daily_attendance：每位員工每天一列（上班最早時間、下班最晚時間、結果、工時），
+# 於寫入打卡的同一個交易內更新，匯出與後台都改讀這張表。
+# checkins 的 (employee_id, work_date, check_type) 有唯一索引：每人每天上下班各一筆，
+# 「是否已打卡」由 INSERT ... ON CONFLICT DO NOTHING 在寫入時一併判斷，不必先讀取再寫入。
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _worked_minutes(first_in, last_out):
+    if not first_in or not last_out:
+        return None
+    delta = datetime.strptime(last_out, TS_FORMAT) - datetime.strptime(first_in, TS_FORMAT)
+    return int(delta.total_seconds() // 60)
+
+
+def _next_day(date):
+    return (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d 00:00:00")
+
+
+def record_checkin(conn, employee_id, name, check_type, timestamp, result,
+                   latitude=None, longitude=None, distance=None, site_id=None, line_id=None):
+    # 寫入一筆打卡並同步更新當日出勤彙總，回傳是否寫入（當天已有同類打卡時回傳 False）；呼叫端負責 commit
+    inserted = conn.execute('''
+        INSERT INTO checkins (employee_id, line_id, name, check_type, timestamp, work_date, result,
+                              latitude, longitude, distance, site_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (employee_id, work_date, check_type) DO NOTHING
+    ''', (employee_id, line_id, name, check_type, timestamp, timestamp[:10], result,
+          latitude, longitude, distance, site_id)).rowcount
+    if not inserted:
+        return False
+    update_daily(conn, employee_id, name, check_type, timestamp, result)
+    calendar_index.mark(conn, "checkin", [timestamp])
+    data_version.touch(conn, "checkin", [timestamp])
+    return True
+
+
+def has_checkin(conn, employee_id, work_date, check_type):
+    # 以唯一索引查詢當天是否已有該類打卡
+    return conn.execute("SELECT 1 FROM checkins WHERE employee_id = ? AND work_date = ? AND check_type = ?",
+                        (employee_id, work_date, check_type)).fetchone() is not None
+
+
+def update_daily(conn, employee_id, name, check_type, timestamp, result):
+    date = timestamp[:10]
+    if check_type == "上班":
+        conn.execute('''
+            INSERT INTO daily_attendance (employee_id, date, name, first_in, in_result)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(employee_id, date) DO UPDATE SET
+                name = excluded.name,
+                in_result = CASE WHEN daily_attendance.first_in IS NULL OR excluded.first_in < daily_attendance.first_in
+                                 THEN excluded.in_result ELSE daily_attendance.in_result END,
+                first_in = CASE WHEN daily_attendance.first_in IS NULL OR excluded.first_in < daily_attendance.first_in
+                                THEN excluded.first_in ELSE daily_attendance.first_in END
+        ''', (employee_id, date, name, timestamp, result))
+    else:
+        conn.execute('''
+            INSERT INTO daily_attendance (employee_id, date, name, last_out, out_result)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(employee_id, date) DO UPDATE SET
+                name = excluded.name,
+                out_result = CASE WHEN daily_attendance.last_out IS NULL OR excluded.last_out >= daily_attendance.last_out
+                                  THEN excluded.out_result ELSE daily_attendance.out_result END,
+                last_out = CASE WHEN daily_attendance.last_out IS NULL OR excluded.last_out >= daily_attendance.last_out
+                                THEN excluded.last_out ELSE daily_attendance.last_out END
+        ''', (employee_id, date, name, timestamp, result))
+    first_in, last_out = conn.execute(
+        "SELECT first_in, last_out FROM daily_attendance WHERE employee_id = ? AND date = ?", (employee_id, date)
+    ).fetchone()
+    if first_in and last_out:
+        conn.execute("UPDATE daily_attendance SET worked_minutes = ? WHERE employee_id = ? AND date = ?",
+                     (_worked_minutes(first_in, last_out), employee_id, date))
+
+
+def get_daily(conn, employee_id, date):
+    # 回傳 (first_in, last_out, in_result, out_result)，當天沒有紀錄時回傳 None
+    return conn.execute('''
+        SELECT first_in, last_out, in_result, out_result FROM daily_attendance
+        WHERE employee_id = ? AND date = ?
+    ''', (employee_id, date)).fetchone()
+
+
+def rebuild(conn, start_date=None, end_date=None):
+    # 由 checkins 重建（回填）daily_attendance；不指定日期時重建全部，回傳寫入列數
+    where, params = "", ()
+    if start_date and end_date:
+        where, params = "WHERE date >= ? AND date <= ?", (start_date, end_date)
+    conn.execute(f"DELETE FROM daily_attendance {where}", params)
+
+    if start_date and end_date:
+        cursor = conn.execute('''
+            SELECT employee_id, name, check_type, timestamp, result FROM checkins
+            WHERE timestamp >= ? AND timestamp < ? AND employee_id IS NOT NULL ORDER BY employee_id, timestamp
+        ''', (f"{start_date} 00:00:00", _next_day(end_date)))
+    else:
+        cursor = conn.execute('''
+            SELECT employee_id, name, check_type, timestamp, result FROM checkins
+            WHERE employee_id IS NOT NULL ORDER BY employee_id, timestamp
+        ''')
+
+    written = 0
+    for _, events in groupby(cursor, key=lambda r: r[0]):
+        days = {}
+        for employee_id, name, check_type, timestamp, result in events:
+            day = days.setdefault(timestamp[:10], [employee_id, None, None, None, None, None])
+            day[1] = name
+            if check_type == "上班":
+                if day[2] is None or timestamp < day[2]:
+                    day[2], day[4] = timestamp, result
+            elif day[3] is None or timestamp >= day[3]:
+                day[3], day[5] = timestamp, result
+        rows = [(emp, date, name, first_in, last_out, in_result, out_result, _worked_minutes(first_in, last_out))
+                for date, (emp, name, first_in, last_out, in_result, out_result) in days.items()]
+        conn.executemany('''
+            INSERT INTO daily_attendance (employee_id, date, name, first_in, last_out, in_result, out_result, worked_minutes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        written += len(rows)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="由打卡紀錄重建每日出勤彙總（daily_attendance）")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("start_date", nargs="?", help="YYYY-MM-DD，未指定則重建全部")
+    parser.add_argument("end_date", nargs="?", help="YYYY-MM-DD")
+    args = parser.parse_args()
+    if bool(args.start_date) != bool(args.end_date):
+        parser.error("start_date 與 end_date 需同時指定")
+
+    from db import init_db  # db 匯入本模組，這裡延後匯入以免循環
+    init_db()
+    started = time.perf_counter()
+    with connection() as conn:
+        written = rebuild(conn, args.start_date, args.end_date)
+    print(f"✅ 已重建 {written:,} 筆每日出勤，耗時 {time.perf_counter() - started:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""匯出效能與記憶體量測：在不同資料量下產生定位 / 打卡 excel，記錄耗時、檔案大小與 Python 記憶體峰值。
+
+記憶體峰值以 tracemalloc 量測（不含 SQLite 的 page cache / mmap），
+若峰值隨資料量成長超過 --max-growth 倍即視為失敗（結束碼 1），可放在 CI 當作回歸檢查。
+固定資料量的上限檢查見 tests/test_export_memory.py：60 人 × 30 天、86,400 筆定位的匯出峰值約 1.8 MiB，上限 4 MiB。
+
+用法：
+    python benchmarks/bench_export.py                       # 預設 100k、400k、1.6M 筆定位
+    python benchmarks/bench_export.py --rows 50000 200000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import attendance  # noqa: E402
+import db  # noqa: E402
+import db_pool  # noqa: E402
+import exports  # noqa: E402
+import location_partitions  # noqa: E402
+
+EMPLOYEES = 60
+DAYS = 30
+
+
+def populate(path, rows):
+    conn = sqlite3.connect(path)
+    per_day = max(1, rows // (EMPLOYEES * DAYS))
+    step = max(1, 86400 // per_day)
+    # 先寫入暫存表再依月份搬進月份表
+    conn.execute("CREATE TEMP TABLE location_import (line_id, employee_id, name, latitude, longitude, timestamp, tst)")
+    conn.execute(f"""
+        WITH RECURSIVE seq(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM seq WHERE x < {rows - 1})
+        INSERT INTO location_import (line_id, employee_id, name, latitude, longitude, timestamp)
+        SELECT 'U' || (x % {EMPLOYEES}), printf('%03d', x % {EMPLOYEES}), 'emp' || (x % {EMPLOYEES}),
+               25.0478 + (x % 100) * 0.0001, 121.5319 + (x % 97) * 0.0001,
+               datetime('2024-03-01', '+' || ((x / {EMPLOYEES}) / {per_day}) || ' days',
+                        '+' || (((x / {EMPLOYEES}) % {per_day}) * {step}) || ' seconds')
+        FROM seq
+    """)
+    location_partitions.copy_from(conn, "location_import")
+    conn.execute(f"""
+        WITH RECURSIVE days(d) AS (SELECT 0 UNION ALL SELECT d + 1 FROM days WHERE d < {DAYS - 1}),
+             emps(e) AS (SELECT 0 UNION ALL SELECT e + 1 FROM emps WHERE e < {EMPLOYEES - 1})
+        INSERT INTO checkins (employee_id, line_id, name, check_type, timestamp, result)
+        SELECT printf('%03d', e), 'U' || e, 'emp' || e, t.check_type,
+               datetime('2024-03-01', '+' || d || ' days', t.offset), '正常'
+        FROM days, emps, (SELECT '上班' AS check_type, '+8 hours' AS offset
+                          UNION ALL SELECT '下班', '+17 hours') AS t
+    """)
+    attendance.rebuild(conn)
+    conn.commit()
+    conn.close()
+
+
+def measure(build):
+    tracemalloc.start()
+    started = time.perf_counter()
+    path = build("2024-03-01", "2024-03-31")
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size = os.path.getsize(path)
+    os.remove(path)
+    return elapsed, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 400_000, 1_600_000])
+    parser.add_argument("--max-growth", type=float, default=2.0,
+                        help="最大資料量與最小資料量的記憶體峰值比例上限")
+    args = parser.parse_args()
+
+    peaks = []
+    print(f"{'定位筆數':>10} {'匯出':<6} {'耗時(s)':>8} {'峰值(MiB)':>10} {'檔案(KiB)':>10}")
+    for rows in args.rows:
+        db_pool.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+        db.init_db()
+        populate(db_pool.DB_PATH, rows)
+        for label, build in (("定位", exports.build_locations_xlsx), ("打卡", exports.build_checkins_xlsx)):
+            elapsed, peak, size = measure(build)
+            if label == "定位":
+                peaks.append(peak)
+            print(f"{rows:>10,} {label:<6} {elapsed:>8.2f} {peak / 2 ** 20:>10.2f} {size / 1024:>10.1f}")
+        db_pool.close_all()
+
+    growth = max(peaks) / min(peaks)
+    print(f"\n定位匯出記憶體峰值成長：{growth:.2f}x（資料量成長 {max(args.rows) / min(args.rows):.0f}x）")
+    if growth > args.max_growth:
+        print(f"❌ 超過上限 {args.max_growth}x")
+        sys.exit(1)
+    print("✅ 記憶體用量與資料量無關")
+
+
+if __name__ == "__main__":
+    main()
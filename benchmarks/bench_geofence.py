@@ -0,0 +1,77 @@
+"""工地比對效能：單點查詢延遲與批次比對吞吐量。
+
+用法：
+    python benchmarks/bench_geofence.py --sites 10000 --points 200000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from geofence import SiteIndex, haversine_m  # noqa: E402
+
+# 台灣本島大致範圍
+LAT_RANGE = (22.0, 25.3)
+LNG_RANGE = (120.1, 122.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sites", type=int, default=10000)
+    parser.add_argument("--points", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    lats = rng.uniform(*LAT_RANGE, args.sites)
+    lngs = rng.uniform(*LNG_RANGE, args.sites)
+    radii = rng.choice([30, 50, 100, 300, 1000], args.sites)
+    sites = [(i + 1, f"site{i + 1}", lats[i], lngs[i], radii[i]) for i in range(args.sites)]
+
+    started = time.perf_counter()
+    index = SiteIndex(sites)
+    print(f"建立索引：{args.sites:,} 個工地、{len(index.cells):,} 格，{(time.perf_counter() - started) * 1000:.1f} ms")
+
+    # 一半的點落在工地附近，一半隨機分布
+    near = rng.integers(0, args.sites, args.points // 2)
+    p_lats = np.concatenate([lats[near] + rng.normal(0, 0.0003, len(near)),
+                             rng.uniform(*LAT_RANGE, args.points - len(near))])
+    p_lngs = np.concatenate([lngs[near] + rng.normal(0, 0.0003, len(near)),
+                             rng.uniform(*LNG_RANGE, args.points - len(near))])
+
+    samples = []
+    for lat, lng in zip(p_lats[:20000].tolist(), p_lngs[:20000].tolist()):
+        t = time.perf_counter()
+        index.match(lat, lng)
+        samples.append(time.perf_counter() - t)
+    samples.sort()
+    print(f"單點 match：p50 {statistics.median(samples) * 1e6:.1f} µs、"
+          f"p99 {samples[int(len(samples) * 0.99)] * 1e6:.1f} µs、max {samples[-1] * 1e6:.1f} µs")
+
+    t = time.perf_counter()
+    site_ids, _ = index.match_many(p_lats, p_lngs)
+    elapsed = time.perf_counter() - t
+    print(f"批次 match_many：{args.points:,} 點 {elapsed * 1000:.1f} ms（{args.points / elapsed:,.0f} 點/秒），"
+          f"命中 {(site_ids >= 0).sum():,}")
+
+    # 與舊做法（逐一計算每個工地距離）比較，抽樣 200 點
+    t = time.perf_counter()
+    for lat, lng in zip(p_lats[:200].tolist(), p_lngs[:200].tolist()):
+        d = haversine_m(lat, lng, lats, lngs)
+        np.any(d <= radii)
+    print(f"線性掃描（對照）：每點 {(time.perf_counter() - t) / 200 * 1e6:.1f} µs")
+
+    # 檢查結果一致
+    sample = slice(0, 2000)
+    brute = haversine_m(p_lats[sample, None], p_lngs[sample, None], lats[None, :], lngs[None, :])
+    brute_hit = (brute <= radii[None, :]).any(axis=1)
+    assert np.array_equal(brute_hit, site_ids[sample] >= 0), "索引結果與線性掃描不一致"
+    print("結果與線性掃描一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""比較加上索引與改寫成半開時間區間前後，熱門查詢的執行計畫與耗時。
+
+用法：
+    python benchmarks/bench_indexes.py               # 預設 10,000,000 筆定位
+    python benchmarks/bench_indexes.py --rows 200000 # 快速試跑
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import db  # noqa: E402
+import db_pool  # noqa: E402
+
+EMPLOYEES = 300
+DAY = "2024-03-15"
+MONTH_START, MONTH_END = "2024-03-01", "2024-03-31"
+# 比較的是索引與查詢寫法，只升級到定位分表（migration 10）之前，location_logs 仍是單一表
+INDEXED_VERSION = 9
+
+# (名稱, 改寫前 SQL, 改寫後 SQL, 參數前, 參數後)
+QUERIES = [
+    (
+        "process_message 今日打卡",
+        "SELECT check_type, timestamp FROM checkins WHERE employee_id=? AND DATE(timestamp)=? ORDER BY timestamp",
+        "SELECT check_type, timestamp FROM checkins WHERE employee_id=? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+        ("42", DAY),
+        ("42", *db.day_bounds(DAY, DAY)),
+    ),
+    (
+        "最新定位",
+        "SELECT latitude, longitude FROM location_logs WHERE line_id=? ORDER BY timestamp DESC LIMIT 1",
+        "SELECT latitude, longitude FROM location_logs WHERE line_id=? ORDER BY timestamp DESC LIMIT 1",
+        ("U42",),
+        ("U42",),
+    ),
+    (
+        "打卡匯出（整月）",
+        "SELECT employee_id, name, timestamp, check_type FROM checkins WHERE DATE(timestamp) BETWEEN ? AND ? ORDER BY employee_id, timestamp",
+        "SELECT employee_id, name, timestamp, check_type FROM checkins WHERE timestamp >= ? AND timestamp < ? ORDER BY employee_id, timestamp",
+        (MONTH_START, MONTH_END),
+        db.day_bounds(MONTH_START, MONTH_END),
+    ),
+    (
+        "定位匯出（單日）",
+        "SELECT employee_id, name, timestamp, latitude, longitude FROM location_logs WHERE DATE(timestamp) BETWEEN ? AND ? ORDER BY employee_id, timestamp",
+        "SELECT employee_id, name, timestamp, latitude, longitude FROM location_logs WHERE timestamp >= ? AND timestamp < ? ORDER BY employee_id, timestamp",
+        (DAY, DAY),
+        db.day_bounds(DAY, DAY),
+    ),
+    (
+        "後台定位日期清單",
+        "SELECT DISTINCT DATE(timestamp) FROM location_logs ORDER BY timestamp DESC",
+        "SELECT DISTINCT DATE(timestamp) AS d FROM location_logs ORDER BY d DESC",
+        (),
+        (),
+    ),
+]
+
+
+def populate(conn, rows):
+    # 以遞迴 CTE 直接在 SQLite 內產生資料，避免 Python 迴圈成為瓶頸
+    # 定位：每筆間隔 (一年秒數 / rows)，輪流分配給 EMPLOYEES 位員工
+    step = max(1, 365 * 86400 // rows)
+    conn.execute(f"""
+        WITH RECURSIVE seq(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM seq WHERE x < {rows - 1})
+        INSERT INTO location_logs (line_id, employee_id, name, latitude, longitude, timestamp)
+        SELECT 'U' || (x % {EMPLOYEES}), CAST(x % {EMPLOYEES} AS TEXT), 'emp' || (x % {EMPLOYEES}),
+               25.0478 + (x % 100) * 0.0001, 121.5319 + (x % 97) * 0.0001,
+               datetime('2024-01-01', '+' || (x * {step}) || ' seconds')
+        FROM seq
+    """)
+    # 打卡：每位員工每天上下班各一筆
+    conn.execute(f"""
+        WITH RECURSIVE days(d) AS (SELECT 0 UNION ALL SELECT d + 1 FROM days WHERE d < 364),
+             emps(e) AS (SELECT 0 UNION ALL SELECT e + 1 FROM emps WHERE e < {EMPLOYEES - 1})
+        INSERT INTO checkins (employee_id, line_id, name, check_type, timestamp, result)
+        SELECT CAST(e AS TEXT), 'U' || e, 'emp' || e, t.check_type,
+               datetime('2024-01-01', '+' || d || ' days', t.offset), '正常'
+        FROM days, emps, (SELECT '上班' AS check_type, '+8 hours' AS offset
+                          UNION ALL SELECT '下班', '+17 hours') AS t
+    """)
+    conn.commit()
+
+
+def plan(conn, sql, params):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def timing(conn, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def report(conn, label, use_new, repeat):
+    print(f"\n===== {label} =====")
+    results = {}
+    for name, old_sql, new_sql, old_params, new_params in QUERIES:
+        sql, params = (new_sql, new_params) if use_new else (old_sql, old_params)
+        elapsed = timing(conn, sql, params, repeat)
+        results[name] = elapsed
+        print(f"\n[{name}] {elapsed * 1000:.2f} ms")
+        for line in plan(conn, sql, params):
+            print("   ", line)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000, help="location_logs 筆數")
+    parser.add_argument("--repeat", type=int, default=3, help="每個查詢重複次數（取中位數）")
+    parser.add_argument("--db", help="資料庫路徑（預設使用暫存檔）")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+    db_pool.DB_PATH = path
+    conn = sqlite3.connect(path)
+    # 只建立最初的資料表（沒有索引、版本 0），模擬升級前的資料庫
+    db._create_tables(conn)
+
+    started = time.perf_counter()
+    populate(conn, args.rows)
+    print(f"產生 {args.rows:,} 筆定位、{EMPLOYEES * 365 * 2:,} 筆打卡：{time.perf_counter() - started:.1f} s（{path}）")
+
+    before = report(conn, "改寫前（無索引）", False, args.repeat)
+
+    started = time.perf_counter()
+    version = db.migrate(conn, until=INDEXED_VERSION)
+    conn.execute("ANALYZE")
+    print(f"\n執行 migration 至版本 {version}：{time.perf_counter() - started:.1f} s")
+
+    after = report(conn, "改寫後（有索引、半開區間）", True, args.repeat)
+
+    print("\n===== 摘要 =====")
+    for name in before:
+        speedup = before[name] / after[name] if after[name] else float("inf")
+        print(f"{name}: {before[name] * 1000:.2f} ms -> {after[name] * 1000:.2f} ms（{speedup:.1f}x）")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
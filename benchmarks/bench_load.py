@@ -0,0 +1,348 @@
+"""整體壓力測試：在 gunicorn 底下模擬持續定位回報、早上打卡尖峰與後台大範圍匯出。
+
+流程（全部在本機執行，不需連網）：
+  1. 沒有指定 --db 時先以 gen_data.py 產生合成資料（使用者、數個月的打卡與定位）
+  2. 啟動本機 LINE stub（line_stub.py）與 gunicorn（--workers 個 worker）
+  3. 持續定位：--employees 位員工每 --interval 秒對 /location/webhook 送一筆 OwnTracks 定位，持續 --duration 秒
+  4. 打卡尖峰：同一時間湧入 --rush 個已簽章的 LINE /callback「上班」事件（每個請求 --events-per-callback 個事件）
+  5. 後台匯出：登入後以 --export-range 送出打卡與定位的背景匯出工作各 --export-repeat 次，輪詢完成後下載
+  6. 依端點列出吞吐量、p50 / p95 / p99 延遲、錯誤數與資料庫鎖定錯誤（回應內容與 gunicorn log 中的 "database is locked"）
+
+用法：
+    python benchmarks/bench_load.py                                   # 2 個 worker、200 人、60 秒
+    python benchmarks/bench_load.py --workers 4 --employees 1000 --interval 10 --duration 120
+    python benchmarks/bench_load.py --db /tmp/load.db --export-range "2024-01-01 - 2024-03-31"
+    python benchmarks/bench_load.py --json report.json                 # 另存結果，方便比較不同版本
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, BENCH_DIR)
+import gen_data  # noqa: E402
+import line_stub  # noqa: E402
+
+LOCK_ERROR = "database is locked"
+
+
+class Recorder:
+    # 依端點收集每個請求的延遲與結果
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)    # 端點 -> [延遲秒數]
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.lock_errors = defaultdict(int)
+        self.spans = {}                     # 端點 -> [第一個請求開始, 最後一個請求結束]
+
+    def request(self, session, name, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=300, **kwargs)
+            status, text = response.status_code, response.text if response.status_code >= 400 else ""
+        except requests.RequestException as e:
+            response, status, text = None, "exception", str(e)
+        ended = time.perf_counter()
+        with self.lock:
+            self.samples[name].append(ended - started)
+            self.statuses[name][status] += 1
+            if LOCK_ERROR in text:
+                self.lock_errors[name] += 1
+            span = self.spans.setdefault(name, [started, ended])
+            span[0], span[1] = min(span[0], started), max(span[1], ended)
+        return response
+
+    def report(self):
+        rows = {}
+        for name, samples in self.samples.items():
+            samples = sorted(samples)
+            statuses = self.statuses[name]
+            ok = sum(count for status, count in statuses.items() if isinstance(status, int) and status < 400)
+            span = self.spans[name][1] - self.spans[name][0]
+            rows[name] = {
+                "requests": len(samples),
+                "ok": ok,
+                "errors": len(samples) - ok,
+                "lock_errors": self.lock_errors[name],
+                "throughput": round(len(samples) / span, 2) if span else 0.0,
+                "p50_ms": round(percentile(samples, 50) * 1000, 1),
+                "p95_ms": round(percentile(samples, 95) * 1000, 1),
+                "p99_ms": round(percentile(samples, 99) * 1000, 1),
+                "max_ms": round(samples[-1] * 1000, 1),
+                "statuses": {str(k): v for k, v in statuses.items()},
+            }
+        return rows
+
+
+def percentile(sorted_samples, p):
+    # nearest-rank
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, -(-len(sorted_samples) * p // 100))
+    return sorted_samples[int(rank) - 1]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(args, db_path, stub_url, workdir):
+    port = free_port()
+    env = dict(os.environ,
+               DB_PATH=db_path,
+               LINE_API_BASE=stub_url,
+               LINE_CHANNEL_ACCESS_TOKEN="bench-token",
+               LINE_CHANNEL_SECRET=args.channel_secret,
+               QR_CACHE_DIR=os.path.join(workdir, "qr"),
+               EXPORT_CACHE_DIR=os.path.join(workdir, "exports"),
+               COMPACTION_INTERVAL_HOURS="0")
+    log_path = os.path.join(workdir, "gunicorn.log")
+    log = open(log_path, "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "--workers", str(args.workers),
+         "--threads", str(args.threads), "--bind", f"127.0.0.1:{port}", "--timeout", "300"],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"❌ gunicorn 啟動失敗，請查看 {log_path}")
+        try:
+            requests.get(f"{base}/admin/login", timeout=1)
+            return process, base, log_path
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("❌ 等待 gunicorn 啟動逾時")
+
+
+def owntracks_fix(index, step):
+    # 在工地附近兩個相距約 30 公尺的點之間來回，避免被靜止過濾丟棄，也都在打卡範圍內
+    offset = 0.00014 if step % 2 else -0.00014
+    return {
+        "_type": "location",
+        "lat": gen_data.SITE_LAT + offset + random.uniform(-0.00001, 0.00001),
+        "lon": gen_data.SITE_LNG + random.uniform(-0.00001, 0.00001),
+        "tst": int(time.time()),
+        "topic": f"owntracks/{gen_data.employee_id(index)}/phone",
+    }
+
+
+def run_tracking(recorder, base, args):
+    # 每位員工固定間隔回報，起始時間隨機錯開；送不出去時延後，不補送
+    local = threading.local()
+    started = time.time()
+    schedule = sorted((random.uniform(0, args.interval), i) for i in range(args.employees))
+    steps = [0] * args.employees
+
+    def post(index):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        steps[index] += 1
+        recorder.request(session, "POST /location/webhook", "POST", f"{base}/location/webhook",
+                         json=owntracks_fix(index, steps[index]))
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        rounds = 0
+        while True:
+            for offset, index in schedule:
+                due = started + rounds * args.interval + offset
+                if due - started >= args.duration:
+                    return
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(post, index)
+            rounds += 1
+
+
+def sign(secret, body):
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def callback_body(indexes, text):
+    now = int(time.time() * 1000)
+    return json.dumps({
+        "destination": "Ubenchbot",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": now,
+            "webhookEventId": uuid.uuid4().hex,
+            "replyToken": uuid.uuid4().hex,
+            "source": {"type": "user", "userId": gen_data.line_id(i)},
+            "message": {"type": "text", "id": str(now + i), "text": text},
+        } for i in indexes],
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def run_rush(recorder, base, args):
+    # 所有請求同時送出，模擬早上打卡尖峰
+    per = args.events_per_callback
+    batches = [range(i, min(i + per, args.rush)) for i in range(0, args.rush, per)]
+    local = threading.local()
+
+    def post(indexes):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        body = callback_body([i % args.employees for i in indexes], "上班")
+        recorder.request(session, "POST /callback", "POST", f"{base}/callback", data=body,
+                         headers={"Content-Type": "application/json",
+                                  "X-Line-Signature": sign(args.channel_secret, body)})
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(post, batches))
+
+
+def run_exports(recorder, base, args):
+    session = requests.Session()
+    session.post(f"{base}/admin/login", data={"username": args.admin_user, "password": args.admin_password})
+    sizes = {}
+    for _ in range(args.export_repeat):
+        for kind in ("checkins", "locations"):
+            # 送出背景匯出工作後輪詢到完成再下載（已結束月份的第二次起會直接命中快取）
+            response = recorder.request(session, "POST /admin/api/exports", "POST", f"{base}/admin/api/exports",
+                                        data={"kind": kind, "daterange": args.export_range})
+            if response is None or not response.ok:
+                continue
+            job = response.json()
+            while job["status"] in ("queued", "running"):
+                time.sleep(0.2)
+                response = recorder.request(session, "GET /admin/api/exports/<id>", "GET",
+                                            f"{base}/admin/api/exports/{job['job_id']}")
+                if response is None or not response.ok:
+                    break
+                job = response.json()
+            if job["status"] != "done":
+                continue
+            response = recorder.request(session, "GET /admin/exports/<id>/download", "GET", f"{base}{job['download_url']}")
+            if response is not None and response.ok:
+                sizes[kind] = len(response.content)
+    return sizes
+
+
+def count_log(path, needle):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return sum(line.count(needle) for line in f)
+
+
+def print_report(rows):
+    print(f"\n{'端點':<34} {'請求':>7} {'錯誤':>6} {'鎖定':>5} {'req/s':>8} "
+          f"{'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'max(ms)':>9}")
+    for name, row in rows.items():
+        print(f"{name:<34} {row['requests']:>7} {row['errors']:>6} {row['lock_errors']:>5} {row['throughput']:>8.1f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="使用現有資料庫（會被寫入，請先複製）；未指定時產生合成資料")
+    parser.add_argument("--data-months", type=int, default=3, help="合成資料月數")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker 數")
+    parser.add_argument("--threads", type=int, default=4, help="每個 worker 的執行緒數")
+    parser.add_argument("--employees", type=int, default=200, help="回報定位的員工數（合成資料也產生同樣人數）")
+    parser.add_argument("--interval", type=float, default=5.0, help="每位員工定位間隔（秒）")
+    parser.add_argument("--duration", type=float, default=60.0, help="持續定位階段秒數（0 表示略過）")
+    parser.add_argument("--rush", type=int, default=None, help="打卡尖峰事件數（預設為員工數，0 表示略過）")
+    parser.add_argument("--events-per-callback", type=int, default=1, help="每個 /callback 請求的事件數")
+    parser.add_argument("--concurrency", type=int, default=32, help="壓測端同時連線數")
+    parser.add_argument("--export-range", default="2024-01-01 - 2024-03-31")
+    parser.add_argument("--export-repeat", type=int, default=1, help="匯出次數（0 表示略過）")
+    parser.add_argument("--channel-secret", default=os.getenv("LINE_CHANNEL_SECRET", "bench-secret"))
+    parser.add_argument("--admin-user", default="admin")
+    parser.add_argument("--admin-password", default="admin")
+    parser.add_argument("--stub-latency", type=float, default=0.05, help="LINE stub 每次 push 的延遲（秒）")
+    parser.add_argument("--json", help="將結果另存為 JSON")
+    parser.add_argument("--keep", action="store_true", help="保留暫存目錄（資料庫與 gunicorn log）")
+    args = parser.parse_args()
+    if args.rush is None:
+        args.rush = args.employees
+
+    workdir = tempfile.mkdtemp(prefix="yls-load-")
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(workdir, "load.db")
+    if not args.db:
+        started = time.perf_counter()
+        days, locations, checkins = gen_data.generate(db_path, args.employees, args.data_months)
+        print(f"📦 合成資料：{args.employees} 人、{days} 天，定位 {locations:,} 筆、打卡 {checkins:,} 筆"
+              f"（{time.perf_counter() - started:.1f} 秒）")
+
+    stub = line_stub.serve(port=0, latency=args.stub_latency)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    process, base, log_path = start_app(args, db_path, stub_url, workdir)
+    print(f"🚀 gunicorn {args.workers} workers × {args.threads} threads：{base}（log：{log_path}）")
+
+    recorder = Recorder()
+    phases = {}
+    try:
+        if args.duration > 0:
+            print(f"📍 持續定位：{args.employees} 人，每 {args.interval:g} 秒一筆，{args.duration:g} 秒")
+            started = time.perf_counter()
+            run_tracking(recorder, base, args)
+            phases["tracking"] = round(time.perf_counter() - started, 2)
+        if args.rush > 0:
+            print(f"⏰ 打卡尖峰：{args.rush} 個事件，每個請求 {args.events_per_callback} 個")
+            started = time.perf_counter()
+            run_rush(recorder, base, args)
+            phases["rush"] = round(time.perf_counter() - started, 2)
+        sizes = {}
+        if args.export_repeat > 0:
+            print(f"📊 後台匯出：{args.export_range} × {args.export_repeat}")
+            started = time.perf_counter()
+            sizes = run_exports(recorder, base, args)
+            phases["exports"] = round(time.perf_counter() - started, 2)
+        # 等背景推播送完再讀 stub 統計
+        time.sleep(1)
+        pushes = stub.state.snapshot()
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        stub.shutdown()
+
+    rows = recorder.report()
+    print_report(rows)
+    log_lock_errors = count_log(log_path, LOCK_ERROR)
+    print(f"\n階段耗時（秒）：{phases}")
+    print(f"匯出檔案大小（bytes）：{sizes}")
+    print(f"LINE stub：push {pushes['pushes']} 次、訊息 {pushes['messages']} 則")
+    print(f"gunicorn log 中的資料庫鎖定錯誤：{log_lock_errors}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "endpoints": rows, "phases": phases, "export_sizes": sizes,
+                       "line_pushes": pushes["pushes"], "line_messages": pushes["messages"],
+                       "log_lock_errors": log_lock_errors}, f, ensure_ascii=False, indent=2)
+        print(f"💾 已寫入 {args.json}")
+    if args.keep:
+        print(f"📁 暫存目錄：{workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
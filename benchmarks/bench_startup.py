@@ -0,0 +1,133 @@
+"""冷啟動效能：app 匯入時間分解（python -X importtime）與 gunicorn 啟動到第一個回應的時間。
+
+流程：
+  1. 以 python db.py 在暫存資料庫建立結構（模擬部署時的一次性初始化）
+  2. 以 python -X importtime -c "import app" 匯入 --runs 次，取 app 累計時間的中位數，並列出最耗時的模組
+  3. 啟動 gunicorn（1 個 worker，preload 開 / 關各 --runs 次），量測從啟動到 GET /admin/login 收到第一個 byte 的時間
+  4. 匯出與 QR Code 相關的套件（openpyxl、qrcode、PIL）在啟動時不應載入；
+     有載入或 app 匯入時間超過 --max-import-ms 時以非 0 結束，可放進 CI 防止退步
+
+用法：
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 5 --top 15 --max-import-ms 1500
+"""
+import argparse
+import http.client
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# 只在第一次使用時才載入的套件
+LAZY_MODULES = ("openpyxl", "qrcode", "PIL")
+_line = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def app_env(workdir):
+    return dict(os.environ,
+                DB_PATH=os.path.join(workdir, "startup.db"),
+                QR_CACHE_DIR=os.path.join(workdir, "qr"),
+                EXPORT_CACHE_DIR=os.path.join(workdir, "exports"),
+                METRICS_DIR=os.path.join(workdir, "metrics"),
+                COMPACTION_INTERVAL_HOURS="0",
+                ANALYTICS_INTERVAL_MINUTES="0")
+
+
+def import_profile(env):
+    # 回傳 [(模組, 巢狀深度, 自身 µs, 累計 µs)]
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _line.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, len(indent) // 2, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_byte(env, preload, timeout=60):
+    # 從啟動 gunicorn 到 GET /admin/login 收到回應第一個 byte 的秒數
+    port = free_port()
+    env = dict(env, GUNICORN_PRELOAD="1" if preload else "0")
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app", "--workers", "1",
+         "--bind", f"127.0.0.1:{port}"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise SystemExit("❌ gunicorn 啟動失敗")
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+            try:
+                conn.request("GET", "/admin/login")
+                response = conn.getresponse()
+                response.read(1)
+                return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.005)
+            finally:
+                conn.close()
+        raise SystemExit("❌ 等待 gunicorn 啟動逾時")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="每項量測次數（取中位數）")
+    parser.add_argument("--top", type=int, default=12, help="列出累計時間最長的前幾個模組")
+    parser.add_argument("--max-import-ms", type=float, default=2000.0, help="app 匯入時間上限（毫秒）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="yls-startup-")
+    env = app_env(workdir)
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "db.py"], cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    print(f"🗄️  部署初始化（python db.py）：{(time.perf_counter() - started) * 1000:.0f} ms")
+
+    profiles = [import_profile(env) for _ in range(args.runs)]
+    totals = [next(cumulative for name, depth, _, cumulative in rows if name == "app" and depth == 0)
+              for rows in profiles]
+    import_ms = statistics.median(totals) / 1000
+    print(f"\n📦 import app：{import_ms:.0f} ms（{args.runs} 次中位數）")
+    # 以最後一次為準，列出 app 直接或間接匯入、累計最久的模組（只看前兩層）
+    rows = sorted((r for r in profiles[-1] if 1 <= r[1] <= 2), key=lambda r: r[3], reverse=True)
+    print(f"{'模組':<40} {'自身(ms)':>9} {'累計(ms)':>9}")
+    for name, depth, self_us, cumulative_us in rows[:args.top]:
+        print(f"{'  ' * (depth - 1) + name:<40} {self_us / 1000:>9.1f} {cumulative_us / 1000:>9.1f}")
+
+    print(f"\n⏱️  gunicorn 啟動到第一個回應（1 個 worker，{args.runs} 次中位數）")
+    for preload in (True, False):
+        samples = [time_to_first_byte(env, preload) for _ in range(args.runs)]
+        print(f"preload {'開' if preload else '關'}：{statistics.median(samples) * 1000:.0f} ms"
+              f"（最快 {min(samples) * 1000:.0f} ms、最慢 {max(samples) * 1000:.0f} ms）")
+
+    loaded = sorted({name.split(".")[0] for name, *_ in profiles[-1]} & set(LAZY_MODULES))
+    failed = False
+    if loaded:
+        print(f"\n❌ 啟動時載入了應延後載入的套件：{', '.join(loaded)}")
+        failed = True
+    if import_ms > args.max_import_ms:
+        print(f"❌ app 匯入時間超過上限 {args.max_import_ms:.0f} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print(f"\n✅ 啟動時未載入 {', '.join(LAZY_MODULES)}，匯入時間在 {args.max_import_ms:.0f} ms 內")
+
+
+if __name__ == "__main__":
+    main()
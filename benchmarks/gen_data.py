@@ -0,0 +1,105 @@
+"""產生壓力測試用的合成資料：綁定使用者、數個月的打卡與定位紀錄。
+
+定位點只落在上班時間（08:00–18:00），每位員工每 --interval-minutes 分鐘一筆，
+位置在預設工地（總部）附近小幅移動；打卡每人每天上下班各一筆。
+資料以 SQL 遞迴 CTE 一次寫入，再重建每日出勤彙總與日曆索引，和正式流程寫出的結果一致。
+
+用法：
+    python benchmarks/gen_data.py --db /tmp/load.db                          # 300 人、3 個月
+    python benchmarks/gen_data.py --db /tmp/load.db --employees 1000 --months 6
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import attendance  # noqa: E402
+import calendar_index  # noqa: E402
+import db  # noqa: E402
+import db_pool  # noqa: E402
+import location_partitions  # noqa: E402
+
+# 與 migration 2 建立的預設工地相同
+SITE_LAT, SITE_LNG = 25.0478, 121.5319
+
+
+def line_id(i):
+    return f"Ubench{i:05d}"
+
+
+def employee_id(i):
+    return f"{i:04d}"
+
+
+def generate(path, employees=300, months=3, start="2024-01-01", interval_minutes=5):
+    # 每個月以 30 天計；回傳 (天數, 定位筆數, 打卡筆數)
+    db_pool.DB_PATH = path
+    db.init_db()
+    db_pool.close_all()
+
+    days = 30 * months
+    per_day = 10 * 60 // interval_minutes
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executemany("INSERT OR IGNORE INTO users (line_id, employee_id, name, bind_time) VALUES (?, ?, ?, ?)",
+                     [(line_id(i), employee_id(i), f"emp{i}", f"{start} 00:00:00") for i in range(employees)])
+    # 時間為台北時間，tst 換回 UTC 秒數（與 OwnTracks 寫入的資料相同）；先寫入暫存表再依月份搬進月份表
+    conn.execute("CREATE TEMP TABLE location_import (line_id, employee_id, name, latitude, longitude, timestamp, tst)")
+    conn.execute(f"""
+        WITH RECURSIVE days(d) AS (SELECT 0 UNION ALL SELECT d + 1 FROM days WHERE d < {days - 1}),
+             slots(s) AS (SELECT 0 UNION ALL SELECT s + 1 FROM slots WHERE s < {per_day - 1}),
+             emps(e) AS (SELECT 0 UNION ALL SELECT e + 1 FROM emps WHERE e < {employees - 1}),
+             points AS (
+                 SELECT e, s, datetime(?, '+' || d || ' days', '+8 hours',
+                                       '+' || (s * {interval_minutes * 60} + e % 60) || ' seconds') AS ts
+                 FROM days, slots, emps
+             )
+        INSERT INTO location_import (line_id, employee_id, name, latitude, longitude, timestamp, tst)
+        SELECT 'Ubench' || printf('%05d', e), printf('%04d', e), 'emp' || e,
+               {SITE_LAT} + ((e * 7 + s * 13) % 50 - 25) * 0.00002,
+               {SITE_LNG} + ((e * 11 + s * 17) % 50 - 25) * 0.00002,
+               ts, CAST(strftime('%s', ts) AS INTEGER) - 8 * 3600
+        FROM points
+    """, (start,))
+    location_partitions.copy_from(conn, "location_import")
+    conn.execute("DROP TABLE location_import")
+    conn.execute(f"""
+        WITH RECURSIVE days(d) AS (SELECT 0 UNION ALL SELECT d + 1 FROM days WHERE d < {days - 1}),
+             emps(e) AS (SELECT 0 UNION ALL SELECT e + 1 FROM emps WHERE e < {employees - 1})
+        INSERT INTO checkins (employee_id, line_id, name, check_type, timestamp, work_date, latitude, longitude,
+                              distance, result, site_id)
+        SELECT printf('%04d', e), 'Ubench' || printf('%05d', e), 'emp' || e, t.check_type,
+               datetime(?, '+' || d || ' days', t.offset, '+' || (e % 900) || ' seconds'),
+               date(?, '+' || d || ' days'), {SITE_LAT}, {SITE_LNG}, 0, '正常', 1
+        FROM days, emps, (SELECT '上班' AS check_type, '+7 hours' AS offset
+                          UNION ALL SELECT '下班', '+17 hours') AS t
+    """, (start, start))
+    attendance.rebuild(conn)
+    calendar_index.rebuild(conn)
+    conn.commit()
+    locations = conn.execute("SELECT COUNT(*) FROM location_logs").fetchone()[0]
+    checkins = conn.execute("SELECT COUNT(*) FROM checkins").fetchone()[0]
+    conn.close()
+    return days, locations, checkins
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True, help="輸出的 SQLite 檔案（請指定新檔案）")
+    parser.add_argument("--employees", type=int, default=300)
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--start", default="2024-01-01")
+    parser.add_argument("--interval-minutes", type=int, default=5, help="每位員工定位間隔（分鐘）")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    days, locations, checkins = generate(args.db, args.employees, args.months, args.start, args.interval_minutes)
+    print(f"✅ {args.employees} 人、{days} 天：定位 {locations:,} 筆、打卡 {checkins:,} 筆，"
+          f"{time.perf_counter() - started:.1f} 秒 → {args.db}")
+
+
+if __name__ == "__main__":
+    main()
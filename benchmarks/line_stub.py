@@ -0,0 +1,146 @@
+"""本機 LINE Messaging API stub，用來測試 line_dispatcher 與壓力測試，不會真的發訊息。
+
+用法：
+    python benchmarks/line_stub.py --port 8090 --fail-rate 0.1 --latency 0.05
+    LINE_API_BASE=http://127.0.0.1:8090 python app.py
+
+GET /stats 取得收到的 push 次數、訊息數與每位使用者的訊息內容；POST /reset 清空紀錄。
+測試可用 server.state.fail_next() 指定接下來幾次 push 的錯誤，server.state.attempts 為每次 push 的 (to, retry key, 狀態碼)。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubState:
+    def __init__(self, fail_rate=0.0, latency=0.0):
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.pushes = 0
+            self.messages = 0
+            self.failures = 0
+            self.retry_keys = set()
+            self.by_user = defaultdict(list)
+            self.attempts = []
+            self.scripted = deque()
+
+    def fail_next(self, status, retry_after=None, accepted=False):
+        # 下一次 push 回傳 status；accepted=True 時照常收下訊息再回傳錯誤（模擬回應遺失），以同一個 retry key 重送會得到 409
+        with self.lock:
+            self.scripted.append((status, retry_after, accepted))
+
+    def accept(self, to, messages, retry_key):
+        # 呼叫端持有 lock
+        if retry_key:
+            self.retry_keys.add(retry_key)
+        self.pushes += 1
+        self.messages += len(messages)
+        self.by_user[to].extend(m.get("text") or m.get("originalContentUrl") for m in messages)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "pushes": self.pushes,
+                "messages": self.messages,
+                "injected_failures": self.failures,
+                "by_user": dict(self.by_user),
+            }
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                return self._reply(200, state.snapshot())
+            self._reply(404, {"message": "Not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length)
+            if self.path == "/reset":
+                state.reset()
+                return self._reply(200, {})
+            if self.path != "/v2/bot/message/push":
+                return self._reply(404, {"message": "Not found"})
+            if state.latency:
+                time.sleep(state.latency)
+            body = json.loads(raw or b"{}")
+            messages = body.get("messages", [])
+            if not body.get("to") or not 1 <= len(messages) <= 5:
+                return self._reply(400, {"message": "The request body has 1 error(s)"})
+            retry_key = self.headers.get("X-Line-Retry-Key")
+            with state.lock:
+                status, headers = 200, None
+                if retry_key and retry_key in state.retry_keys:
+                    status = 409
+                elif state.scripted:
+                    status, retry_after, accepted = state.scripted.popleft()
+                    state.failures += 1
+                    headers = {"Retry-After": retry_after} if retry_after is not None else None
+                    if accepted:
+                        state.accept(body["to"], messages, retry_key)
+                elif random.random() < state.fail_rate:
+                    state.failures += 1
+                    status = random.choice([429, 500, 503])
+                    headers = {"Retry-After": "0"} if status == 429 else None
+                else:
+                    state.accept(body["to"], messages, retry_key)
+                state.attempts.append((body["to"], retry_key, status))
+            if status == 409:
+                return self._reply(409, {"message": "The retry key is already accepted"})
+            if status != 200:
+                return self._reply(status, {"message": "injected failure"}, headers)
+            self._reply(200, {})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(host="127.0.0.1", port=8090, fail_rate=0.0, latency=0.0):
+    state = StubState(fail_rate, latency)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="隨機回傳 429/5xx 的比例")
+    parser.add_argument("--latency", type=float, default=0.0, help="每次 push 的模擬延遲（秒）")
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.fail_rate, args.latency)
+    print(f"LINE stub 監聽 http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# 日曆索引：記錄每種資料（打卡 / 定位）有資料的日期，後台的日期與月份選單直接讀這張小表，
+# 不必對 checkins / location_logs 做 DISTINCT DATE 掃描。
+# 寫入資料時以 mark() 補上日期；整批刪除資料後以 rebuild() 或 clear() 同步。
+
+# 資料種類 -> 原始資料表
+SOURCES = {
+    "checkin": "checkins",
+    "location": "location_logs",
+}
+
+
+def mark(conn, source, dates):
+    # dates 為 "YYYY-MM-DD"（或完整 timestamp，只取前 10 碼）
+    conn.executemany("INSERT INTO calendar_dates (source, date) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                     [(source, d) for d in {d[:10] for d in dates}])
+
+
+def dates(conn, source):
+    cursor = conn.execute("SELECT date FROM calendar_dates WHERE source = ? ORDER BY date DESC", (source,))
+    return [r[0] for r in cursor.fetchall()]
+
+
+def months(conn, source):
+    cursor = conn.execute("""
+        SELECT DISTINCT substr(date, 1, 7) AS m FROM calendar_dates WHERE source = ? ORDER BY m DESC
+    """, (source,))
+    return [r[0] for r in cursor.fetchall()]
+
+
+def clear(conn, source=None):
+    if source:
+        conn.execute("DELETE FROM calendar_dates WHERE source = ?", (source,))
+    else:
+        conn.execute("DELETE FROM calendar_dates")
+
+
+def rebuild(conn, source=None):
+    # 由原始資料重新計算日期（刪除部分資料後使用）
+    for name in ([source] if source else SOURCES):
+        clear(conn, name)
+        conn.execute(f"""
+            INSERT INTO calendar_dates (source, date)
+            SELECT DISTINCT ?, substr(timestamp, 1, 10) FROM {SOURCES[name]} WHERE timestamp IS NOT NULL
+        """, (name,))
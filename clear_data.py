@@ -1,15 +1,24 @@
-import sqlite3
+from db_pool import connection
+import analytics
+import compaction
+import export_jobs
+import identity_cache
+import location_partitions
 
-DB_PATH = "checkin.db"
-
-conn = sqlite3.connect(DB_PATH)
-cursor = conn.cursor()
-
-cursor.execute("DELETE FROM checkins;")
-cursor.execute("DELETE FROM location_logs;")
-cursor.execute("DELETE FROM users;")
-cursor.execute("DELETE FROM user_states;")
-conn.commit()
-conn.close()
+# 打卡分批刪除，避免單一大交易長時間鎖住資料庫；定位直接 DROP 各月份表
+compaction.delete_in_chunks("checkins")
+with connection() as conn:
+    location_partitions.drop_all(conn)
+    conn.execute("DELETE FROM daily_attendance;")
+    conn.execute("DELETE FROM latest_location;")
+    conn.execute("DELETE FROM calendar_dates;")
+    conn.execute("DELETE FROM compaction_log;")
+    analytics.clear(conn)
+    export_jobs.clear(conn)
+    conn.execute("DELETE FROM users;")
+    conn.execute("DELETE FROM user_states;")
+    # 讓執行中的 worker 清掉身分快取
+    identity_cache.invalidate(conn)
+compaction.remove_archives()
 
 print("⚠️ 已清空所有資料（打卡、定位、綁定）")
@@ -0,0 +1,388 @@
+import argparse
+import csv
+import fcntl
+import glob
+import gzip
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from applog import log
+import data_version
+import db_pool
+import location_partitions
+import pg_backend
+from db_pool import connection
+
+tz = pytz.timezone("Asia/Taipei")
+
+# 定位資料保存策略：
+#   超過 DOWNSAMPLE_AFTER_DAYS 天的定位，每位員工每天依時間桶與移動距離抽稀
+#   （每個時間桶保留一點、移動超過 MIN_DISTANCE_M 的點一律保留、每天最後一點必定保留，匯出結果不變）
+#   超過 ARCHIVE_AFTER_DAYS 天的定位搬到 ARCHIVE_DIR 下每月一個的 gzip CSV，匯出時仍會讀取
+# 抽稀刪掉的原始點也會先寫入封存檔，封存檔保有完整原始資料；天數設為 0 表示停用該步驟，
+# ARCHIVE_DIR 設為空字串則超過保存期限的定位直接刪除、不封存。
+# 整個月份都超過保存期限時，整張月份表依序寫入封存檔後直接 DROP TABLE（見 location_partitions.py）。
+DOWNSAMPLE_AFTER_DAYS = int(os.getenv("LOCATION_DOWNSAMPLE_AFTER_DAYS", "30"))
+BUCKET_SECONDS = int(os.getenv("LOCATION_DOWNSAMPLE_BUCKET_SECONDS", "300"))
+MIN_DISTANCE_M = float(os.getenv("LOCATION_DOWNSAMPLE_MIN_DISTANCE_M", "100"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("LOCATION_ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_DIR = os.getenv("LOCATION_ARCHIVE_DIR", "archive")
+# 刪除時每批筆數與批次間的停頓，每批各自一個短交易，不會長時間擋住 webhook 寫入
+CHUNK_SIZE = int(os.getenv("COMPACTION_CHUNK_SIZE", "2000"))
+CHUNK_PAUSE = float(os.getenv("COMPACTION_CHUNK_PAUSE", "0.05"))
+# 排程：每隔幾小時在背景執行一次（0 表示不排程，改用 CLI / cron）；多個 worker 以檔案鎖確保同時只有一個在跑
+INTERVAL_HOURS = float(os.getenv("COMPACTION_INTERVAL_HOURS", "0"))
+LOCK_PATH = os.getenv("COMPACTION_LOCK_PATH", "compaction.lock")
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def _day_bounds(day):
+    end = datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)
+    return f"{day} 00:00:00", end.strftime("%Y-%m-%d 00:00:00")
+
+
+def _distance_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def _seconds_of_day(ts):
+    return int(ts[11:13]) * 3600 + int(ts[14:16]) * 60 + int(ts[17:19])
+
+
+def thin(points, bucket_seconds=BUCKET_SECONDS, min_distance_m=MIN_DISTANCE_M):
+    # points: 單一員工單日、依時間排序的 (id, line_id, employee_id, name, latitude, longitude, timestamp)
+    # 回傳要刪除的點；每個姓名當天的最後一點必定保留（匯出取每天最後一筆）
+    last_per_name = {p[3]: p[0] for p in points}
+    keep_ids = set(last_per_name.values())
+    dropped = []
+    last_bucket = last_kept = None
+    for p in points:
+        bucket = _seconds_of_day(p[6]) // bucket_seconds
+        if (p[0] in keep_ids or bucket != last_bucket or last_kept is None
+                or _distance_m(last_kept[4], last_kept[5], p[4], p[5]) >= min_distance_m):
+            last_bucket, last_kept = bucket, p
+        else:
+            dropped.append(p)
+    return dropped
+
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"location_logs_{month}.csv.gz")
+
+
+def append_archive(rows):
+    # 依月份附加到 gzip 檔（每次附加為一個新的 gzip member，讀取時會自動串接），回傳寫入的位元組數
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row[6][:7], []).append(row)
+    written = 0
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for month, month_rows in by_month.items():
+        path = archive_path(month)
+        before = os.path.getsize(path) if os.path.exists(path) else 0
+        with gzip.open(path, "at", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(month_rows)
+        written += os.path.getsize(path) - before
+    return written
+
+
+def iter_archived(start_date, end_date):
+    # 讀取封存檔中 [start_date, end_date] 的定位，產生 (id, line_id, employee_id, name, latitude, longitude, timestamp)
+    start, end = f"{start_date} 00:00:00", _day_bounds(end_date)[1]
+    month = start_date[:7]
+    while month <= end_date[:7]:
+        path = archive_path(month)
+        if os.path.exists(path):
+            with gzip.open(path, "rt", newline="", encoding="utf-8") as f:
+                for row in csv.reader(f):
+                    if start <= row[6] < end:
+                        yield (int(row[0]), row[1], row[2], row[3], float(row[4]), float(row[5]), row[6])
+        year, mon = int(month[:4]), int(month[5:7])
+        month = f"{year + mon // 12}-{mon % 12 + 1:02d}"
+
+
+def archived_last_fixes(start_date, end_date):
+    # 封存資料中每位員工、每個姓名每天的最後一筆，格式同匯出查詢：{工號: [(工號, 姓名, 時間, 緯度, 經度), ...]}
+    last = {}
+    for _, _, employee_id, name, latitude, longitude, timestamp in iter_archived(start_date, end_date):
+        key = (employee_id, name, timestamp[:10])
+        if key not in last or timestamp >= last[key][2]:
+            last[key] = (employee_id, name, timestamp, latitude, longitude)
+    by_employee = {}
+    for row in last.values():
+        by_employee.setdefault(row[0], []).append(row)
+    return by_employee
+
+
+def remove_archives():
+    for path in glob.glob(os.path.join(ARCHIVE_DIR, "location_logs_*.csv.gz")):
+        os.remove(path)
+
+
+def delete_ids(table, ids):
+    # 依主鍵分批刪除月份表中的定位，每批一個短交易，批次之間稍作停頓讓其他寫入取得鎖
+    ids = list(ids)
+    for i in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[i:i + CHUNK_SIZE]
+        with connection() as conn:
+            conn.execute(f"DELETE FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        if CHUNK_PAUSE and i + CHUNK_SIZE < len(ids):
+            time.sleep(CHUNK_PAUSE)
+    return len(ids)
+
+
+def delete_in_chunks(table, chunk_size=CHUNK_SIZE, pause=CHUNK_PAUSE):
+    # 分批清空整張表（取代單一大 DELETE），回傳刪除筆數
+    deleted = 0
+    while True:
+        with connection() as conn:
+            count = conn.execute(f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} LIMIT ?)",
+                                 (chunk_size,)).rowcount
+        deleted += count
+        if count < chunk_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+
+def _employee_day_rows(table, day):
+    # 逐位員工以 (employee_id, timestamp) 索引讀取月份表中的單日定位，每次只持有一位員工的資料；
+    # 每次讀取各自取用連線，呼叫端可在兩次讀取之間分批刪除並提交
+    bounds = _day_bounds(day)
+    with connection() as conn:
+        if table not in location_partitions.tables(conn, *bounds):
+            return
+        if not conn.execute(f"SELECT 1 FROM {table} WHERE timestamp >= ? AND timestamp < ? LIMIT 1",
+                            bounds).fetchone():
+            return
+        employee_id = conn.execute(f"SELECT MIN(employee_id) FROM {table}").fetchone()[0]
+    while employee_id is not None:
+        with connection() as conn:
+            rows = conn.execute(f"""
+                SELECT id, line_id, employee_id, name, latitude, longitude, timestamp FROM {table}
+                WHERE employee_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp
+            """, (employee_id, *bounds)).fetchall()
+            employee_id = conn.execute(f"SELECT MIN(employee_id) FROM {table} WHERE employee_id > ?",
+                                       (employee_id,)).fetchone()[0]
+        if rows:
+            yield rows
+
+
+def _log(day, stage, before, after):
+    with connection() as conn:
+        conn.execute("""
+            INSERT INTO compaction_log (date, stage, rows_before, rows_after, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(date) DO UPDATE SET stage = excluded.stage, rows_before = excluded.rows_before,
+                rows_after = excluded.rows_after, updated_at = excluded.updated_at
+        """, (day, stage, before, after, datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")))
+        # 已結束月份的匯出快取失效（不封存時整天的定位都已刪除）
+        data_version.touch(conn, "location", [day])
+
+
+def _archive_before(today):
+    return (today - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d") if ARCHIVE_AFTER_DAYS else None
+
+
+def _expired_months(today):
+    # 整個月份都早於封存期限的月份表
+    archive_before = _archive_before(today)
+    if not archive_before:
+        return []
+    with connection() as conn:
+        return [month for month in location_partitions.months(conn)
+                if location_partitions.month_bounds(month)[1][:10] <= archive_before]
+
+
+def archive_month(month, dry_run=False):
+    # 整張月份表寫入封存檔（ARCHIVE_DIR 為空時不寫）後 DROP TABLE，回傳 ({日期: 筆數}, 封存檔位元組數)；
+    # 讀取期間不鎖表，DROP 前在同一個交易內補上讀取後才寫入的列（id 大於已讀取的最大值）
+    table = location_partitions.table_name(month)
+    counts, written, last_id = {}, 0, 0
+
+    def archive(rows):
+        nonlocal written
+        for row in rows:
+            counts[row[6][:10]] = counts.get(row[6][:10], 0) + 1
+        if not dry_run:
+            written += append_archive(rows)
+
+    if not ARCHIVE_DIR:
+        # 不封存：只統計每天筆數後直接 DROP
+        with connection() as conn:
+            counts = dict(conn.execute(f"SELECT substr(timestamp, 1, 10), COUNT(*) FROM {table} GROUP BY 1").fetchall())
+            if not dry_run:
+                location_partitions.drop(conn, month)
+        return counts, 0
+    select = f"SELECT id, line_id, employee_id, name, latitude, longitude, timestamp FROM {table}"
+    with connection() as conn:
+        batch = []
+        for row in db_pool.stream(conn, f"{select} ORDER BY id"):
+            batch.append(row)
+            if len(batch) >= CHUNK_SIZE * 10:
+                archive(batch)
+                last_id, batch = batch[-1][0], []
+        if batch:
+            archive(batch)
+            last_id = batch[-1][0]
+    if dry_run:
+        return counts, written
+    with connection() as conn:
+        if db_pool.BACKEND == "postgres":
+            conn.execute(f"LOCK TABLE {table} IN EXCLUSIVE MODE")
+        late = conn.execute(f"{select} WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+        if late:
+            archive(late)
+        location_partitions.drop(conn, month)
+    return counts, written
+
+
+def _plan(today):
+    # 回傳 [(日期, 動作)]，動作為 archive / downsample
+    with connection() as conn:
+        first = location_partitions.first_timestamp(conn)
+        if not first:
+            return []
+        done = dict(conn.execute("SELECT date, stage FROM compaction_log").fetchall())
+    archive_before = _archive_before(today)
+    downsample_before = (today - timedelta(days=DOWNSAMPLE_AFTER_DAYS)).strftime("%Y-%m-%d") if DOWNSAMPLE_AFTER_DAYS else None
+    plan = []
+    day = datetime.strptime(first[:10], "%Y-%m-%d")
+    last = max(filter(None, (archive_before, downsample_before)), default=None)
+    while last and day.strftime("%Y-%m-%d") < last:
+        date = day.strftime("%Y-%m-%d")
+        if archive_before and date < archive_before:
+            plan.append((date, "archive"))
+        elif downsample_before and date < downsample_before and done.get(date) is None:
+            plan.append((date, "downsample"))
+        day += timedelta(days=1)
+    return plan
+
+
+def run(dry_run=False, today=None):
+    # 執行一次壓縮，回傳統計
+    today = today or datetime.now(tz).replace(tzinfo=None)
+    report = {"days": 0, "downsampled_rows": 0, "archived_rows": 0, "deleted_rows": 0, "archive_bytes": 0}
+    # 釋放空間只統計 SQLite（PostgreSQL 由 autovacuum 回收）
+    sqlite = db_pool.BACKEND == "sqlite"
+    with connection() as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0] if sqlite else 0
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0] if sqlite else 0
+    expired = _expired_months(today)
+    for month in expired:
+        counts, written = archive_month(month, dry_run=dry_run)
+        total = sum(counts.values())
+        report["days"] += len(counts)
+        report["archived_rows"] += total
+        report["archive_bytes"] += written
+        if dry_run:
+            continue
+        report["deleted_rows"] += total
+        for day, count in sorted(counts.items()):
+            _log(day, "archived", count, 0)
+    for day, action in _plan(today):
+        if dry_run and day[:7] in expired:
+            continue
+        table = location_partitions.table_name(day)
+        before = after = 0
+        for rows in _employee_day_rows(table, day):
+            dropped = rows if action == "archive" else thin(rows)
+            before += len(rows)
+            after += len(rows) - len(dropped)
+            report["archived_rows" if action == "archive" else "downsampled_rows"] += len(dropped)
+            if dry_run or not dropped:
+                continue
+            if ARCHIVE_DIR:
+                report["archive_bytes"] += append_archive(dropped)
+            report["deleted_rows"] += delete_ids(table, (row[0] for row in dropped))
+        if not before:
+            continue
+        report["days"] += 1
+        if not dry_run:
+            _log(day, "archived" if action == "archive" else "downsampled", before, after)
+    with connection() as conn:
+        free_after = conn.execute("PRAGMA freelist_count").fetchone()[0] if sqlite else 0
+    report["freed_bytes"] = max(free_after - free_before, 0) * page_size
+    return report
+
+
+def run_locked(dry_run=False):
+    # 以檔案鎖確保同一時間只有一個行程在壓縮；取不到鎖時回傳 None
+    # PostgreSQL 可能有多台主機，改用資料庫的 advisory lock
+    if db_pool.BACKEND == "postgres":
+        with pg_backend.advisory_lock("compaction") as locked:
+            return run(dry_run=dry_run) if locked else None
+    with open(LOCK_PATH, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        return run(dry_run=dry_run)
+
+
+_scheduler_pid = None
+
+
+def start_scheduler():
+    # 於每個行程各啟動一個排程執行緒（fork 後重新啟動），實際執行由檔案鎖互斥
+    global _scheduler_pid
+    if not INTERVAL_HOURS or _scheduler_pid == os.getpid():
+        return
+    _scheduler_pid = os.getpid()
+
+    def loop():
+        while True:
+            time.sleep(INTERVAL_HOURS * 3600)
+            try:
+                report = run_locked()
+                if report:
+                    log("compaction.done", **report)
+            except Exception as e:
+                log("compaction.error", "error", error=str(e))
+    threading.Thread(target=loop, name="compaction", daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="定位資料抽稀、封存與分批刪除")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="依保存策略執行一次")
+    run_parser.add_argument("--dry-run", action="store_true", help="只計算會處理的筆數，不刪除")
+    run_parser.add_argument("--vacuum", action="store_true", help="完成後執行 VACUUM 縮小資料庫檔案（期間會鎖住資料庫）")
+    sub.add_parser("status", help="列出已處理的日期")
+    args = parser.parse_args()
+
+    from db import init_db  # db 匯入 location_cache 等模組，這裡延後匯入
+    init_db()
+    if args.command == "status":
+        with connection() as conn:
+            for row in conn.execute("SELECT date, stage, rows_before, rows_after, updated_at FROM compaction_log ORDER BY date"):
+                print("{}\t{}\t{:,} -> {:,}\t{}".format(*row))
+        return
+
+    started = time.perf_counter()
+    report = run_locked(dry_run=args.dry_run)
+    if report is None:
+        print("⚠️ 另一個壓縮程序正在執行")
+        return
+    if args.vacuum and not args.dry_run and db_pool.BACKEND == "sqlite":
+        from db_pool import DB_PATH
+        before = os.path.getsize(DB_PATH)
+        with connection() as conn:
+            conn.execute("VACUUM")
+        report["vacuum_bytes"] = before - os.path.getsize(DB_PATH)
+    print(f"✅ 處理 {report['days']} 天，耗時 {time.perf_counter() - started:.2f} s")
+    print(f"抽稀刪除 {report['downsampled_rows']:,} 筆、封存 {report['archived_rows']:,} 筆，"
+          f"共刪除 {report['deleted_rows']:,} 筆")
+    print(f"封存檔寫入 {report['archive_bytes']:,} bytes，資料庫釋放 {report['freed_bytes']:,} bytes"
+          + (f"，VACUUM 縮小 {report['vacuum_bytes']:,} bytes" if "vacuum_bytes" in report else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import hashlib
+from datetime import datetime
+
+import pytz
+
+# 已結束月份的資料版本號（存於 meta，key 為 data_version:<種類>:<YYYY-MM>），匯出快取以此判斷是否過期。
+# 寫入或刪除資料時在同一個交易內以 touch() 把涉及的月份加一；本月資料持續變動、匯出不使用快取，不必記錄，
+# 熱門的寫入路徑因此只多一次日期比較。清空資料時 clear() 把共用的 epoch 加一，所有快取一起失效。
+# 種類："checkin"（打卡匯出）、"location"（定位匯出，含工地停留工作表）
+EPOCH_KEY = "data_version:epoch"
+tz = pytz.timezone("Asia/Taipei")
+
+
+def _key(source, month):
+    return f"data_version:{source}:{month}"
+
+
+def current_month():
+    return datetime.now(tz).strftime("%Y-%m")
+
+
+def touch(conn, source, dates):
+    # dates 為 "YYYY-MM-DD"（或完整 timestamp）；只記錄已結束的月份
+    current = current_month()
+    months = sorted({d[:7] for d in dates if d[:7] < current})
+    if months:
+        conn.executemany("""
+            INSERT INTO meta (key, value) VALUES (?, 1)
+            ON CONFLICT (key) DO UPDATE SET value = meta.value + 1
+        """, [(_key(source, month),) for month in months])
+
+
+def clear(conn):
+    conn.execute("""
+        INSERT INTO meta (key, value) VALUES (?, 1)
+        ON CONFLICT (key) DO UPDATE SET value = meta.value + 1
+    """, (EPOCH_KEY,))
+
+
+def digest(conn, source, months):
+    # 月份清單的版本摘要（含 epoch），任何一個月份的資料變更或清空後都會不同
+    keys = [EPOCH_KEY] + [_key(source, month) for month in months]
+    values = dict(conn.execute(f"SELECT key, value FROM meta WHERE key IN ({','.join('?' * len(keys))})",
+                               keys).fetchall())
+    text = ",".join(f"{key}={values.get(key, 0)}" for key in keys)
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
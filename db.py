@@ -1,10 +1,227 @@
-import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
+import db_pool
+import pg_backend
+from db_pool import connection
+from location_cache import upsert_latest
+import attendance
+import calendar_index
+import data_version
+import identity_cache
+import location_filter
+import location_partitions
 
-DB_NAME = "checkin.db"
+# 資料庫結構版本（記錄於 PRAGMA user_version）
+# 每個版本是一串 SQL（或接收 cursor 的函式），只能往後追加，不可修改已發布的版本
+MIGRATIONS = [
+    # 1：熱門查詢用的索引
+    [
+        "CREATE INDEX IF NOT EXISTS idx_checkins_employee_ts ON checkins(employee_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_checkins_ts ON checkins(timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_location_logs_line_ts ON location_logs(line_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_location_logs_ts ON location_logs(timestamp)",
+    ],
+    # 2：工地（打卡範圍）改存資料庫，每個工地可設定半徑；打卡紀錄補上比對到的工地
+    [
+        """
+        CREATE TABLE IF NOT EXISTS sites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            radius_m REAL NOT NULL DEFAULT 50,
+            active INTEGER NOT NULL DEFAULT 1
+        )
+        """,
+        "INSERT INTO sites (name, latitude, longitude, radius_m) VALUES ('總部', 25.0478, 121.5319, 50)",
+        "ALTER TABLE checkins ADD COLUMN site_id INTEGER",
+    ],
+    # 3：每個使用者的最新定位，打卡時直接以主鍵查詢，不必排序整張 location_logs
+    [
+        """
+        CREATE TABLE IF NOT EXISTS latest_location (
+            line_id TEXT PRIMARY KEY,
+            employee_id TEXT,
+            latitude REAL,
+            longitude REAL,
+            timestamp TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_latest_location_employee ON latest_location(employee_id)",
+        # SQLite 搭配 MAX() 時，其他欄位取自最大值那一列
+        """
+        INSERT OR REPLACE INTO latest_location (line_id, employee_id, latitude, longitude, timestamp)
+        SELECT line_id, employee_id, latitude, longitude, MAX(timestamp)
+        FROM location_logs WHERE line_id IS NOT NULL GROUP BY line_id
+        """,
+    ],
+    # 4：匯出時逐位員工依時間讀取定位
+    [
+        "CREATE INDEX IF NOT EXISTS idx_location_logs_employee_ts ON location_logs(employee_id, timestamp)",
+    ],
+    # 5：每日出勤彙總（每人每天一列），打卡時同步更新，並由歷史打卡回填
+    [
+        """
+        CREATE TABLE IF NOT EXISTS daily_attendance (
+            employee_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            name TEXT,
+            first_in TEXT,
+            last_out TEXT,
+            in_result TEXT,
+            out_result TEXT,
+            worked_minutes INTEGER,
+            PRIMARY KEY (employee_id, date)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_daily_attendance_date ON daily_attendance(date)",
+        lambda cursor: attendance.rebuild(cursor.connection),
+    ],
+    # 6：日曆索引（各類資料有資料的日期），後台選單不再對大表做 DISTINCT DATE 掃描
+    [
+        """
+        CREATE TABLE IF NOT EXISTS calendar_dates (
+            source TEXT NOT NULL,
+            date TEXT NOT NULL,
+            PRIMARY KEY (source, date)
+        ) WITHOUT ROWID
+        """,
+        lambda cursor: calendar_index.rebuild(cursor.connection),
+    ],
+    # 7：定位壓縮（抽稀 / 封存）進度，每天一列
+    [
+        """
+        CREATE TABLE IF NOT EXISTS compaction_log (
+            date TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            rows_before INTEGER,
+            rows_after INTEGER,
+            updated_at TEXT
+        )
+        """,
+    ],
+    # 8：保存 OwnTracks 原始 tst，同一員工重送的相同 tst 由唯一索引擋下（舊資料 tst 為 NULL，不受影響）
+    [
+        "ALTER TABLE location_logs ADD COLUMN tst INTEGER",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_location_logs_employee_tst
+        ON location_logs(employee_id, tst) WHERE tst IS NOT NULL
+        """,
+    ],
+    # 9：跨 worker 共用的版本號（users_version：綁定資料變更時加一，各 worker 據此清空身分快取）
+    [
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        """,
+        "INSERT OR IGNORE INTO meta (key, value) VALUES ('users_version', 0)",
+    ],
+    # 10：定位依月份分表（見 location_partitions.py），既有資料搬進各月份表，location_logs 改為檢視表
+    [
+        "CREATE TABLE IF NOT EXISTS location_partitions (month TEXT PRIMARY KEY)",
+        lambda cursor: location_partitions.migrate(cursor.connection),
+    ],
+    # 11：打卡的工作日期與唯一索引（每人每天上下班各一筆，由資料庫擋下重複打卡），LINE 事件去重表
+    [
+        "ALTER TABLE checkins ADD COLUMN work_date TEXT",
+        # 既有的重複打卡保留原樣，只有每組的第一筆填入 work_date（NULL 不受唯一索引限制）
+        """
+        UPDATE checkins SET work_date = substr(timestamp, 1, 10) WHERE id IN (
+            SELECT MIN(id) FROM checkins WHERE employee_id IS NOT NULL AND timestamp IS NOT NULL
+            GROUP BY employee_id, substr(timestamp, 1, 10), check_type
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_checkins_employee_work_date_type
+        ON checkins(employee_id, work_date, check_type)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS line_events (
+            event_id TEXT PRIMARY KEY,
+            received_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_line_events_received_at ON line_events(received_at)",
+    ],
+    # 12：工地在場時間彙總（見 analytics.py），每人每天每個工地一列；各月份表記錄已分析到的 id
+    [
+        """
+        CREATE TABLE IF NOT EXISTS onsite_daily (
+            employee_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            site_id INTEGER NOT NULL,
+            seconds INTEGER NOT NULL DEFAULT 0,
+            visits INTEGER NOT NULL DEFAULT 0,
+            first_arrival TEXT,
+            last_departure TEXT,
+            PRIMARY KEY (employee_id, date, site_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_onsite_daily_date ON onsite_daily(date)",
+        """
+        CREATE TABLE IF NOT EXISTS onsite_state (
+            employee_id TEXT PRIMARY KEY,
+            last_ts TEXT NOT NULL,
+            site_id INTEGER NOT NULL
+        )
+        """,
+        "ALTER TABLE location_partitions ADD COLUMN analyzed_id INTEGER NOT NULL DEFAULT 0",
+    ],
+    # 13：背景匯出工作（見 export_jobs.py），任何 worker 都能查詢進度
+    [
+        """
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            version TEXT,
+            status TEXT NOT NULL,
+            progress INTEGER NOT NULL DEFAULT 0,
+            path TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_export_jobs_created_at ON export_jobs(created_at)",
+    ],
+    # 14：worker 啟動時依時間載入最近的定位（location_cache.warm）
+    [
+        "CREATE INDEX IF NOT EXISTS idx_latest_location_timestamp ON latest_location(timestamp)",
+    ],
+]
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    # 結構已是最新版本時只做一次查詢就返回（每個 worker 啟動時都會呼叫）；
+    # 實際建立與升級在部署時執行一次：python db.py（Render 的 preDeployCommand、Procfile 的 release），
+    # 部署流程沒有執行時（例如 SQLite 在 persistent disk 上）由 gunicorn preload 的 master 執行
+    with connection() as conn:
+        if schema_version(conn) == len(MIGRATIONS):
+            return
+        if db_pool.BACKEND == "postgres":
+            # PostgreSQL 直接建立最新結構（見 pg_backend.SCHEMA），新增 migration 時兩邊要一起更新
+            pg_backend.init_schema(conn)
+            location_partitions.migrate(conn)
+            conn.execute("""
+                INSERT INTO meta (key, value) VALUES ('schema_version', ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """, (len(MIGRATIONS),))
+            return
+        _create_tables(conn)
+        migrate(conn)
+
+def schema_version(conn):
+    # SQLite 記在 PRAGMA user_version；PostgreSQL 沒有對應的 migration，完成 init_schema 後記在 meta
+    if db_pool.BACKEND == "sqlite":
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    if not conn.execute("SELECT to_regclass('meta')").fetchone()[0]:
+        return 0
+    row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+    return row[0] if row else 0
+
+def _create_tables(conn):
     cursor = conn.cursor()
 
     # 使用者主表：正式綁定資料
@@ -43,6 +260,7 @@ def init_db():
             last_updated TEXT
         )
     """)
+    # 定位記錄表（舊版單一表，migration 10 拆成月份表後同名的檢視表已存在，這裡不會再建立）
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS location_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -56,52 +274,86 @@ def init_db():
     """)
 
     conn.commit()
-    conn.close()
 
-def bind_user(line_id, employee_id, name):
-    conn = sqlite3.connect(DB_NAME)
+def migrate(conn, until=None):
+    # until：只升級到指定版本（效能比較用），預設為最新版本
     cursor = conn.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for target, steps in enumerate(MIGRATIONS[version:until], start=version + 1):
+        cursor.execute("BEGIN")
+        try:
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+def day_bounds(start_date, end_date):
+    # 將日期區間 [start_date, end_date] 轉為半開時間區間 [start, end)，讓查詢能走 timestamp 索引
+    end = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
+    return f"{start_date} 00:00:00", end.strftime("%Y-%m-%d 00:00:00")
+
+def bind_user(line_id, employee_id, name):
     try:
-        cursor.execute("INSERT INTO users (line_id, employee_id, name, bind_time) VALUES (?, ?, ?, ?)",
-                       (line_id, employee_id, name, datetime.now().isoformat()))
-        conn.commit()
+        with connection() as conn:
+            conn.execute("INSERT INTO users (line_id, employee_id, name, bind_time) VALUES (?, ?, ?, ?)",
+                         (line_id, employee_id, name, datetime.now().isoformat()))
+            identity_cache.invalidate(conn)
         return True
-    except sqlite3.IntegrityError:
+    except db_pool.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 def get_employee_by_line_id(line_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT employee_id, name FROM users WHERE line_id = ?", (line_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result
+    user = identity_cache.get_by_line_id(line_id)
+    return user[1:] if user else None
 
 def has_checked_in_today(employee_id, check_type):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
     today = datetime.now().strftime("%Y-%m-%d")
-    cursor.execute("""
-        SELECT * FROM checkins 
-        WHERE employee_id = ? AND check_type = ? AND DATE(timestamp) = ?
-    """, (employee_id, check_type, today))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+    with connection() as conn:
+        return attendance.has_checkin(conn, employee_id, today, check_type)
 
 def save_checkin(data):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO checkins (
-            employee_id, line_id, name, check_type, timestamp,
-            latitude, longitude, distance, result
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        data["employee_id"], data["line_id"], data["name"], data["check_type"], data["timestamp"],
-        data["latitude"], data["longitude"], data["distance"], data["result"]
-    ))
-    conn.commit()
-    conn.close()
+    # 回傳是否寫入；當天已有同類打卡時不寫入（見 attendance.record_checkin）
+    with connection() as conn:
+        return attendance.record_checkin(
+            conn, data["employee_id"], data["name"], data["check_type"], data["timestamp"], data["result"],
+            data["latitude"], data["longitude"], data["distance"], line_id=data["line_id"]
+        )
+
+def insert_locations(conn, rows, count_duplicates=True):
+    # 批次寫入定位點，rows 為 (line_id, employee_id, name, latitude, longitude, timestamp, tst)，
+    # tst 為 OwnTracks 原始時間（可為 None）；依 timestamp 寫入各月份表，
+    # 同一員工重複的 tst 直接略過（相同 tst 換算出的時間相同，必定落在同一張表），回傳實際寫入筆數。
+    # 略過的筆數計入即時過濾的統計（location_filter）；歷史匯入自行統計，傳 count_duplicates=False
+    inserted = 0
+    for table, table_rows in location_partitions.route(conn, rows).items():
+        if db_pool.BACKEND == "postgres":
+            inserted += pg_backend.insert_locations(conn, table, table_rows)
+            continue
+        before = conn.total_changes
+        conn.executemany(f"""
+            INSERT INTO {table} (line_id, employee_id, name, latitude, longitude, timestamp, tst)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT DO NOTHING
+        """, table_rows)
+        inserted += conn.total_changes - before
+    if count_duplicates:
+        location_filter.count_db_duplicates(len(rows) - inserted)
+    upsert_latest(conn, rows)
+    calendar_index.mark(conn, "location", (row[5] for row in rows))
+    if inserted:
+        # 補傳到已結束月份的定位會讓該月的匯出快取失效
+        data_version.touch(conn, "location", (row[5] for row in rows))
+    return inserted
+
+if __name__ == "__main__":
+    # 部署時執行一次：建立資料表並套用 migration
+    init_db()
+    with connection() as conn:
+        print(f"✅ 資料庫結構版本 {schema_version(conn)}（{db_pool.BACKEND}）")
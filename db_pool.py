@@ -0,0 +1,198 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import metrics
+import pg_backend
+
+# 所有模組共用的資料庫路徑與連線設定
+# DATABASE_URL 為 postgresql://... 時改用 PostgreSQL（見 pg_backend.py），否則使用本機 SQLite 檔案
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+BACKEND = "postgres" if DATABASE_URL.startswith(("postgres://", "postgresql://")) else "sqlite"
+DB_PATH = os.getenv("DB_PATH", "checkin.db")
+BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "10"))
+CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(128 * 1024 * 1024)))
+STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", "256"))
+MAX_IDLE = int(os.getenv("SQLITE_POOL_MAX_IDLE", "8"))
+
+_lock = threading.Lock()
+_local = threading.local()
+_idle = []
+_pid = None
+# fork 前父行程留下的連線：子行程不可使用也不可關閉，只保留參照避免被回收
+_inherited = []
+# 兩種後端的例外，呼叫端以 except db_pool.IntegrityError 捕捉
+IntegrityError = (sqlite3.IntegrityError, pg_backend.IntegrityError)
+OperationalError = (sqlite3.OperationalError, pg_backend.OperationalError)
+
+_stats = {
+    "opened": 0,
+    "closed": 0,
+    "checkouts": 0,
+    "reused": 0,
+    "in_use": 0,
+    "commits": 0,
+    "rollbacks": 0,
+}
+
+
+def _open():
+    # 連線類別會為每個語句計時（metrics.py，METRICS_SQL=0 可關閉）
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE,
+                           check_same_thread=False, factory=metrics.connection_factory())
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    with _lock:
+        _stats["opened"] += 1
+    return conn
+
+
+def _reset_after_fork():
+    # gunicorn worker 由 master fork 而來，繼承的連線一律作廢
+    global _pid
+    _inherited.extend(_idle)
+    _idle.clear()
+    _local.__dict__.clear()
+    for key in _stats:
+        _stats[key] = 0
+    _pid = os.getpid()
+
+
+def _checkout():
+    if BACKEND == "postgres":
+        conn = pg_backend.checkout()
+        with _lock:
+            _stats["checkouts"] += 1
+            _stats["in_use"] += 1
+        return conn
+    with _lock:
+        if _pid != os.getpid():
+            _reset_after_fork()
+        _stats["checkouts"] += 1
+        _stats["in_use"] += 1
+        if _idle:
+            _stats["reused"] += 1
+            return _idle.pop()
+    return _open()
+
+
+def _checkin(conn):
+    if BACKEND == "postgres":
+        with _lock:
+            _stats["in_use"] -= 1
+        pg_backend.checkin(conn)
+        return
+    with _lock:
+        _stats["in_use"] -= 1
+        if len(_idle) < MAX_IDLE:
+            _idle.append(conn)
+            return
+        _stats["closed"] += 1
+    conn.close()
+
+
+def _active():
+    # 目前執行緒是否在 connection() 區塊內
+    return getattr(_local, "pid", None) == os.getpid() and getattr(_local, "depth", 0)
+
+
+@contextmanager
+def connection():
+    # 同一執行緒內巢狀使用會拿到同一條連線與同一個交易；
+    # 最外層正常結束時 commit、發生例外時 rollback，再把連線歸還連線池
+    if _active():
+        _local.depth += 1
+        try:
+            yield _local.conn
+        finally:
+            _local.depth -= 1
+        return
+
+    conn = _checkout()
+    _local.conn, _local.depth, _local.pid, _local.callbacks = conn, 1, os.getpid(), []
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+            with _lock:
+                _stats["commits"] += 1
+    except BaseException:
+        conn.rollback()
+        with _lock:
+            _stats["rollbacks"] += 1
+        raise
+    finally:
+        callbacks = _local.callbacks
+        _local.conn, _local.depth, _local.callbacks = None, 0, []
+        _checkin(conn)
+    for callback in callbacks:
+        callback()
+
+
+def after_commit(callback):
+    # 目前執行緒的交易提交後才執行 callback（例如更新行程內快取），rollback 時捨棄；
+    # 不在 connection() 內時直接執行
+    if _active():
+        _local.callbacks.append(callback)
+    else:
+        callback()
+
+
+@contextmanager
+def savepoint(conn, name):
+    # 區塊內發生例外時只回復區塊內的寫入與 after_commit 登記的 callback，外層交易的其他部分照常在最後提交；
+    # 區塊內不可呼叫 conn.commit()
+    if BACKEND == "sqlite" and not conn.in_transaction:
+        # 沒有交易時 SAVEPOINT 會自行開始交易，RELEASE 就直接提交了
+        conn.execute("BEGIN")
+    conn.execute(f"SAVEPOINT {name}")
+    callbacks = _local.callbacks if _active() else []
+    mark = len(callbacks)
+    try:
+        yield conn
+    except BaseException:
+        conn.execute(f"ROLLBACK TO SAVEPOINT {name}")
+        conn.execute(f"RELEASE SAVEPOINT {name}")
+        del callbacks[mark:]
+        raise
+    conn.execute(f"RELEASE SAVEPOINT {name}")
+
+
+def close_all():
+    if BACKEND == "postgres":
+        pg_backend.close_all()
+        return
+    with _lock:
+        if _pid != os.getpid():
+            return
+        while _idle:
+            _idle.pop().close()
+            _stats["closed"] += 1
+
+
+def stats():
+    with _lock:
+        data = dict(_stats)
+        data["idle"] = len(_idle) if _pid == os.getpid() else 0
+    data["max_idle"] = MAX_IDLE
+    data["backend"] = BACKEND
+    data["pid"] = os.getpid()
+    return data
+
+
+def stream(conn, sql, params=(), size=5000):
+    # 逐批讀取大量資料：PostgreSQL 用伺服器端游標，SQLite 本身就是逐列讀取，以 fetchmany 分批
+    if hasattr(conn, "stream"):
+        yield from conn.stream(sql, params, size)
+        return
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
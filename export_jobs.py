@@ -0,0 +1,215 @@
+import glob
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytz
+from flask import send_file
+
+import analytics
+import data_version
+import exports
+import location_partitions
+from applog import log
+from db_pool import connection
+
+tz = pytz.timezone("Asia/Taipei")
+
+# 背景匯出：後台送出日期區間後建立一筆 export_jobs（回傳 job id），由本行程的執行緒池產生檔案，
+# 進度與結果記在資料表內，任何 worker 都能查詢；請求本身不再等待匯出完成，不會卡住 worker 或逾時。
+# 整個區間都在已結束的月份時，檔案存在 EXPORT_CACHE_DIR，檔名含（種類, 起, 迄, 資料版本摘要），
+# 相同請求直接回傳快取；資料變更或清空時版本摘要改變（見 data_version.py），舊檔在下次產生時刪除。
+# 含本月的區間每次重新產生，檔案保留 EXPORT_JOB_TTL_HOURS 小時供下載。
+# 多台主機共用 PostgreSQL 時，EXPORT_CACHE_DIR 需放在共用磁碟上。
+CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", "export_cache")
+WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+JOB_TTL_HOURS = float(os.getenv("EXPORT_JOB_TTL_HOURS", "24"))
+# 執行中的工作超過此秒數沒有更新，視為行程已中斷（例如 worker 重啟）
+STALE_SECONDS = int(os.getenv("EXPORT_JOB_STALE_SECONDS", "600"))
+PROGRESS_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 60
+
+# 匯出種類 -> (產生函式, 資料版本種類, 下載檔名)
+KINDS = {
+    "checkins": (exports.build_checkins_xlsx, "checkin", "打卡紀錄"),
+    "locations": (exports.build_locations_xlsx, "location", "定位紀錄"),
+}
+ACTIVE = ("queued", "running")
+COLUMNS = ("id", "kind", "start_date", "end_date", "version", "status", "progress", "path", "error",
+           "created_at", "updated_at")
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+
+
+def _now():
+    return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _ago(seconds):
+    return (datetime.now(tz) - timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _get_executor():
+    # gunicorn fork 之後父行程的執行緒不存在，每個行程各自建立執行緒池
+    global _executor, _executor_pid
+    with _lock:
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="export")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _months(start_date, end_date):
+    months, month = [], start_date[:7]
+    while month <= end_date[:7]:
+        months.append(month)
+        month = location_partitions.next_month(month)
+    return months
+
+
+def cache_path(kind, start_date, end_date, version):
+    # 絕對路徑（send_file 的相對路徑以程式目錄為準，不是工作目錄）
+    return os.path.join(os.path.abspath(CACHE_DIR), f"{kind}_{start_date}_{end_date}_{version}.xlsx")
+
+
+def _update(job_id, **fields):
+    fields["updated_at"] = _now()
+    with connection() as conn:
+        conn.execute(f"UPDATE export_jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                     (*fields.values(), job_id))
+
+
+def submit(kind, start_date, end_date):
+    # 建立匯出工作並回傳其內容；已結束月份有快取時直接完成，相同的工作正在執行時回傳該工作
+    if kind not in KINDS:
+        raise ValueError(f"未知的匯出種類：{kind}")
+    _prune()
+    now = _now()
+    with connection() as conn:
+        version = None
+        if end_date[:7] < data_version.current_month():
+            # 版本摘要要在讀取資料前取得：產生期間資料若有變更，這份檔案之後就不會再被使用
+            version = data_version.digest(conn, KINDS[kind][1], _months(start_date, end_date))
+            path = cache_path(kind, start_date, end_date, version)
+            if os.path.exists(path):
+                job = dict(zip(COLUMNS, (uuid.uuid4().hex, kind, start_date, end_date, version, "done", 100, path,
+                                         None, now, now)))
+                _insert(conn, job)
+                return job
+        row = conn.execute(f"""
+            SELECT {', '.join(COLUMNS)} FROM export_jobs
+            WHERE kind = ? AND start_date = ? AND end_date = ? AND COALESCE(version, '') = ?
+              AND status IN (?, ?) AND updated_at >= ?
+            ORDER BY created_at DESC LIMIT 1
+        """, (kind, start_date, end_date, version or "", *ACTIVE, _ago(STALE_SECONDS))).fetchone()
+        if row:
+            return dict(zip(COLUMNS, row))
+        job = dict(zip(COLUMNS, (uuid.uuid4().hex, kind, start_date, end_date, version, "queued", 0, None, None,
+                                 now, now)))
+        _insert(conn, job)
+    _get_executor().submit(_run, job)
+    return job
+
+
+def _insert(conn, job):
+    conn.execute(f"INSERT INTO export_jobs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                 tuple(job.values()))
+
+
+def _run(job):
+    # 在背景執行緒產生檔案；進度由另一個執行緒每秒寫入（匯出本身的連線只讀取，不夾帶寫入）
+    build = KINDS[job["kind"]][0]
+    state = {"progress": 0}
+    finished = threading.Event()
+
+    def report(done, total):
+        state["progress"] = min(99, done * 100 // total) if total else 0
+
+    def reporter():
+        # 進度有變化時寫入；沒有變化時每 HEARTBEAT_INTERVAL 秒仍更新一次，避免被當成中斷
+        written, written_at = 0, time.monotonic()
+        while not finished.wait(PROGRESS_INTERVAL):
+            if state["progress"] != written or time.monotonic() - written_at >= HEARTBEAT_INTERVAL:
+                written, written_at = state["progress"], time.monotonic()
+                _update(job["id"], progress=written)
+
+    _update(job["id"], status="running")
+    thread = threading.Thread(target=reporter, name=f"export-progress-{job['id'][:8]}", daemon=True)
+    thread.start()
+    try:
+        if job["kind"] == "locations":
+            # 先補上工地停留分析（在背景執行緒，不占用請求）；分析變更了已結束月份時，快取改記在新的版本下
+            analytics.refresh()
+            if job["version"]:
+                with connection() as conn:
+                    job["version"] = data_version.digest(conn, KINDS[job["kind"]][1],
+                                                         _months(job["start_date"], job["end_date"]))
+                _update(job["id"], version=job["version"])
+        tmp_path = build(job["start_date"], job["end_date"], report)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if job["version"]:
+            path = cache_path(job["kind"], job["start_date"], job["end_date"], job["version"])
+            # 同一區間舊版本的快取已不會再用到
+            for old in glob.glob(cache_path(job["kind"], job["start_date"], job["end_date"], "*")):
+                os.remove(old)
+        else:
+            path = os.path.join(os.path.abspath(CACHE_DIR), f"job_{job['id']}.xlsx")
+        # 暫存檔可能在另一個檔案系統（/tmp），先搬到同一目錄再改名，其他請求不會看到寫到一半的檔案
+        shutil.move(tmp_path, f"{path}.part")
+        os.replace(f"{path}.part", path)
+        fields = {"status": "done", "progress": 100, "path": path}
+    except Exception as e:
+        log("export.job_error", "error", job_id=job["id"], kind=job["kind"], error=str(e))
+        fields = {"status": "error", "error": str(e)}
+    # 等進度執行緒結束，最後的狀態才不會被較晚寫入的進度蓋過
+    finished.set()
+    thread.join()
+    _update(job["id"], **fields)
+
+
+def get(job_id):
+    # 回傳工作內容（dict）或 None；執行中但太久沒有更新的工作標示為中斷
+    with connection() as conn:
+        row = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM export_jobs WHERE id = ?", (job_id,)).fetchone()
+    if not row:
+        return None
+    job = dict(zip(COLUMNS, row))
+    if job["status"] in ACTIVE and job["updated_at"] < _ago(STALE_SECONDS):
+        job["status"], job["error"] = "error", "匯出中斷，請重新送出"
+    elif job["status"] == "done" and not os.path.exists(job["path"]):
+        job["status"], job["error"] = "error", "檔案已過期，請重新送出"
+    return job
+
+
+def send(job):
+    # 快取檔案會重複使用，下載後不刪除
+    label = KINDS[job["kind"]][2]
+    return send_file(job["path"], mimetype=exports.XLSX_MIMETYPE, as_attachment=True,
+                     download_name=f"{label}_{job['start_date']}_to_{job['end_date']}.xlsx")
+
+
+def _prune():
+    # 刪除超過保留時間的工作紀錄與其（非快取的）檔案
+    cutoff = _ago(JOB_TTL_HOURS * 3600)
+    with connection() as conn:
+        rows = conn.execute("SELECT id, version, path FROM export_jobs WHERE created_at < ?", (cutoff,)).fetchall()
+        if not rows:
+            return
+        conn.execute("DELETE FROM export_jobs WHERE created_at < ?", (cutoff,))
+    for _, version, path in rows:
+        if not version and path and os.path.exists(path):
+            os.remove(path)
+
+
+def clear(conn):
+    # 清空資料時呼叫：所有快取失效並刪除檔案
+    data_version.clear(conn)
+    conn.execute("DELETE FROM export_jobs")
+    for path in glob.glob(os.path.join(CACHE_DIR, "*.xlsx")):
+        os.remove(path)
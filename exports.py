@@ -0,0 +1,262 @@
+import functools
+import os
+import tempfile
+from itertools import groupby
+
+import analytics
+import compaction
+import location_partitions
+import metrics
+from db import day_bounds
+import db_pool
+from db_pool import connection
+
+# 定位匯出流程：只讀區間涵蓋到的月份表，逐位員工以 (employee_id, timestamp) 索引分批讀取，每累積 3 位員工就寫出一個工作表，
+# 使用 openpyxl write-only 模式逐列寫入暫存檔，由背景匯出工作（見 export_jobs.py）搬到匯出目錄後供下載。
+# 記憶體用量只與「3 位員工 × 日期數」及 FETCH_SIZE 有關，不隨資料筆數成長；
+# 實測數據見 benchmarks/bench_export.py，記憶體上限由 tests/test_export_memory.py 檢查。
+# 打卡匯出改讀 daily_attendance（見 attendance.py），資料量只與員工數 × 日期數有關。
+# 定位匯出另附一個「工地停留」工作表，讀預先計算好的 onsite_daily（見 analytics.py）。
+# openpyxl 匯入約需 0.2 秒，只在實際產生檔案時才載入，不拖慢 worker 啟動。
+FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "5000"))
+EMPLOYEES_PER_SHEET = 3
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def iter_rows(conn, sql, params, size=FETCH_SIZE):
+    # PostgreSQL 為伺服器端游標，每次只取回 size 筆
+    return db_pool.stream(conn, sql, params, size)
+
+
+def iter_employee_rows(conn, tables, query, bounds):
+    # 逐位員工做索引範圍查詢（query 的參數為 employee_id, 起, 迄，{table} 代入各月份表），
+    # 依員工順序產生資料列；同一位員工依月份先後讀取各表，不必對整個區間排序
+    employee_id = _next_employee(conn, tables)
+    while employee_id is not None:
+        for table in tables:
+            yield from iter_rows(conn, query.format(table=table), (employee_id, *bounds))
+        employee_id = _next_employee(conn, tables, employee_id)
+
+
+def _next_employee(conn, tables, after=None):
+    # 各表中排在 after 之後的最小工號（每張表一次索引查詢）
+    found = []
+    for table in tables:
+        if after is None:
+            row = conn.execute(f"SELECT MIN(employee_id) FROM {table}").fetchone()
+        else:
+            row = conn.execute(f"SELECT MIN(employee_id) FROM {table} WHERE employee_id > ?", (after,)).fetchone()
+        if row[0] is not None:
+            found.append(row[0])
+    return min(found, default=None)
+
+
+def _count_employees(conn, tables):
+    # 月份表中的員工數（逐位以索引跳到下一個工號），作為進度的分母；包含區間內沒有定位的員工，只是估計值
+    count = 0
+    employee_id = _next_employee(conn, tables)
+    while employee_id is not None:
+        count += 1
+        employee_id = _next_employee(conn, tables, employee_id)
+    return count
+
+
+def _date_str(ts):
+    # "YYYY-MM-DD HH:MM:SS" -> "YYYY/MM/DD"
+    return ts[:10].replace("-", "/")
+
+
+def _group_employees(rows, step, finish):
+    # rows 依 employee_id, timestamp 排序；以 (工號, 姓名) 為一位員工，依首次出現順序逐位產生
+    # step(state, row) 逐筆累積單一員工的狀態，finish(state) 轉成 {日期: (值1, 值2)}
+    for emp_id, emp_rows in groupby(rows, key=lambda r: r[0]):
+        by_name = {}
+        for row in emp_rows:
+            state = by_name.get(row[1])
+            if state is None:
+                state = by_name[row[1]] = {}
+            step(state, row)
+        for name, state in by_name.items():
+            yield (emp_id, name), finish(state)
+
+
+def _write_sheets(wb, title_format, columns, employees, sorted_dates, progress=None):
+    # employees: 依序產生 ((工號, 姓名), {日期: (值1, 值2)})，每 3 位一個工作表；progress(已處理員工數) 回報進度
+    idx = 0
+    batch = []
+    for done, employee in enumerate(employees, start=1):
+        batch.append(employee)
+        if progress:
+            progress(done)
+        if len(batch) == EMPLOYEES_PER_SHEET:
+            idx += 1
+            _write_sheet(wb, title_format.format(idx), columns, batch, sorted_dates)
+            batch = []
+    if batch:
+        idx += 1
+        _write_sheet(wb, title_format.format(idx), columns, batch, sorted_dates)
+
+
+def _write_sheet(wb, title, columns, group, sorted_dates):
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Font
+    from openpyxl.utils import get_column_letter
+
+    ws = wb.create_sheet(title=title)
+    width = len(group) * 4 - 1
+    header = [None] * width
+    labels = [None] * width
+    for i, ((emp_id, name), _) in enumerate(group):
+        col = i * 4
+        cell = WriteOnlyCell(ws, value=f"工號：{emp_id} 姓名：{name}")
+        cell.font = Font(bold=True)
+        header[col] = cell
+        for offset, label in enumerate(("日期",) + columns):
+            cell = WriteOnlyCell(ws, value=label)
+            cell.alignment = Alignment(horizontal="center")
+            labels[col + offset] = cell
+        ws.merged_cells.add(f"{get_column_letter(col + 1)}1:{get_column_letter(col + 3)}1")
+    ws.append(header)
+    ws.append(labels)
+    for date in sorted_dates:
+        row = [None] * width
+        for i, (_, values) in enumerate(group):
+            col = i * 4
+            first, second = values.get(date, (None, None))
+            row[col:col + 3] = (date, first, second)
+        ws.append(row)
+
+
+def _save(wb):
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def _instrumented(kind):
+    # 匯出耗時與檔案大小記入 /admin/metrics
+    def decorate(build):
+        @functools.wraps(build)
+        def wrapper(start_date, end_date, progress=None):
+            with metrics.timer(metrics.EXPORT_LATENCY, kind):
+                path = build(start_date, end_date, progress)
+            metrics.EXPORT_SIZE.observe(os.path.getsize(path), kind)
+            return path
+        return wrapper
+    return decorate
+
+
+@_instrumented("checkins")
+def build_checkins_xlsx(start_date, end_date, progress=None):
+    # 直接讀每日出勤彙總（每人每天一列），依主鍵 (employee_id, date) 順序產生；
+    # progress(已處理員工數, 員工總數) 供背景匯出回報進度（見 export_jobs.py）
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    with connection() as conn:
+        sorted_dates = sorted(_date_str(r[0]) for r in conn.execute('''
+            SELECT DISTINCT date FROM daily_attendance
+            WHERE date >= ? AND date <= ? AND first_in IS NOT NULL
+        ''', (start_date, end_date)))
+        if progress:
+            total = conn.execute('''
+                SELECT COUNT(DISTINCT employee_id) FROM daily_attendance
+                WHERE date >= ? AND date <= ? AND first_in IS NOT NULL
+            ''', (start_date, end_date)).fetchone()[0]
+            progress = functools.partial(progress, total=total)
+        rows = iter_rows(conn, '''
+            SELECT employee_id, name, date, first_in, last_out FROM daily_attendance
+            WHERE date >= ? AND date <= ? AND first_in IS NOT NULL
+            ORDER BY employee_id, date
+        ''', (start_date, end_date))
+        employees = _group_employees(rows, _collect_checkin, lambda state: state)
+        _write_sheets(wb, "第{}頁", ("上班", "下班"), employees, sorted_dates, progress)
+    return _save(wb)
+
+
+def _collect_checkin(state, row):
+    _, _, date, first_in, last_out = row
+    state[_date_str(date)] = (first_in[11:16], last_out[11:16] if last_out else "")
+
+
+@_instrumented("locations")
+def build_locations_xlsx(start_date, end_date, progress=None):
+    bounds = day_bounds(start_date, end_date)
+    # 已封存的定位只取每人每天最後一筆，資料量與員工數 × 日期數相當
+    archived = compaction.archived_last_fixes(start_date, end_date)
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    with connection() as conn:
+        tables = location_partitions.tables(conn, *bounds)
+        dates = set()
+        for table in tables:
+            dates.update(r[0] for r in conn.execute(f'''
+                SELECT DISTINCT substr(timestamp, 1, 10) FROM {table}
+                WHERE timestamp >= ? AND timestamp < ?
+            ''', bounds))
+        dates.update(row[2][:10] for rows in archived.values() for row in rows)
+        sorted_dates = sorted(_date_str(d) for d in dates)
+        if progress:
+            progress = functools.partial(progress, total=_count_employees(conn, tables))
+        rows = iter_employee_rows(conn, tables, LAST_FIX_QUERY[db_pool.BACKEND], bounds)
+        if archived:
+            rows = _merge_archived(rows, archived)
+        employees = _group_employees(rows, _collect_location, lambda state: state)
+        _write_sheets(wb, "定位{}", ("緯度", "經度"), employees, sorted_dates, progress)
+        _write_onsite_sheet(wb, analytics.daily(conn, start_date, end_date))
+    return _save(wb)
+
+
+def _write_onsite_sheet(wb, rows):
+    # 每人每天每個工地一列
+    ws = wb.create_sheet(title="工地停留")
+    ws.append(["工號", "姓名", "日期", "工地", "到達", "離開", "停留（分鐘）", "進出次數"])
+    for emp_id, name, date, site_id, site, seconds, visits, first_arrival, last_departure in rows:
+        ws.append([emp_id, name, _date_str(date), site or f"#{site_id}", first_arrival[11:16],
+                   last_departure[11:16], round(seconds / 60), visits])
+
+
+# 每人每天只取最後一筆，在資料庫端完成彙總（同一天必定在同一張月份表內）
+LAST_FIX_QUERY = {
+    # SQLite 搭配 MAX() 時其他欄位取自最大值那一列
+    "sqlite": '''
+        SELECT employee_id, name, MAX(timestamp) AS ts, latitude, longitude FROM {table}
+        WHERE employee_id = ? AND timestamp >= ? AND timestamp < ?
+        GROUP BY name, DATE(timestamp)
+        ORDER BY ts
+    ''',
+    "postgres": '''
+        SELECT * FROM (
+            SELECT DISTINCT ON (name, substr(timestamp, 1, 10))
+                   employee_id, name, timestamp AS ts, latitude, longitude FROM {table}
+            WHERE employee_id = ? AND timestamp >= ? AND timestamp < ?
+            ORDER BY name, substr(timestamp, 1, 10), timestamp DESC
+        ) AS last_fix
+        ORDER BY ts
+    ''',
+}
+
+
+def _merge_archived(rows, archived):
+    # rows 依 employee_id 排序；把封存資料併入同一位員工並依時間排序，同一天較晚的一筆會覆蓋較早的
+    pending = sorted(archived)
+    for emp_id, emp_rows in groupby(rows, key=lambda r: r[0]):
+        while pending and pending[0] < emp_id:
+            yield from sorted(archived[pending.pop(0)], key=lambda r: r[2])
+        if pending and pending[0] == emp_id:
+            yield from sorted([*emp_rows, *archived[pending.pop(0)]], key=lambda r: r[2])
+        else:
+            yield from emp_rows
+    for emp_id in pending:
+        yield from sorted(archived[emp_id], key=lambda r: r[2])
+
+
+def _collect_location(state, row):
+    _, _, ts, lat, lng = row
+    state[_date_str(ts)] = (lat, lng)
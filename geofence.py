@@ -0,0 +1,217 @@
+import argparse
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from db import day_bounds
+from db_pool import connection
+import location_partitions
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEGREE = 111320.0
+# 網格邊長（公尺）：每個工地登記到它的範圍所覆蓋的每一格，查詢時只需看點所在的那一格
+CELL_SIZE_M = float(os.getenv("GEOFENCE_CELL_SIZE_M", "250"))
+# 多個 worker 各自快取工地索引，每隔一段時間重新載入以取得其他行程的異動
+RELOAD_INTERVAL = float(os.getenv("GEOFENCE_RELOAD_INTERVAL", "60"))
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    # 向量化 haversine，參數可為純量或 numpy 陣列（支援 broadcasting），單位為度，回傳公尺
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SiteIndex:
+    def __init__(self, sites, cell_size_m=CELL_SIZE_M):
+        # sites: [(id, name, latitude, longitude, radius_m), ...]
+        self.cell_deg = cell_size_m / METERS_PER_DEGREE
+        self.ids = np.array([s[0] for s in sites], dtype=np.int64)
+        self.names = [s[1] for s in sites]
+        self.lats = np.array([s[2] for s in sites], dtype=float)
+        self.lngs = np.array([s[3] for s in sites], dtype=float)
+        self.radii = np.array([s[4] for s in sites], dtype=float)
+        cells = defaultdict(list)
+        for idx in range(len(sites)):
+            lat, lng, radius = self.lats[idx], self.lngs[idx], self.radii[idx]
+            dlat = radius / METERS_PER_DEGREE
+            dlng = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+            for i in range(self._cell(lat - dlat), self._cell(lat + dlat) + 1):
+                for j in range(self._cell(lng - dlng), self._cell(lng + dlng) + 1):
+                    cells[self._key(i, j)].append(idx)
+        self.cells = {key: np.array(value, dtype=np.int64) for key, value in cells.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, degrees):
+        return int(math.floor(degrees / self.cell_deg))
+
+    @staticmethod
+    def _key(i, j):
+        # 將 (緯度格, 經度格) 合成單一整數鍵，純量與 numpy 陣列皆適用
+        return i * 1000000 + j
+
+    def site(self, idx):
+        return {
+            "id": int(self.ids[idx]),
+            "name": self.names[idx],
+            "latitude": float(self.lats[idx]),
+            "longitude": float(self.lngs[idx]),
+            "radius_m": float(self.radii[idx]),
+        }
+
+    def match(self, lat, lng):
+        # 回傳 (工地資料, 距離公尺)；不在任何工地範圍內時回傳 (None, None)
+        candidates = self.cells.get(self._key(self._cell(lat), self._cell(lng)))
+        if candidates is None:
+            return None, None
+        distances = haversine_m(lat, lng, self.lats[candidates], self.lngs[candidates])
+        inside = distances <= self.radii[candidates]
+        if not inside.any():
+            return None, None
+        best = np.argmin(np.where(inside, distances, np.inf))
+        return self.site(candidates[best]), float(distances[best])
+
+    def match_many(self, lats, lngs):
+        # 批次比對：回傳 (site_ids, distances)，不在範圍內者 site_id 為 -1、距離為 NaN
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        n = len(lats)
+        site_ids = np.full(n, -1, dtype=np.int64)
+        distances = np.full(n, np.nan)
+        if not n or not self.cells:
+            return site_ids, distances
+        keys = self._key(np.floor(lats / self.cell_deg).astype(np.int64),
+                         np.floor(lngs / self.cell_deg).astype(np.int64))
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        empty = np.empty(0, dtype=np.int64)
+        per_key = [self.cells.get(int(k), empty) for k in unique_keys]
+        counts = np.array([len(c) for c in per_key], dtype=np.int64)[inverse]
+        if not counts.any():
+            return site_ids, distances
+        # 展開成 (點, 候選工地) 配對，一次算完全部距離
+        pair_points = np.repeat(np.arange(n), counts)
+        pair_sites = np.concatenate([per_key[k] for k in inverse.tolist()])
+        dist = haversine_m(lats[pair_points], lngs[pair_points], self.lats[pair_sites], self.lngs[pair_sites])
+        dist = np.where(dist <= self.radii[pair_sites], dist, np.inf)
+        # 每個點取距離最近且在範圍內的工地
+        order = np.lexsort((dist, pair_points))
+        first = order[np.r_[True, pair_points[order][1:] != pair_points[order][:-1]]]
+        hit = np.isfinite(dist[first])
+        site_ids[pair_points[first][hit]] = self.ids[pair_sites[first][hit]]
+        distances[pair_points[first][hit]] = dist[first][hit]
+        return site_ids, distances
+
+
+_lock = threading.Lock()
+_index = None
+_loaded_at = 0.0
+
+
+def load_sites(conn):
+    cursor = conn.execute("SELECT id, name, latitude, longitude, radius_m FROM sites WHERE active = 1 ORDER BY id")
+    return cursor.fetchall()
+
+
+def get_index():
+    global _index, _loaded_at
+    if _index is not None and time.monotonic() - _loaded_at < RELOAD_INTERVAL:
+        return _index
+    with _lock:
+        if _index is None or time.monotonic() - _loaded_at >= RELOAD_INTERVAL:
+            with connection() as conn:
+                _index = SiteIndex(load_sites(conn))
+            _loaded_at = time.monotonic()
+    return _index
+
+
+def invalidate():
+    global _index
+    _index = None
+
+
+def match(lat, lng):
+    return get_index().match(lat, lng)
+
+
+def match_many(lats, lngs):
+    return get_index().match_many(lats, lngs)
+
+
+def score_location_logs(start_date, end_date, chunk_size=50000):
+    # 批次重新評分歷史定位：逐張月份表、逐批讀取並向量化比對，產生 (ids, employee_ids, site_ids, distances)
+    index = get_index()
+    bounds = day_bounds(start_date, end_date)
+    with connection() as conn:
+        for table in location_partitions.tables(conn, *bounds):
+            cursor = conn.execute(f"""
+                SELECT id, employee_id, latitude, longitude FROM {table}
+                WHERE timestamp >= ? AND timestamp < ?
+            """, bounds)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                ids, employee_ids, lats, lngs = zip(*rows)
+                site_ids, distances = index.match_many(lats, lngs)
+                yield ids, employee_ids, site_ids, distances
+
+
+def add_site(name, latitude, longitude, radius_m=50):
+    with connection() as conn:
+        conn.execute("INSERT INTO sites (name, latitude, longitude, radius_m) VALUES (?, ?, ?, ?)",
+                     (name, latitude, longitude, radius_m))
+    invalidate()
+
+
+def deactivate_site(site_id):
+    with connection() as conn:
+        conn.execute("UPDATE sites SET active = 0 WHERE id = ?", (site_id,))
+    invalidate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="工地（打卡範圍）管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="列出啟用中的工地")
+    add = sub.add_parser("add", help="新增工地")
+    add.add_argument("name")
+    add.add_argument("latitude", type=float)
+    add.add_argument("longitude", type=float)
+    add.add_argument("radius_m", type=float, nargs="?", default=50)
+    remove = sub.add_parser("remove", help="停用工地")
+    remove.add_argument("site_id", type=int)
+    rescore = sub.add_parser("rescore", help="以目前工地設定重新評分歷史定位")
+    rescore.add_argument("start_date")
+    rescore.add_argument("end_date")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        with connection() as conn:
+            for row in load_sites(conn):
+                print("{}\t{}\t{:.6f}, {:.6f}\t{:g} m".format(*row))
+    elif args.command == "add":
+        add_site(args.name, args.latitude, args.longitude, args.radius_m)
+    elif args.command == "remove":
+        deactivate_site(args.site_id)
+    elif args.command == "rescore":
+        started = time.perf_counter()
+        total = 0
+        per_site = Counter()
+        for ids, _, site_ids, _ in score_location_logs(args.start_date, args.end_date):
+            total += len(ids)
+            per_site.update(site_ids.tolist())
+        elapsed = time.perf_counter() - started
+        print(f"共 {total:,} 筆定位，耗時 {elapsed:.2f} s")
+        print(f"範圍外：{per_site.pop(-1, 0):,}")
+        for site_id, count in sorted(per_site.items()):
+            print(f"工地 {site_id}：{count:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import os
+
+# gunicorn 設定（gunicorn -c gunicorn.conf.py app:app）
+# preload：master 先匯入 app（init_db 只在 master 執行一次），worker 由 fork 取得已載入的模組，
+# 不必各自重新匯入 Flask / numpy 等，worker 啟動與重啟幾乎不花時間。
+# 連線池、背景執行緒都以 pid 判斷，fork 後在 worker 內重新建立（見 db_pool.py、app.py 的 start_schedulers）。
+# GUNICORN_PRELOAD=0 時改回每個 worker 各自匯入（例如想用 --reload 開發）。
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+
+
+def post_worker_init(worker):
+    # 每個 worker 載入 app（init_db 已完成）後先載入最近的定位（見 location_cache.warm），第一個打卡請求不必等待
+    import location_cache
+
+    location_cache.warm()
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db_pool import connection
+
+# 綁定資料快取：line_id -> (line_id, 工號, 姓名)、工號 -> (line_id, 姓名)，LRU + TTL。
+# 綁定 / 刪除使用者時在同一個交易內把 meta.users_version 加一，
+# 各 worker 每隔 VERSION_CHECK_INTERVAL 秒讀一次版本號，不同就清空自己的快取。
+# 查無綁定的結果不快取，剛綁定完的使用者不會被擋下。
+CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "300"))
+VERSION_CHECK_INTERVAL = float(os.getenv("IDENTITY_VERSION_CHECK_INTERVAL", "1.0"))
+
+_lock = threading.Lock()
+_by_line_id = OrderedDict()      # line_id -> ((line_id, employee_id, name), cached_at)
+_by_employee_id = OrderedDict()  # employee_id -> ((line_id, name), cached_at)
+_version = None
+_checked_at = 0.0
+_counters = {"hits": 0, "misses": 0, "invalidations": 0, "version_checks": 0}
+
+
+def _get(cache, key):
+    entry = cache.get(key)
+    if entry is None or time.monotonic() - entry[1] >= CACHE_TTL:
+        return None
+    cache.move_to_end(key)
+    return entry[0]
+
+
+def _set(cache, key, value, now):
+    cache[key] = (value, now)
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def put(line_id, employee_id, name):
+    now = time.monotonic()
+    with _lock:
+        _set(_by_line_id, line_id, (line_id, employee_id, name), now)
+        _set(_by_employee_id, employee_id, (line_id, name), now)
+
+
+def _check_version(conn):
+    # 其他 worker 綁定 / 刪除使用者後，最多 VERSION_CHECK_INTERVAL 秒內會清掉本行程的快取
+    global _version, _checked_at
+    if time.monotonic() - _checked_at < VERSION_CHECK_INTERVAL:
+        return
+    row = conn.execute("SELECT value FROM meta WHERE key = 'users_version'").fetchone()
+    version = row[0] if row else 0
+    with _lock:
+        _counters["version_checks"] += 1
+        if version != _version:
+            _by_line_id.clear()
+            _by_employee_id.clear()
+            _version = version
+        _checked_at = time.monotonic()
+
+
+def _lookup(cache, key, conn, query):
+    if conn is None:
+        with connection() as conn:
+            return _lookup(cache, key, conn, query)
+    _check_version(conn)
+    with _lock:
+        value = _get(cache, key)
+        _counters["hits" if value is not None else "misses"] += 1
+    if value is not None:
+        return value
+    row = conn.execute(query, (key,)).fetchone()
+    if row is None:
+        return None
+    put(*row)
+    return (row[0], row[2]) if cache is _by_employee_id else tuple(row)
+
+
+def _peek(cache, key, conn):
+    if conn is not None:
+        _check_version(conn)
+    with _lock:
+        value = _get(cache, key)
+        _counters["hits" if value is not None else "misses"] += 1
+    return value
+
+
+def peek(line_id, conn=None):
+    # 只看快取、不查資料庫（供批次預先載入判斷哪些使用者需要查詢）
+    return _peek(_by_line_id, line_id, conn)
+
+
+def peek_employee(employee_id, conn=None):
+    return _peek(_by_employee_id, employee_id, conn)
+
+
+def get_by_line_id(line_id, conn=None):
+    # 回傳 (line_id, 工號, 姓名)，未綁定時回傳 None
+    return _lookup(_by_line_id, line_id, conn,
+                   "SELECT line_id, employee_id, name FROM users WHERE line_id = ?")
+
+
+def get_by_employee_id(employee_id, conn=None):
+    # 回傳 (line_id, 姓名)，未綁定時回傳 None
+    return _lookup(_by_employee_id, employee_id, conn,
+                   "SELECT line_id, employee_id, name FROM users WHERE employee_id = ?")
+
+
+def invalidate(conn):
+    # 在修改 users 的同一個交易內呼叫：版本號加一讓其他 worker 失效，本行程快取立即清空
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'users_version'")
+    clear()
+
+
+def clear():
+    global _checked_at
+    with _lock:
+        _by_line_id.clear()
+        _by_employee_id.clear()
+        _counters["invalidations"] += 1
+        _checked_at = 0.0
+
+
+def stats():
+    with _lock:
+        size = len(_by_line_id)
+        data = dict(_counters, size=size, version=_version)
+    total = data["hits"] + data["misses"]
+    data.update(hit_ratio=round(data["hits"] / total, 4) if total else 0.0,
+                max_size=CACHE_SIZE, ttl=CACHE_TTL, version_check_interval=VERSION_CHECK_INTERVAL)
+    return data
@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from datetime import datetime
+from multiprocessing import Pool
+
+import location_partitions
+import owntracks
+from db_pool import connection
+from owntracks import PayloadError
+
+# OwnTracks 歷史定位匯入：手機 HTTP 回報中斷多天時，由 OwnTracks Recorder 的 .rec 檔或匯出的 JSON 補回定位，
+# 不必逐點重送 /location/webhook。
+#   .rec：Recorder 的儲存格式，每行「時間\t*\tJSON」，路徑為 rec/<使用者>/<裝置>/YYYY-MM.rec，使用者即工號
+#   JSON：陣列、NDJSON 或 Recorder API 的 {"data": [...]}；工號依序取自 --employee、topic、檔案路徑、username
+# 多個行程平行解析檔案，主行程依檔案順序寫入：工號一次查好，每 BATCH_SIZE 筆一個交易（經 db.insert_locations 分到月份表），
+# 批次之間停頓 BATCH_PAUSE 秒讓 webhook 取得寫入鎖；同工號同 tst 的點（含資料庫中已有的）由月份表的唯一索引略過。
+# migration 8 之前寫入的定位沒有 tst，唯一索引擋不到：這些月份另外以（工號, timestamp）比對，已存在的點略過。
+# 匯入前不存在的月份（本月除外）先不建日期與工號索引，全部寫完再建立，省去逐筆維護索引。
+# 歷史點不經過即時的重複 / 靜止過濾（location_filter），之後由 compaction.py 依保存策略抽稀。
+# 用法：python import_owntracks.py /srv/recorder/store/rec [其他檔案或目錄 ...] [--employee 工號] [--workers 4]
+BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "20000"))
+BATCH_PAUSE = float(os.getenv("IMPORT_BATCH_PAUSE", "0.05"))
+EXTENSIONS = (".rec", ".json", ".jsonl", ".ndjson")
+
+
+def find_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if name.endswith(EXTENSIONS))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def _path_user(path):
+    # rec/<使用者>/<裝置>/YYYY-MM.rec
+    parts = os.path.abspath(path).split(os.sep)
+    return (parts[-3], parts[-2]) if path.endswith(".rec") and len(parts) >= 3 else (None, None)
+
+
+def _items(path, text):
+    if path.endswith(".rec"):
+        for line in text.splitlines():
+            parts = line.split("\t", 2)
+            yield parts[2] if len(parts) == 3 else None
+        return
+    try:
+        items, _ = owntracks.parse_body(text)
+    except PayloadError:
+        # 空檔或整個檔案格式錯誤
+        yield None
+        return
+    if len(items) == 1 and isinstance(items[0], dict) and isinstance(items[0].get("data"), list):
+        items = items[0]["data"]
+    yield from items
+
+
+def parse_file(task):
+    # 在子行程執行：回傳 (路徑, [(工號, 緯度, 經度, tst, timestamp)], 格式錯誤筆數, 略過的非定位訊息數)
+    path, employee = task
+    user, device = _path_user(path)
+    with open(path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    points, invalid, ignored = [], 0, 0
+    for item in _items(path, text):
+        try:
+            if isinstance(item, str):
+                item = json.loads(item)
+            kind = owntracks.message_type(item)
+            if kind is None:
+                raise PayloadError("訊息格式錯誤")
+            if kind != "location":
+                ignored += 1
+                continue
+            if item.get("tst") is None:
+                # 沒有 tst 的點無法得知時間，也無法去除重複
+                raise PayloadError("缺少 tst")
+            # 訊息內的 topic 優先，其次為 .rec 路徑上的使用者、訊息的 username
+            owner = employee or user or item.get("username")
+            point = owntracks.parse_location(item, topic=f"owntracks/{owner}/{device or '-'}" if owner else None)
+            if employee:
+                point = point._replace(employee_id=employee)
+        except (ValueError, PayloadError):
+            invalid += 1
+            continue
+        points.append((point.employee_id, point.latitude, point.longitude, point.tst, point.timestamp))
+    return path, points, invalid, ignored
+
+
+class Importer:
+    def __init__(self, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, defer_indexes=True):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.defer_indexes = defer_indexes
+        self.report = {"files": 0, "parsed": 0, "inserted": 0, "duplicates": 0, "unknown_employee": 0,
+                       "invalid": 0, "ignored": 0, "batches": 0}
+        self.unknown = set()
+        self.deferred = set()
+        self.batch = []
+        with connection() as conn:
+            # 工號一次查好（綁定資料只有員工數筆）
+            self.users = {e: (line_id, name) for e, line_id, name in
+                          conn.execute("SELECT employee_id, line_id, name FROM users").fetchall()}
+            self.existing = set(location_partitions.months(conn))
+            # 有 tst 為 NULL 的舊資料的月份
+            self.legacy = {month for month in self.existing if conn.execute(
+                f"SELECT 1 FROM {location_partitions.table_name(month)} WHERE tst IS NULL LIMIT 1").fetchone()}
+        self.current_month = datetime.now(owntracks.tz).strftime("%Y-%m")
+
+    def add(self, result):
+        _, points, invalid, ignored = result
+        self.report["files"] += 1
+        self.report["parsed"] += len(points)
+        self.report["invalid"] += invalid
+        self.report["ignored"] += ignored
+        for employee_id, latitude, longitude, tst, timestamp in points:
+            user = self.users.get(employee_id)
+            if not user:
+                self.report["unknown_employee"] += 1
+                self.unknown.add(employee_id)
+                continue
+            self.batch.append((user[0], employee_id, user[1], latitude, longitude, timestamp, tst))
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        from db import insert_locations
+
+        if not self.batch:
+            return
+        with connection() as conn:
+            rows = self._skip_legacy(conn, self.batch)
+            if self.defer_indexes:
+                for month in sorted({row[5][:7] for row in self.batch} - self.existing - self.deferred):
+                    if month == self.current_month:
+                        continue
+                    location_partitions.ensure(conn, month)
+                    location_partitions.drop_deferrable_indexes(conn, month)
+                    self.deferred.add(month)
+            # 重複略過的點記在 report["duplicates"]，不算進即時過濾的統計
+            inserted = insert_locations(conn, rows, count_duplicates=False) if rows else 0
+        self.report["inserted"] += inserted
+        self.report["duplicates"] += len(self.batch) - inserted
+        self.report["batches"] += 1
+        self.batch = []
+        if self.pause:
+            time.sleep(self.pause)
+
+    def _skip_legacy(self, conn, rows):
+        # 去掉與舊資料（tst 為 NULL）同工號同 timestamp 的點；舊資料的 timestamp 即由 tst 換算，精確到秒
+        by_month = {}
+        for row in rows:
+            if row[5][:7] in self.legacy:
+                by_month.setdefault(row[5][:7], []).append(row)
+        if not by_month:
+            return rows
+        existing = set()
+        for month, month_rows in by_month.items():
+            employee_ids = sorted({row[1] for row in month_rows})
+            existing.update(conn.execute(f"""
+                SELECT employee_id, timestamp FROM {location_partitions.table_name(month)}
+                WHERE tst IS NULL AND employee_id IN ({','.join('?' * len(employee_ids))})
+                  AND timestamp >= ? AND timestamp <= ?
+            """, (*employee_ids, min(row[5] for row in month_rows), max(row[5] for row in month_rows))).fetchall())
+        return [row for row in rows if (row[1], row[5]) not in existing]
+
+    def finish(self):
+        # 補建延後的索引，每個月份一個交易；匯入中途失敗時也要執行
+        for month in sorted(self.deferred):
+            with connection() as conn:
+                location_partitions.create_indexes(conn, month)
+        self.deferred.clear()
+
+
+def run(paths, employee=None, workers=None, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, defer_indexes=True):
+    # 回傳統計；子行程只負責解析，寫入全部在主行程
+    files = find_files(paths)
+    importer = Importer(batch_size, pause, defer_indexes)
+    workers = workers or os.cpu_count() or 1
+    try:
+        with Pool(workers) as pool:
+            # 最多同時解析 workers × 2 個檔案，寫入較慢時不會把全部結果堆在記憶體裡
+            pending = deque()
+            for path in files:
+                pending.append(pool.apply_async(parse_file, ((path, employee),)))
+                if len(pending) >= workers * 2:
+                    importer.add(pending.popleft().get())
+            while pending:
+                importer.add(pending.popleft().get())
+        importer.flush()
+    finally:
+        importer.finish()
+    report = dict(importer.report, unknown_employees=sorted(importer.unknown))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="匯入 OwnTracks Recorder 的 .rec 檔或 JSON 匯出")
+    parser.add_argument("paths", nargs="+", help="檔案或目錄（目錄會遞迴尋找 .rec / .json / .jsonl / .ndjson）")
+    parser.add_argument("--employee", help="全部視為此工號（單一員工的匯出檔沒有 topic 時使用）")
+    parser.add_argument("--workers", type=int, default=None, help="解析行程數（預設為 CPU 數）")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="每個交易寫入筆數")
+    parser.add_argument("--pause", type=float, default=BATCH_PAUSE, help="批次之間停頓秒數")
+    parser.add_argument("--no-defer-indexes", action="store_true", help="新月份表也一開始就建立全部索引")
+    args = parser.parse_args()
+
+    from db import init_db
+    init_db()
+    started = time.perf_counter()
+    report = run(args.paths, args.employee, args.workers, args.batch_size, args.pause, not args.no_defer_indexes)
+    elapsed = time.perf_counter() - started
+    print(f"✅ {report['files']:,} 個檔案、解析 {report['parsed']:,} 筆，寫入 {report['inserted']:,} 筆"
+          f"（{report['batches']:,} 批），耗時 {elapsed:.1f} s，{report['parsed'] / elapsed if elapsed else 0:,.0f} 筆/秒")
+    print(f"重複略過 {report['duplicates']:,}、未綁定工號 {report['unknown_employee']:,}、"
+          f"格式錯誤 {report['invalid']:,}、非定位訊息 {report['ignored']:,}")
+    if report["unknown_employees"]:
+        print(f"⚠️ 未綁定的工號：{', '.join(report['unknown_employees'][:20])}"
+              + (" …" if len(report["unknown_employees"]) > 20 else ""))
+
+
+if __name__ == "__main__":
+    main()
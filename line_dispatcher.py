@@ -0,0 +1,222 @@
+import atexit
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from applog import log
+
+# LINE_API_BASE 可指向本機 stub（見 benchmarks/line_stub.py）
+LINE_API_BASE = os.getenv("LINE_API_BASE", "https://api.line.me")
+# 發送模式：async（背景執行緒發送，webhook 立即回應）/ sync（在請求內直接發送）
+DISPATCH_MODE = os.getenv("LINE_DISPATCH_MODE", "async")
+WORKERS = int(os.getenv("LINE_DISPATCH_WORKERS", "4"))
+MAX_RETRIES = int(os.getenv("LINE_MAX_RETRIES", "5"))
+BACKOFF_BASE = float(os.getenv("LINE_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("LINE_BACKOFF_MAX", "30"))
+REQUEST_TIMEOUT = float(os.getenv("LINE_REQUEST_TIMEOUT", "10"))
+
+# Push API 單次最多 5 則訊息
+MAX_MESSAGES_PER_PUSH = 5
+
+
+class LineDispatcher:
+    def __init__(self, workers=WORKERS, mode=DISPATCH_MODE):
+        self.workers = workers
+        self.mode = mode
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._pending = OrderedDict()  # line_id -> deque(messages)
+        self._ready = deque()          # 等待發送的 line_id（依先來後到）
+        self._busy = set()             # 正在發送中的 line_id，確保同一使用者的訊息依序送出
+        self._threads = []
+        self._stopping = False
+        self._pid = None
+        self._session = None
+        # 計數器由多個發送執行緒與請求執行緒同時更新，另用一把鎖保護
+        self._counters_lock = threading.Lock()
+        self._counters = {
+            "messages": 0,
+            "pushes": 0,
+            "sent_messages": 0,
+            "retries": 0,
+            "failed_pushes": 0,
+            "failed_messages": 0,
+        }
+
+    def _ensure_started(self):
+        # fork 後重新建立 Session 與背景執行緒
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pending.clear()
+            self._ready.clear()
+            self._busy.clear()
+            self._stopping = False
+            self._session = self._new_session()
+            self._threads = []
+            if self.mode == "async":
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._run, name=f"line-dispatcher-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.workers, 1))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @contextmanager
+    def collect(self):
+        # 在 with 區塊內產生的訊息先暫存，離開時依使用者合併送出
+        if getattr(self._local, "buffer", None) is not None:
+            yield
+            return
+        self._local.buffer = OrderedDict()
+        try:
+            yield
+        finally:
+            buffer, self._local.buffer = self._local.buffer, None
+            for line_id, messages in buffer.items():
+                self._enqueue(line_id, messages)
+
+    @contextmanager
+    def capture(self):
+        # 與 collect 相同，但離開時不送出；呼叫端確認資料已寫入後再以 flush(buffer) 送出
+        previous = getattr(self._local, "buffer", None)
+        self._local.buffer = buffer = OrderedDict()
+        try:
+            yield buffer
+        finally:
+            self._local.buffer = previous
+
+    def flush(self, buffer):
+        for line_id, messages in buffer.items():
+            self._enqueue(line_id, messages)
+
+    def send(self, line_id, messages):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is not None:
+            buffer.setdefault(line_id, []).extend(messages)
+            return
+        self._enqueue(line_id, messages)
+
+    def _enqueue(self, line_id, messages):
+        self._ensure_started()
+        self._count(messages=len(messages))
+        if self.mode != "async":
+            for i in range(0, len(messages), MAX_MESSAGES_PER_PUSH):
+                self._push(line_id, messages[i:i + MAX_MESSAGES_PER_PUSH])
+            return
+        with self._cond:
+            self._pending.setdefault(line_id, deque()).extend(messages)
+            if line_id not in self._busy and line_id not in self._ready:
+                self._ready.append(line_id)
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopping:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                line_id = self._ready.popleft()
+                pending = self._pending[line_id]
+                batch = [pending.popleft() for _ in range(min(len(pending), MAX_MESSAGES_PER_PUSH))]
+                if not pending:
+                    del self._pending[line_id]
+                self._busy.add(line_id)
+            try:
+                self._push(line_id, batch)
+            finally:
+                with self._cond:
+                    self._busy.discard(line_id)
+                    if line_id in self._pending:
+                        self._ready.append(line_id)
+                        self._cond.notify()
+
+    def _push(self, line_id, messages):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {os.getenv('LINE_CHANNEL_ACCESS_TOKEN')}",
+            # 同一個 retry key 重送時 LINE 不會重複發送
+            "X-Line-Retry-Key": str(uuid.uuid4()),
+        }
+        body = {"to": line_id, "messages": messages}
+        url = f"{LINE_API_BASE}/v2/bot/message/push"
+        for attempt in range(MAX_RETRIES + 1):
+            retry_after = None
+            started = time.perf_counter()
+            try:
+                resp = self._session.post(url, headers=headers, json=body, timeout=REQUEST_TIMEOUT)
+                metrics.LINE_LATENCY.observe(time.perf_counter() - started, "push", str(resp.status_code))
+                if resp.status_code < 400 or resp.status_code == 409:
+                    # 409：相同 retry key 已被接受過
+                    self._count(pushes=1, sent_messages=len(messages))
+                    return True
+                metrics.LINE_ERRORS.inc("push", str(resp.status_code))
+                if resp.status_code != 429 and resp.status_code < 500:
+                    log("line.push_failed", "error", status=resp.status_code, body=resp.text[:200])
+                    break
+                log("line.push_retry", "warning", sampled=True, status=resp.status_code, attempt=attempt)
+                retry_after = resp.headers.get("Retry-After")
+            except requests.RequestException as e:
+                metrics.LINE_LATENCY.observe(time.perf_counter() - started, "push", "exception")
+                metrics.LINE_ERRORS.inc("push", type(e).__name__)
+                log("line.push_connection_error", "warning", attempt=attempt, error=str(e))
+            if attempt == MAX_RETRIES:
+                break
+            self._count(retries=1)
+            time.sleep(self._backoff(attempt, retry_after))
+        self._count(failed_pushes=1, failed_messages=len(messages))
+        return False
+
+    def _count(self, **deltas):
+        with self._counters_lock:
+            for key, delta in deltas.items():
+                self._counters[key] += delta
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX)
+        delay = min(BACKOFF_BASE * (2 ** attempt), BACKOFF_MAX)
+        return delay * random.uniform(0.5, 1.0)
+
+    def stop(self, timeout=10):
+        # 關閉前把佇列內的訊息送完
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self._counters)
+        stats["mode"] = self.mode
+        with self._cond:
+            stats["queued_messages"] = sum(len(m) for m in self._pending.values())
+            stats["queued_users"] = len(self._pending)
+        # 因合併而省下的 push 次數
+        stats["coalesced"] = stats["sent_messages"] - stats["pushes"]
+        return stats
+
+
+dispatcher = LineDispatcher()
+atexit.register(dispatcher.stop)
@@ -1,127 +1,188 @@
 import json
-import sqlite3
-from datetime import datetime, timedelta
 import os
-import requests
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import pytz
-from math import radians, sin, cos, sqrt, atan2
-import qrcode
-from io import BytesIO
+from db_pool import connection, savepoint
+from line_dispatcher import dispatcher
+import attendance
+import geofence
+import identity_cache
+import location_cache
+import qr_cache
+from applog import log
 
-DB_PATH = 'checkin.db'
-LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 tz = pytz.timezone("Asia/Taipei")
+# 已處理的 webhookEventId 保留時數（LINE 重送只會在這段時間內發生），每隔 PRUNE_INTERVAL 秒清除一次過期的
+EVENT_RETENTION_HOURS = float(os.getenv("LINE_EVENT_RETENTION_HOURS", "72"))
+EVENT_PRUNE_INTERVAL = 3600
+CHECKIN_WORDS = ["上班", "下班", "Đi làm", "Tan làm"]
 
-ALLOWED_LOCATIONS = [
-    (25.0478, 121.5319),
-]
-
-def is_within_allowed_location(lat, lng, radius_km=0.05):
-    for allowed_lat, allowed_lng in ALLOWED_LOCATIONS:
-        dlat = radians(lat - allowed_lat)
-        dlng = radians(lng - allowed_lng)
-        a = sin(dlat/2)**2 + cos(radians(lat)) * cos(radians(allowed_lat)) * sin(dlng/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-        distance = 6371 * c
-        if distance <= radius_km:
-            return True
-    return False
+_pruned_at = 0.0
 
 def reply_message(line_id, text):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"
-    }
-    body = {
-        "to": line_id,
-        "messages": [{"type": "text", "text": text}]
-    }
-    requests.post("https://api.line.me/v2/bot/message/push", headers=headers, json=body)
+    dispatcher.send(line_id, [{"type": "text", "text": text}])
 
 def push_image(line_id, image_url):
-    headers = {
-        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    body = {
-        "to": line_id,
-        "messages": [{
-            "type": "image",
-            "originalContentUrl": image_url,
-            "previewImageUrl": image_url
-        }]
-    }
-    requests.post("https://api.line.me/v2/bot/message/push", headers=headers, json=body)
-
-def generate_android_qr_image(employee_id):
-    config = {
-        "_type": "configuration",
-        "desc": f"YLS 打卡設定 - 工號 {employee_id}",
-        "url": "https://yls-checkin-bot.onrender.com/location/webhook",
-        "ident": employee_id,
-        "trackerId": "ot",
-        "secret": False
-    }
-    buffer = BytesIO()
-    qrcode.make(json.dumps(config)).save(buffer, format="PNG")
-    buffer.seek(0)
-    return buffer
-
-def save_qr_image(buffer, filename):
-    path = f"static/qr/{filename}"
-    with open(path, "wb") as f:
-        f.write(buffer.getvalue())
+    dispatcher.send(line_id, [{
+        "type": "image",
+        "originalContentUrl": image_url,
+        "previewImageUrl": image_url
+    }])
 
 def handle_event(body):
+    # 回傳處理失敗的事件數；失敗的事件已撤銷登記，呼叫端回非 200 讓 LINE 重送即可重新處理
     data = json.loads(body)
-    events = data.get("events", [])
+    events = [event for event in data.get("events", []) if (event.get("source") or {}).get("userId")]
+    if not events:
+        return 0
+
+    # 整批共用一條連線與一個交易，一次查詢載入快取沒有的使用者的綁定與暫存狀態，結束時一起提交
+    failed = 0
+    buffers = []
+    with connection() as conn:
+        events = claim_events(conn, events)
+        # 依使用者分組：同一使用者的事件依序處理
+        by_user = OrderedDict()
+        for event in events:
+            by_user.setdefault(event["source"]["userId"], []).append(event)
+        if not by_user:
+            return 0
+        missing = [line_id for line_id in by_user if identity_cache.peek(line_id, conn) is None]
+        preloaded = load_users_and_states(conn, missing) if missing else {}
+
+        for line_id, user_events in by_user.items():
+            # 每位使用者的事件包在一個儲存點內：任一事件失敗就回復這位使用者的全部寫入並丟棄回覆，
+            # 其他使用者照常提交；後面的事件也不再處理，重送時才能依原本的順序重來
+            with dispatcher.capture() as buffer:
+                try:
+                    with savepoint(conn, "line_user"):
+                        for i, event in enumerate(user_events):
+                            # 只有第一個事件能用預先載入的資料，之後的事件可能已改變狀態
+                            dispatch_event(conn, line_id, event, preloaded.get(line_id) if i == 0 else None)
+                except Exception as e:
+                    log("line.event_error", "error", line_id=line_id, events=len(user_events), error=str(e))
+                    release_events(conn, user_events)
+                    failed += len(user_events)
+                    continue
+            buffers.append(buffer)
+
+    # 資料提交後才送出回覆，同一使用者的訊息合併成一次 push
+    for buffer in buffers:
+        dispatcher.flush(buffer)
+    return failed
+
+def claim_events(conn, events):
+    # LINE 重送（或同一事件送到兩個 worker）時以 webhookEventId 去重：事件 ID 與處理結果在同一個交易內寫入，
+    # 以一次 INSERT ... ON CONFLICT DO NOTHING RETURNING 登記整批 ID，已登記過的事件直接略過；沒有 ID 的事件照常處理
+    ids = [event["webhookEventId"] for event in events if event.get("webhookEventId")]
+    if not ids:
+        return events
+    now = datetime.now(tz)
+    received_at = now.strftime("%Y-%m-%d %H:%M:%S")
+    claimed = {row[0] for row in conn.execute(f"""
+        INSERT INTO line_events (event_id, received_at) VALUES {", ".join("(?, ?)" for _ in ids)}
+        ON CONFLICT DO NOTHING RETURNING event_id
+    """, [value for event_id in ids for value in (event_id, received_at)]).fetchall()}
+    fresh = []
     for event in events:
-        if event.get("type") == "message":
-            line_id = event["source"]["userId"]
-            msg = event["message"]["text"].strip()
-            process_message(line_id, msg)
+        event_id = event.get("webhookEventId")
+        if not event_id:
+            fresh.append(event)
+        elif event_id in claimed:
+            # 同一批內重複的 ID 只處理第一個
+            claimed.discard(event_id)
+            fresh.append(event)
+    if len(fresh) < len(events):
+        log("line.duplicate_events", "warning", count=len(events) - len(fresh))
+    _prune_events(conn, now)
+    return fresh
+
+def release_events(conn, events):
+    # 撤銷處理失敗的事件登記，LINE 重送時才不會被當成已處理而略過
+    ids = [event["webhookEventId"] for event in events if event.get("webhookEventId")]
+    if ids:
+        conn.execute(f"DELETE FROM line_events WHERE event_id IN ({','.join('?' * len(ids))})", ids)
+
+def _prune_events(conn, now):
+    global _pruned_at
+    if time.monotonic() - _pruned_at < EVENT_PRUNE_INTERVAL:
+        return
+    _pruned_at = time.monotonic()
+    cutoff = (now - timedelta(hours=EVENT_RETENTION_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("DELETE FROM line_events WHERE received_at < ?", (cutoff,))
+
+def load_users_and_states(conn, line_ids):
+    # 回傳 {line_id: (使用者, 暫存狀態)}，欄位同 _process_message 內的查詢
+    values = ", ".join("(?)" for _ in line_ids)
+    cursor = conn.execute(f"""
+        WITH ids(line_id) AS (VALUES {values})
+        SELECT ids.line_id, u.line_id, u.employee_id, u.name,
+               s.line_id, s.state, s.temp_employee_id, s.last_updated
+        FROM ids
+        LEFT JOIN users u ON u.line_id = ids.line_id
+        LEFT JOIN user_states s ON s.line_id = ids.line_id
+    """, line_ids)
+    preloaded = {}
+    for row in cursor.fetchall():
+        user = row[1:4] if row[1] is not None else None
+        state = row[4:8] if row[4] is not None else None
+        if user:
+            identity_cache.put(*user)
+        preloaded[row[0]] = (user, state)
+    return preloaded
+
+def dispatch_event(conn, line_id, event, preloaded=None):
+    # 依事件類型分派；目前只處理文字訊息，貼圖、圖片、follow 等事件略過
+    if event.get("type") != "message":
+        return
+    message = event.get("message") or {}
+    if message.get("type") != "text":
+        return
+    _process_message(conn, line_id, message.get("text", "").strip(), preloaded)
 
 def process_message(line_id, msg):
+    with connection() as conn:
+        _process_message(conn, line_id, msg)
+
+def _process_message(conn, line_id, msg, preloaded=None):
+    # 不自行 commit：由呼叫端的 connection() 提交（handle_event 另以儲存點包住每位使用者的事件）
     now = datetime.now(tz)
     now_str = now.strftime("%Y-%m-%d %H:%M")
     now_sql = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM users WHERE line_id=?", (line_id,))
-    user = cursor.fetchone()
-    cursor.execute("SELECT * FROM user_states WHERE line_id=?", (line_id,))
-    state = cursor.fetchone()
+    if preloaded:
+        user, state = preloaded
+    else:
+        # 綁定資料走快取；暫存狀態只在綁定流程與補打卡確認時才需要
+        user = identity_cache.get_by_line_id(line_id, conn)
+        state = None
+        if not user or msg in ["確認", "Xác nhận"]:
+            cursor.execute("SELECT line_id, state, temp_employee_id, last_updated FROM user_states WHERE line_id=?", (line_id,))
+            state = cursor.fetchone()
 
     # 教學選項處理 (綁定成功後)
     if msg.lower() == "ios" or msg == "教程":
         push_image(line_id, "https://yls-checkin-bot.onrender.com/static/tutorial/owntracks_ios.png")
         reply_message(line_id, "📄 圖文說明已送出，請依照指示設定 OwnTracks。\nĐã gửi hướng dẫn bằng hình ảnh, vui lòng làm theo.")
-        conn.close()
         return
 
     if msg.lower() == "android":
-        cursor.execute("SELECT employee_id FROM users WHERE line_id=?", (line_id,))
-        row = cursor.fetchone()
-        if row:
-            employee_id = row[0]
-            filename = f"{employee_id}.png"
-            buffer = generate_android_qr_image(employee_id)
-            save_qr_image(buffer, filename)
-            url = f"https://yls-checkin-bot.onrender.com/static/qr/{filename}"
-            push_image(line_id, url)
+        if user:
+            # 圖檔已在綁定時預先產生，這裡通常只需檢查檔案是否存在
+            push_image(line_id, qr_cache.url_for_employee(user[1]))
             reply_message(line_id, "✅ 請打開 OwnTracks 並掃描 QR Code 完成設定。\nVui lòng mở OwnTracks và quét mã QR bên trên.")
-        conn.close()
         return
 
     # 未綁定處理
     if not user:
-        if msg in ["上班", "下班", "Đi làm", "Tan làm"]:
+        if msg in CHECKIN_WORDS:
             reply_message(line_id, "請先綁定帳號再打卡。\nVui lòng liên kết tài khoản trước khi chấm công.")
         elif not state:
             cursor.execute("INSERT INTO user_states VALUES (?, ?, ?, ?)", (line_id, "awaiting_employee_id", None, now_sql))
-            conn.commit()
             reply_message(line_id, "請輸入您的工號：\nVui lòng nhập mã số nhân viên của bạn:")
         elif state[1] == "awaiting_employee_id":
             if not msg.isdigit() or not (2 <= len(msg) <= 3):
@@ -132,74 +193,74 @@ def process_message(line_id, msg):
                     reply_message(line_id, "此工號已被其他人使用，請重新輸入。\nMã số đã tồn tại, vui lòng nhập lại.")
                 else:
                     cursor.execute("UPDATE user_states SET state='awaiting_name', temp_employee_id=?, last_updated=? WHERE line_id=?", (msg, now_sql, line_id))
-                    conn.commit()
                     reply_message(line_id, "請輸入您的姓名：\nVui lòng nhập họ tên của bạn:")
         elif state[1] == "awaiting_name":
             temp_name = msg
             temp_id = state[2]
-            cursor.execute("INSERT INTO users VALUES (?, ?, ?, ?)", (line_id, temp_id, temp_name, now_sql))
+            cursor.execute("INSERT INTO users (line_id, employee_id, name, bind_time) VALUES (?, ?, ?, ?)", (line_id, temp_id, temp_name, now_sql))
             cursor.execute("DELETE FROM user_states WHERE line_id=?", (line_id,))
-            conn.commit()
+            identity_cache.invalidate(conn)
+            qr_cache.prefetch(temp_id)
             reply_message(line_id, f"綁定成功！{temp_name} ({temp_id})\nLiên kết thành công!")
             reply_message(line_id, "請問您使用的是哪一種手機？\nBạn đang sử dụng điện thoại nào？\n\n輸入 iOS → 查看圖文教學\nNhập iOS → Xem hướng dẫn\n\n輸入 Android → 取得 QR 自動設定\nNhập Android → Lấy mã QR để cấu hình tự động")
-        conn.close()
         return
 
     # 打卡相關邏輯開始
-    cursor.execute('''SELECT check_type, timestamp FROM checkins
-                      WHERE employee_id=? AND DATE(timestamp)=?
-                      ORDER BY timestamp''', (user[1], now.strftime("%Y-%m-%d")))
-    records = cursor.fetchall()
-
-    # 定位僅限打卡時檢查
-    if msg in ["上班", "下班", "Đi làm", "Tan làm"]:
-        cursor.execute("SELECT latitude, longitude FROM location_logs WHERE line_id=? ORDER BY timestamp DESC LIMIT 1", (line_id,))
-        last_location = cursor.fetchone()
-        if not last_location:
-            reply_message(line_id, "📍 找不到您的定位資料，請開啟 GPS 並確認 OwnTracks 已設定成功。\nKhông tìm thấy vị trí, vui lòng bật GPS và kiểm tra cấu hình OwnTracks.")
-            conn.close()
-            return
-        if not is_within_allowed_location(*last_location):
-            reply_message(line_id, "📍 你不在允許的打卡範圍內，無法打卡。\nBạn không ở khu vực cho phép.")
-            conn.close()
-            return
+    today = now.strftime("%Y-%m-%d")
+
+    # 定位僅限打卡時檢查，比對到的工地與距離一併寫入打卡紀錄
+    fix = (None, None, None, None)
+    if msg in CHECKIN_WORDS:
+        last_location = location_cache.get_latest(line_id)
+        site, distance = None, None
+        if last_location and location_cache.is_fresh(last_location[2], now):
+            site, distance = geofence.match(last_location[0], last_location[1])
+        if not site:
+            # LRU 可能還是其他 worker 剛寫入新定位之前的值：拒絕打卡前略過 LRU 再查一次資料庫
+            last_location = location_cache.get_latest(line_id, refresh=True)
+            if not last_location:
+                reply_message(line_id, "📍 找不到您的定位資料，請開啟 GPS 並確認 OwnTracks 已設定成功。\nKhông tìm thấy vị trí, vui lòng bật GPS và kiểm tra cấu hình OwnTracks.")
+                return
+            if not location_cache.is_fresh(last_location[2], now):
+                reply_message(line_id, "📍 您的定位資料已過舊，請確認 GPS 與 OwnTracks 正常運作後再打卡。\nVị trí đã cũ, vui lòng kiểm tra GPS và OwnTracks rồi thử lại.")
+                return
+            site, distance = geofence.match(last_location[0], last_location[1])
+            if not site:
+                reply_message(line_id, "📍 你不在允許的打卡範圍內，無法打卡。\nBạn không ở khu vực cho phép.")
+                return
+        fix = (last_location[0], last_location[1], distance, site["id"])
 
     def insert_checkin(t, result):
-        cursor.execute('''INSERT INTO checkins (employee_id, name, check_type, timestamp, result)
-                          VALUES (?, ?, ?, ?, ?)''', (user[1], user[2], t, now_sql, result))
-        conn.commit()
+        # 打卡紀錄與每日出勤彙總在同一個交易內寫入；當天已有同類打卡時由唯一索引擋下，回傳 False
+        return attendance.record_checkin(conn, user[1], user[2], t, now_sql, result, *fix)
 
     if msg in ["上班", "Đi làm"]:
-        if any(r[0] == "上班" for r in records):
-            reply_message(line_id, f"{user[2]}，你今天已打過上班卡。\n{user[2]}, bạn đã chấm công đi làm hôm nay.")
-        else:
-            insert_checkin("上班", "正常")
+        # 不先讀取當天紀錄，直接寫入，是否已打過卡由寫入結果判斷（重複點擊、兩個 worker 同時處理也只會有一筆）
+        if insert_checkin("上班", "正常"):
             reply_message(line_id, f"{user[2]}，上班打卡成功！\n🔴 時間：{now_str}")
+        else:
+            reply_message(line_id, f"{user[2]}，你今天已打過上班卡。\n{user[2]}, bạn đã chấm công đi làm hôm nay.")
     elif msg in ["下班", "Tan làm"]:
-        if not any(r[0] == "上班" for r in records):
+        # 下班的結果要看上班時間，只讀當天彙總一列；重複下班同樣由寫入結果判斷
+        daily = attendance.get_daily(conn, user[1], today)
+        first_in = daily[0] if daily else None
+        if not first_in:
             cursor.execute("UPDATE user_states SET state='awaiting_confirm_forgot_checkin', last_updated=? WHERE line_id=?", (now_sql, line_id))
-            conn.commit()
             reply_message(line_id, "查無上班紀錄，是否忘記打卡？輸入「確認」補打卡。\nKhông thấy chấm công đi làm, nhập '確認' để xác nhận bổ sung.")
-        elif any(r[0] == "下班" for r in records):
-            reply_message(line_id, f"{user[2]}，你今天已打過下班卡。\n{user[2]}, bạn đã chấm công tan làm.")
-        else:
-            start_time = [datetime.strptime(r[1], "%Y-%m-%d %H:%M:%S") for r in records if r[0] == "上班"][0]
-            start_time = tz.localize(start_time)
-            if now - start_time > timedelta(hours=14):
-                insert_checkin("下班", "可能忘記打卡")
-            else:
-                insert_checkin("下班", "正常")
+            return
+        start_time = tz.localize(datetime.strptime(first_in, "%Y-%m-%d %H:%M:%S"))
+        result = "可能忘記打卡" if now - start_time > timedelta(hours=14) else "正常"
+        if insert_checkin("下班", result):
             reply_message(line_id, f"{user[2]}，下班打卡成功！\n🔴 時間：{now_str}")
+        else:
+            reply_message(line_id, f"{user[2]}，你今天已打過下班卡。\n{user[2]}, bạn đã chấm công tan làm.")
     elif msg in ["確認", "Xác nhận"]:
         if state and state[1] == "awaiting_confirm_forgot_checkin":
             insert_checkin("上班", "忘記打卡")
             insert_checkin("下班", "補打卡")
             cursor.execute("DELETE FROM user_states WHERE line_id=?", (line_id,))
-            conn.commit()
             reply_message(line_id, f"{user[2]}，補打上下班卡完成。\n{user[2]}, đã xác nhận và bổ sung chấm công.")
         else:
             reply_message(line_id, "目前無補卡需求。\nKhông có yêu cầu xác nhận.")
     else:
         reply_message(line_id, "請輸入「上班」或「下班」進行打卡。\nVui lòng nhập 'Đi làm' hoặc 'Tan làm' để chấm công.")
-
-    conn.close()
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pytz
+
+import db_pool
+from db_pool import connection
+
+tz = pytz.timezone("Asia/Taipei")
+
+# 超過此分鐘數的定位視為過舊，打卡時不採用（0 表示不檢查）
+MAX_AGE_MINUTES = int(os.getenv("LOCATION_MAX_AGE_MINUTES", "30"))
+# 每個行程前面放一層 LRU（worker 啟動時由 warm() 載入）；本行程的寫入提交後立即更新，
+# 其他 worker 寫入的新定位最多延遲 LRU_TTL 秒才會看到。打卡被拒前會略過 LRU 重查（get_latest(refresh=True)），
+# 延遲只會讓打卡採用稍舊但仍在 MAX_AGE_MINUTES 內的定位
+LRU_SIZE = int(os.getenv("LATEST_LOCATION_LRU_SIZE", "5000"))
+LRU_TTL = float(os.getenv("LATEST_LOCATION_LRU_TTL", "300"))
+
+_lock = threading.Lock()
+_lru = OrderedDict()  # line_id -> (latitude, longitude, timestamp, cached_at)
+_counters = {"hits": 0, "misses": 0}
+
+
+def upsert_latest(conn, rows):
+    # rows 格式同 db.insert_locations；每個 line_id 只保留這批中最新的一筆，且不會被較舊的定位覆蓋
+    latest = {}
+    for line_id, employee_id, _, latitude, longitude, timestamp, *_ in rows:
+        if line_id not in latest or timestamp >= latest[line_id][4]:
+            latest[line_id] = (line_id, employee_id, latitude, longitude, timestamp)
+    conn.executemany("""
+        INSERT INTO latest_location (line_id, employee_id, latitude, longitude, timestamp)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(line_id) DO UPDATE SET
+            employee_id = excluded.employee_id,
+            latitude = excluded.latitude,
+            longitude = excluded.longitude,
+            timestamp = excluded.timestamp
+        WHERE excluded.timestamp >= latest_location.timestamp
+    """, list(latest.values()))
+    # 交易提交後才放進 LRU：rollback 的定位不可被打卡採用
+    db_pool.after_commit(lambda: _remember(latest.values()))
+
+
+def _remember(rows):
+    now = time.monotonic()
+    with _lock:
+        for line_id, _, latitude, longitude, timestamp in rows:
+            cached = _lru.get(line_id)
+            if cached is None or timestamp >= cached[2]:
+                _put(line_id, (latitude, longitude, timestamp, now))
+
+
+def _put(line_id, value):
+    _lru[line_id] = value
+    _lru.move_to_end(line_id)
+    while len(_lru) > LRU_SIZE:
+        _lru.popitem(last=False)
+
+
+def warm():
+    # worker 啟動時把最近更新的定位載入 LRU（gunicorn.conf.py 的 post_fork），第一次打卡不必等待；
+    # 依 idx_latest_location_timestamp 只讀最新的 LRU_SIZE 筆
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT line_id, latitude, longitude, timestamp FROM latest_location
+            ORDER BY timestamp DESC LIMIT ?
+        """, (LRU_SIZE,)).fetchall()
+    now = time.monotonic()
+    with _lock:
+        _lru.clear()
+        for line_id, latitude, longitude, timestamp in reversed(rows):
+            _put(line_id, (latitude, longitude, timestamp, now))
+
+
+def get_latest(line_id, refresh=False):
+    # 回傳 (latitude, longitude, timestamp)，查無定位時回傳 None；refresh=True 時略過 LRU 直接查資料庫
+    with _lock:
+        cached = None if refresh else _lru.get(line_id)
+        if cached is not None and time.monotonic() - cached[3] < LRU_TTL:
+            _lru.move_to_end(line_id)
+            _counters["hits"] += 1
+            return cached[:3]
+    _counters["misses"] += 1
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT latitude, longitude, timestamp FROM latest_location WHERE line_id = ?", (line_id,)
+        ).fetchone()
+    if row:
+        with _lock:
+            _put(line_id, (*row, time.monotonic()))
+    return row
+
+
+def is_fresh(timestamp, now=None):
+    if not MAX_AGE_MINUTES:
+        return True
+    now = now or datetime.now(tz)
+    fixed_at = tz.localize(datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S"))
+    return now - fixed_at <= timedelta(minutes=MAX_AGE_MINUTES)
+
+
+def clear():
+    with _lock:
+        _lru.clear()
+
+
+def stats():
+    with _lock:
+        size = len(_lru)
+    return dict(_counters, size=size, max_size=LRU_SIZE, ttl=LRU_TTL, max_age_minutes=MAX_AGE_MINUTES)
@@ -0,0 +1,89 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+
+# 定位過濾：寫入前依員工丟棄重送與靜止的點
+#   重複：同一員工同一個 tst（OwnTracks 重新連線後常會重送），記憶體內比對最近的 tst，
+#         資料庫另有 (employee_id, tst) 唯一索引兜底（多個 worker 之間）
+#   靜止：距離上一個收下的點不到 MIN_MOVE_M 公尺且間隔不到 MIN_INTERVAL_SECONDS 秒就丟棄；
+#         超過間隔（例如斷線一段時間後）的第一個點一律收下，最新定位最多延遲 MIN_INTERVAL_SECONDS 秒
+DEDUP_ENABLED = os.getenv("LOCATION_DEDUP", "1") != "0"
+MIN_MOVE_M = float(os.getenv("LOCATION_MIN_MOVE_M", "20"))
+MIN_INTERVAL_SECONDS = float(os.getenv("LOCATION_MIN_INTERVAL_SECONDS", "300"))
+# 每位員工記住最近幾個收下的 tst；更早的重送由資料庫唯一索引擋下
+RECENT_TST = int(os.getenv("LOCATION_RECENT_TST", "64"))
+
+EARTH_RADIUS_M = 6371000.0
+
+_lock = threading.Lock()
+_state = {}  # employee_id -> [上一個收下的 tst, 緯度, 經度, 最近的 tst（deque）, 最近的 tst（set）]
+_counters = {"accepted": 0, "dropped_duplicate": 0, "dropped_stationary": 0, "dropped_duplicate_db": 0}
+
+
+def _distance_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def check(employee_id, tst, latitude, longitude):
+    # 回傳丟棄原因（"duplicate" / "stationary"），收下時回傳 None；tst 為 None 時以目前時間判斷靜止
+    now = tst if tst is not None else time.time()
+    with _lock:
+        if not DEDUP_ENABLED:
+            _counters["accepted"] += 1
+            return None
+        state = _state.get(employee_id)
+        if state is None:
+            state = _state[employee_id] = [None, None, None, deque(maxlen=RECENT_TST), set()]
+        last_tst, last_lat, last_lng, recent, seen = state
+        if tst is not None and tst in seen:
+            _counters["dropped_duplicate"] += 1
+            return "duplicate"
+        # 比上一個收下的點更早的點是補傳的歷史資料，不做靜止判斷
+        if (last_tst is not None and last_tst <= now < last_tst + MIN_INTERVAL_SECONDS
+                and _distance_m(last_lat, last_lng, latitude, longitude) < MIN_MOVE_M):
+            _counters["dropped_stationary"] += 1
+            return "stationary"
+        if tst is not None:
+            if len(recent) == recent.maxlen:
+                seen.discard(recent[0])
+            recent.append(tst)
+            seen.add(tst)
+        if last_tst is None or now >= last_tst:
+            state[0], state[1], state[2] = now, latitude, longitude
+        _counters["accepted"] += 1
+        return None
+
+
+def forget(employee_id, tst):
+    # 點最後沒有寫入（佇列已滿、寫入失敗）時呼叫，讓用戶端重送的同一個 tst 不會被當成重複或靜止
+    with _lock:
+        state = _state.get(employee_id)
+        if state is not None:
+            if tst is not None:
+                state[4].discard(tst)
+            state[0] = state[1] = state[2] = None
+
+
+def count_db_duplicates(count):
+    # 記憶體沒擋下、被資料庫唯一索引忽略的筆數（例如另一個 worker 已寫入）
+    if count:
+        with _lock:
+            _counters["dropped_duplicate_db"] += count
+
+
+def clear():
+    with _lock:
+        _state.clear()
+
+
+def stats():
+    with _lock:
+        employees = len(_state)
+    dropped = _counters["dropped_duplicate"] + _counters["dropped_stationary"] + _counters["dropped_duplicate_db"]
+    total = _counters["accepted"] + _counters["dropped_duplicate"] + _counters["dropped_stationary"]
+    return dict(_counters, employees=employees, drop_ratio=round(dropped / total, 4) if total else 0.0,
+                enabled=DEDUP_ENABLED, min_move_m=MIN_MOVE_M, min_interval_seconds=MIN_INTERVAL_SECONDS)
@@ -0,0 +1,77 @@
+from db import insert_locations
+from db_pool import connection
+import identity_cache
+from location_writer import writer, QueueFull, INGEST_MODE
+import location_filter
+
+# 定位寫入流程（HTTP webhook 與其他來源共用）：
+# 每批每位員工只查一次綁定資料，經過重複 / 靜止過濾後以一次 executemany 寫入並提交
+# （緩衝模式改為送進背景寫入佇列），回傳與輸入順序對應的逐筆結果。
+LOOKUP_CHUNK = 500
+
+
+def lookup_users(conn, employee_ids):
+    # 回傳 {工號: (line_id, 姓名)}；快取命中的不再查詢
+    users, missing = {}, []
+    for employee_id in employee_ids:
+        user = identity_cache.peek_employee(employee_id, conn)
+        if user:
+            users[employee_id] = user
+        else:
+            missing.append(employee_id)
+    employee_ids = missing
+    for i in range(0, len(employee_ids), LOOKUP_CHUNK):
+        chunk = employee_ids[i:i + LOOKUP_CHUNK]
+        cursor = conn.execute(
+            f"SELECT employee_id, line_id, name FROM users WHERE employee_id IN ({','.join('?' * len(chunk))})",
+            chunk)
+        for employee_id, line_id, name in cursor:
+            users[employee_id] = (line_id, name)
+            identity_cache.put(line_id, employee_id, name)
+    return users
+
+
+def ingest(points, mode=INGEST_MODE):
+    # points: owntracks.LocationPoint 列表；結果為 {"status": "success" / "skipped" / "error", ...}
+    # mode 預設依 LOCATION_INGEST_MODE；自行批次的呼叫端（例如 mqtt_ingest.py）固定用 sync
+    results = [None] * len(points)
+    rows, positions = [], []
+    try:
+        with connection() as conn:
+            users = lookup_users(conn, {p.employee_id for p in points})
+            for i, point in enumerate(points):
+                user = users.get(point.employee_id)
+                if not user:
+                    results[i] = {"status": "error", "code": 403, "message": "尚未綁定該工號，無法記錄"}
+                    continue
+                skipped = location_filter.check(point.employee_id, point.tst, point.latitude, point.longitude)
+                if skipped:
+                    results[i] = {"status": "skipped", "reason": skipped}
+                    continue
+                line_id, name = user
+                rows.append((line_id, point.employee_id, name, point.latitude, point.longitude, point.timestamp,
+                             point.tst))
+                positions.append(i)
+            if rows and mode != "buffered":
+                insert_locations(conn, rows)
+    except Exception:
+        # 寫入或提交失敗：過濾器已記下的 tst 要撤回，用戶端重送時才不會被當成重複
+        for row in rows:
+            location_filter.forget(row[1], row[6])
+        raise
+
+    queue_full = False
+    for i, row in zip(positions, rows):
+        if mode == "buffered":
+            # 佇列滿了之後其餘的點不再等待，直接請用戶端重送（重送時已收下的點會因 tst 重複而略過）
+            if not queue_full:
+                try:
+                    writer.submit(row)
+                except QueueFull:
+                    queue_full = True
+            if queue_full:
+                location_filter.forget(row[1], row[6])
+                results[i] = {"status": "error", "code": 503, "message": "寫入佇列已滿，請稍後重送"}
+                continue
+        results[i] = {"status": "success"}
+    return results
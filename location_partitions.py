@@ -0,0 +1,243 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+import pytz
+
+import db_pool
+from applog import log
+
+# 定位資料依月份分表：location_logs_YYYYMM（例如 location_logs_202405），已建立的月份登記在 location_partitions。
+# 寫入時依 timestamp 送到對應月份的表（沒有就建立），區間查詢只讀涵蓋到的月份表；
+# 整月刪除或封存直接 DROP TABLE，不必逐列 DELETE 與維護索引。
+# location_logs 改為所有月份表的 UNION ALL 檢視表，只供臨時查詢與舊工具讀取，程式內的讀寫一律經過 tables() / route()。
+# id 在各月份表內各自遞增（不同月份可能重複），刪除時以 (月份表, id) 指定。
+# 本月與下個月的月份表由背景排程每隔 PREPARE_INTERVAL_HOURS 小時預先建立（prepare），
+# 月初的第一筆寫入不必在交易內建表、重建檢視表；ensure() 只是排程沒跑到時的備援。
+PREFIX = "location_logs_"
+PREPARE_INTERVAL_HOURS = float(os.getenv("LOCATION_PARTITION_PREPARE_HOURS", "6"))
+tz = pytz.timezone("Asia/Taipei")
+COLUMNS = ("id", "line_id", "employee_id", "name", "latitude", "longitude", "timestamp", "tst")
+
+DDL = {
+    "sqlite": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            line_id TEXT,
+            employee_id TEXT,
+            name TEXT,
+            latitude REAL,
+            longitude REAL,
+            timestamp TEXT,
+            tst INTEGER
+        )
+    """,
+    "postgres": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id BIGSERIAL PRIMARY KEY,
+            line_id TEXT,
+            employee_id TEXT,
+            name TEXT,
+            latitude DOUBLE PRECISION,
+            longitude DOUBLE PRECISION,
+            timestamp TEXT,
+            tst BIGINT
+        )
+    """,
+}
+# 每個月份表的索引：匯出逐位員工讀取、日期範圍掃描、(employee_id, tst) 去除重送
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_{table}_employee_ts ON {table}(employee_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_{table}_ts ON {table}(timestamp)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_employee_tst ON {table}(employee_id, tst) WHERE tst IS NOT NULL",
+]
+# 大量匯入新月份時可先移除、匯入完成後再由 create_indexes() 建立的索引（唯一索引負責去除重送，必須保留）
+DEFERRABLE_INDEXES = ("idx_{table}_employee_ts", "idx_{table}_ts")
+# 沒有任何月份表時，檢視表仍要有相同欄位
+_EMPTY_SELECT = ("SELECT CAST(NULL AS INTEGER) AS id, CAST(NULL AS TEXT) AS line_id, "
+                 "CAST(NULL AS TEXT) AS employee_id, CAST(NULL AS TEXT) AS name, CAST(NULL AS REAL) AS latitude, "
+                 "CAST(NULL AS REAL) AS longitude, CAST(NULL AS TEXT) AS timestamp, CAST(NULL AS INTEGER) AS tst "
+                 "WHERE 1 = 0")
+
+
+def table_name(month):
+    # "YYYY-MM"（或完整 timestamp）-> location_logs_YYYYMM
+    datetime.strptime(month[:7], "%Y-%m")
+    return f"{PREFIX}{month[:4]}{month[5:7]}"
+
+
+def next_month(month):
+    year, mon = int(month[:4]), int(month[5:7])
+    return f"{year + mon // 12}-{mon % 12 + 1:02d}"
+
+
+def month_bounds(month):
+    # 月份的半開時間區間 [起, 迄)
+    return f"{month}-01 00:00:00", f"{next_month(month)}-01 00:00:00"
+
+
+def months(conn):
+    return [r[0] for r in conn.execute("SELECT month FROM location_partitions ORDER BY month").fetchall()]
+
+
+def tables(conn, start=None, end=None):
+    # 與半開區間 [start, end) 有交集的月份表（依時間排序），start / end 為 timestamp 字串，None 表示不限
+    result = []
+    for month in months(conn):
+        first, last = month_bounds(month)
+        if (start is None or last > start) and (end is None or first < end):
+            result.append(table_name(month))
+    return result
+
+
+def ensure(conn, month, refresh=True):
+    # 回傳月份表名稱，尚未建立時建立表、索引並登記（與寫入在同一個交易內）；
+    # 目前月份通常已由 prepare() 建好，這裡只剩一次主鍵查詢
+    month = month[:7]
+    table = table_name(month)
+    if conn.execute("SELECT 1 FROM location_partitions WHERE month = ?", (month,)).fetchone():
+        return table
+    if db_pool.BACKEND == "postgres":
+        # 兩個連線同時建立同一張表時 PostgreSQL 會丟出例外，先以交易級 advisory lock 排隊
+        conn.execute("SELECT pg_advisory_xact_lock(hashtext('location_partitions'))")
+        if conn.execute("SELECT 1 FROM location_partitions WHERE month = ?", (month,)).fetchone():
+            return table
+    conn.execute(DDL[db_pool.BACKEND].format(table=table))
+    create_indexes(conn, month)
+    conn.execute("INSERT INTO location_partitions (month) VALUES (?) ON CONFLICT DO NOTHING", (month,))
+    if refresh:
+        refresh_view(conn)
+    return table
+
+
+def prepare(conn=None, now=None):
+    # 預先建立本月與下個月的月份表，回傳這次新建立的月份
+    if conn is None:
+        with db_pool.connection() as conn:
+            return prepare(conn, now)
+    month = (now or datetime.now(tz)).strftime("%Y-%m")
+    existing = set(months(conn))
+    created = [m for m in (month, next_month(month)) if m not in existing]
+    for m in created:
+        ensure(conn, m, refresh=False)
+    if created:
+        refresh_view(conn)
+    return created
+
+
+_scheduler_pid = None
+
+
+def start_scheduler():
+    # 與壓縮、分析排程相同：每個行程各一個排程執行緒；啟動時先執行一次，重複建立由 ensure() 略過
+    global _scheduler_pid
+    if not PREPARE_INTERVAL_HOURS or _scheduler_pid == os.getpid():
+        return
+    _scheduler_pid = os.getpid()
+
+    def loop():
+        while True:
+            try:
+                created = prepare()
+                if created:
+                    log("partitions.prepared", months=created)
+            except Exception as e:
+                log("partitions.prepare_error", "error", error=str(e))
+            time.sleep(PREPARE_INTERVAL_HOURS * 3600)
+    threading.Thread(target=loop, name="partitions", daemon=True).start()
+
+
+def drop_deferrable_indexes(conn, month):
+    for name in DEFERRABLE_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name.format(table=table_name(month))}")
+
+
+def create_indexes(conn, month):
+    for statement in INDEXES:
+        conn.execute(statement.format(table=table_name(month)))
+
+
+def route(conn, rows, ts_index=5):
+    # 依每列的 timestamp 分到各月份表：回傳 {表名: [列, ...]}，需要的表會先建立
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row[ts_index][:7], []).append(row)
+    return {ensure(conn, month): month_rows for month, month_rows in sorted(by_month.items())}
+
+
+def refresh_view(conn):
+    # 重建 location_logs 檢視表（新增或移除月份表後呼叫）
+    columns = ", ".join(COLUMNS)
+    selects = [f"SELECT {columns} FROM {table_name(month)}" for month in months(conn)]
+    conn.execute("DROP VIEW IF EXISTS location_logs")
+    conn.execute("CREATE VIEW location_logs AS " + " UNION ALL ".join(selects or [_EMPTY_SELECT]))
+
+
+def first_timestamp(conn):
+    # 最早一筆定位的時間（依月份順序找第一張有資料的表，每張表一次索引查詢）
+    for table in tables(conn):
+        first = conn.execute(f"SELECT MIN(timestamp) FROM {table}").fetchone()[0]
+        if first:
+            return first
+    return None
+
+
+def drop(conn, month):
+    # PostgreSQL 不允許刪除檢視表引用中的表，先移除檢視表，最後由 refresh_view 重建
+    conn.execute("DROP VIEW IF EXISTS location_logs")
+    conn.execute(f"DROP TABLE IF EXISTS {table_name(month)}")
+    conn.execute("DELETE FROM location_partitions WHERE month = ?", (month[:7],))
+    refresh_view(conn)
+
+
+def drop_all(conn):
+    # 清空全部定位：逐張 DROP TABLE，不論資料量都只是幾個 DDL
+    conn.execute("DROP VIEW IF EXISTS location_logs")
+    for month in months(conn):
+        conn.execute(f"DROP TABLE IF EXISTS {table_name(month)}")
+    conn.execute("DELETE FROM location_partitions")
+    refresh_view(conn)
+
+
+def copy_from(conn, source, columns=COLUMNS[1:]):
+    # 把另一張表（舊版 location_logs、匯入或測試用的暫存表）的資料依月份搬進月份表，回傳筆數
+    column_list = ", ".join(columns)
+    copied = 0
+    month_list = [r[0] for r in conn.execute(
+        f"SELECT DISTINCT substr(timestamp, 1, 7) FROM {source} WHERE timestamp IS NOT NULL").fetchall()]
+    for month in sorted(month_list):
+        table = ensure(conn, month, refresh=False)
+        copied += conn.execute(f"""
+            INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {source}
+            WHERE timestamp >= ? AND timestamp < ?
+        """, month_bounds(month)).rowcount
+        if "id" in columns and db_pool.BACKEND == "postgres":
+            # 保留原本的 id 時，序列要接在最大值之後
+            conn.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), MAX(id)) FROM {table}")
+    refresh_view(conn)
+    return copied
+
+
+def _relation_type(conn, name):
+    if db_pool.BACKEND == "postgres":
+        row = conn.execute("""
+            SELECT CASE table_type WHEN 'VIEW' THEN 'view' ELSE 'table' END FROM information_schema.tables
+            WHERE table_schema = current_schema() AND table_name = ?
+        """, (name,)).fetchone()
+    else:
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def migrate(conn):
+    # 舊版單一 location_logs 表拆成月份表後移除，改建同名檢視表（SQLite 為 migration 10，PostgreSQL 於 init_db 時執行）；
+    # 沒有 timestamp 的舊資料無法歸到任何月份，任何查詢也都讀不到，一併捨棄
+    kind = _relation_type(conn, "location_logs")
+    if kind == "table":
+        # 先改名，檢視表才能使用 location_logs 這個名稱
+        conn.execute("ALTER TABLE location_logs RENAME TO location_logs_legacy")
+        copy_from(conn, "location_logs_legacy", COLUMNS)
+        conn.execute("DROP TABLE location_logs_legacy")
+    elif kind is None:
+        refresh_view(conn)
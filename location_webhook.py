@@ -1,66 +1,70 @@
 from flask import Blueprint, request, jsonify
-import sqlite3
-from datetime import datetime
-import pytz
+from collections import Counter
+import owntracks
+from owntracks import PayloadError
+from location_ingest import ingest
+from location_writer import INGEST_MODE
+from applog import log
 
 location_bp = Blueprint("location", __name__)
-DB_PATH = 'checkin.db'
-tz = pytz.timezone("Asia/Taipei")
 
 @location_bp.route("/webhook", methods=["POST"])
 def receive_location():
     try:
-        data = request.get_json()
-        print("📥 OwnTracks 資料：", data)
+        # 內容可為單一 JSON、JSON 陣列或 NDJSON；離線期間累積的定位可一次送完
+        items, is_batch = owntracks.parse_body(request.get_data(as_text=True))
 
-        # 安全提取經緯度（支援 lat/lon 或 latitude/longitude）
-        lat_raw = data.get("lat") or data.get("latitude")
-        lon_raw = data.get("lon") or data.get("longitude")
-        if lat_raw is None or lon_raw is None:
-            return jsonify({"status": "error", "message": "缺少定位資料"}), 400
+        results = [None] * len(items)
+        points, positions = [], []
+        for i, item in enumerate(items):
+            kind = owntracks.message_type(item)
+            if kind is None:
+                results[i] = {"status": "error", "code": 400, "message": "訊息格式錯誤"}
+                continue
+            if kind != "location":
+                # transition / lwt / card 等非定位訊息不寫入
+                results[i] = {"status": "ignored", "type": kind}
+                continue
+            try:
+                points.append(owntracks.parse_location(item))
+                positions.append(i)
+            except PayloadError as e:
+                results[i] = {"status": "error", "code": e.status, "message": str(e)}
+        for i, result in zip(positions, ingest(points) if points else []):
+            results[i] = result
 
-        latitude = float(lat_raw)
-        longitude = float(lon_raw)
+        if not is_batch:
+            # 每筆定位都會進來，只抽樣輸出，不記錄座標
+            log("location.single", sampled=True, employee_id=points[0].employee_id if points else None,
+                status=results[0]["status"], mode=INGEST_MODE)
+            return _single_response(results[0])
 
-        # 解析 topic
-        topic = data.get("topic", "")
-        parts = topic.split("/")
-        if len(parts) < 2:
-            return jsonify({"status": "error", "message": "無效的 topic 格式"}), 400
-
-        employee_id = parts[1]  # owntracks/{employee_id}/device
-
-        # 處理時間
-        if "tst" in data:
-            utc_time = datetime.utcfromtimestamp(data["tst"]).replace(tzinfo=pytz.utc)
-            local_time = utc_time.astimezone(tz)
-        else:
-            local_time = datetime.now(tz)
-        timestamp_str = local_time.strftime("%Y-%m-%d %H:%M:%S")
-
-        # 查詢對應 user
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT line_id, name FROM users WHERE employee_id = ?", (employee_id,))
-        user_row = cursor.fetchone()
-
-        if not user_row:
-            return jsonify({"status": "error", "message": "尚未綁定該工號，無法記錄"}), 403
-
-        line_id, name = user_row
-
-        # 寫入資料
-        cursor.execute('''
-            INSERT INTO location_logs (line_id, employee_id, name, latitude, longitude, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (line_id, employee_id, name, latitude, longitude, timestamp_str))
-
-        conn.commit()
-        conn.close()
-
-        print(f"✅ 定位儲存成功：{employee_id} - {latitude}, {longitude}")
-        return jsonify({"status": "success", "message": "✅ 定位已成功記錄"})
+        counts = Counter(r["status"] for r in results)
+        log("location.batch", sampled=True, count=len(results),
+            **{key: counts[key] for key in ("success", "skipped", "ignored", "error")})
+        body = {"status": "success", "count": len(results), "results": results,
+                **{key: counts[key] for key in ("success", "skipped", "ignored", "error")}}
+        # 佇列已滿時請 OwnTracks 整批重送；已收下的點重送時會因 tst 重複而略過
+        if any(r.get("code") == 503 for r in results):
+            body["status"] = "error"
+            return jsonify(body), 503, {"Retry-After": "5"}
+        return jsonify(body)
 
+    except PayloadError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status
     except Exception as e:
-        print("🚨 Webhook 錯誤：", str(e))
+        log("location.webhook_error", "error", error=str(e))
         return jsonify({"status": "error", "message": str(e)}), 500
+
+def _single_response(result):
+    # 單筆請求維持原本的回應格式與狀態碼
+    if result["status"] == "error":
+        headers = {"Retry-After": "5"} if result["code"] == 503 else {}
+        return jsonify({"status": "error", "message": result["message"]}), result["code"], headers
+    if result["status"] == "ignored":
+        return jsonify({"status": "success", "message": "非定位訊息，略過", "ignored": result["type"]})
+    if result["status"] == "skipped":
+        return jsonify({"status": "success", "message": "定位未變動，略過", "skipped": result["reason"]})
+    if INGEST_MODE == "buffered":
+        return jsonify({"status": "success", "message": "✅ 定位已接收"})
+    return jsonify({"status": "success", "message": "✅ 定位已成功記錄"})
@@ -0,0 +1,180 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+from applog import log
+from db import insert_locations
+from db_pool import connection, OperationalError
+import location_filter
+
+# 寫入模式：sync（每筆請求直接寫入）/ buffered（先進佇列，由背景執行緒批次寫入）
+INGEST_MODE = os.getenv("LOCATION_INGEST_MODE", "sync")
+QUEUE_SIZE = int(os.getenv("LOCATION_QUEUE_SIZE", "10000"))
+BATCH_SIZE = int(os.getenv("LOCATION_BATCH_SIZE", "500"))
+FLUSH_INTERVAL = float(os.getenv("LOCATION_FLUSH_INTERVAL", "1.0"))
+
+# 佇列滿時的處理方式：
+#   block       等待 LOCATION_BLOCK_TIMEOUT 秒，仍滿則拒絕
+#   reject      立即拒絕（回 503，OwnTracks 會保留並重送）
+#   drop_oldest 丟棄佇列中最舊的點，收下新的點
+BACKPRESSURE = os.getenv("LOCATION_BACKPRESSURE", "block")
+BLOCK_TIMEOUT = float(os.getenv("LOCATION_BLOCK_TIMEOUT", "2.0"))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class LocationWriter:
+    def __init__(self, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 policy=BACKPRESSURE, block_timeout=BLOCK_TIMEOUT):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._lock = threading.Lock()
+        # 計數器由請求執行緒與寫入執行緒同時更新，另用一把鎖保護
+        self._counters_lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._stopping = None
+        self._pid = None
+        self._counters = {
+            "enqueued": 0,
+            "written": 0,
+            "batches": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "rejected": 0,
+            "dropped": 0,
+            "failed": 0,
+        }
+
+    def _ensure_started(self):
+        # gunicorn fork 之後執行緒不會被帶進子行程，因此以 pid 判斷是否需要重新啟動
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.maxsize)
+            self._stopping = threading.Event()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="location-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, row):
+        self._ensure_started()
+        try:
+            if self.policy == "block":
+                self._queue.put(row, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(row)
+        except queue.Full:
+            if self.policy != "drop_oldest":
+                self._count(rejected=1)
+                raise QueueFull()
+            try:
+                self._queue.get_nowait()
+                self._count(dropped=1)
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self._count(rejected=1)
+                raise QueueFull()
+        self._count(enqueued=1)
+
+    def _count(self, **deltas):
+        with self._counters_lock:
+            for key, delta in deltas.items():
+                self._counters[key] += delta
+
+    def _collect(self):
+        # 取得一批資料：滿 batch_size 或超過 flush_interval 即送出
+        try:
+            first = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+        # 關閉前把佇列內剩餘的點全部寫完
+        batch = self._drain()
+        while batch:
+            self._write(batch)
+            batch = self._drain()
+
+    def _write(self, batch, attempts=3):
+        for attempt in range(attempts):
+            try:
+                with connection() as conn:
+                    insert_locations(conn, batch)
+                break
+            except OperationalError as e:
+                # 資料庫忙碌等暫時性錯誤才重試
+                if attempt < attempts - 1:
+                    time.sleep(0.2 * (attempt + 1))
+                    continue
+                error = e
+            except Exception as e:
+                error = e
+            self._count(failed=len(batch))
+            log("location.write_error", "error", rows=len(batch), error=str(error))
+            # 沒寫入的點從過濾器撤回，用戶端重送時才會再收下
+            for row in batch:
+                location_filter.forget(row[1], row[6])
+            return
+        with self._counters_lock:
+            self._counters["written"] += len(batch)
+            self._counters["batches"] += 1
+            self._counters["last_batch_size"] = len(batch)
+            self._counters["max_batch_size"] = max(self._counters["max_batch_size"], len(batch))
+
+    def stop(self, timeout=10):
+        # 關閉時呼叫：停止收集並把剩餘資料寫入
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self._counters)
+        stats["mode"] = INGEST_MODE
+        stats["queue_depth"] = self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+        stats["queue_size"] = self.maxsize
+        stats["avg_batch_size"] = round(stats["written"] / stats["batches"], 1) if stats["batches"] else 0
+        return stats
+
+
+writer = LocationWriter()
+atexit.register(writer.stop)
@@ -0,0 +1,377 @@
+import bisect
+import glob
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+# 效能指標：路由延遲、SQL 耗時（依操作與資料表分組）、LINE API 延遲與錯誤、匯出耗時與檔案大小，
+# 以 Prometheus 文字格式由 /admin/metrics 輸出。
+# 每個行程各自累計；設定 METRICS_DIR 時各 worker 每隔 FLUSH_INTERVAL 秒把快照寫到該目錄，
+# /admin/metrics 合併所有仍在執行的 worker，不論請求落在哪個 worker 都能看到整體數字。
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+SQL_TIMING = ENABLED and os.getenv("METRICS_SQL", "1") != "0"
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "10"))
+# SQL 標籤（操作 + 資料表）組合上限，超過的歸到 "other"，避免標籤數量無限成長
+MAX_QUERIES = int(os.getenv("METRICS_MAX_QUERIES", "100"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SQL_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.5)
+SIZE_BUCKETS = (10_000, 100_000, 1_000_000, 10_000_000, 50_000_000, 100_000_000)
+
+_registry = {}
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+        _registry[name] = self
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._series.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        if not ENABLED:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [各區間次數（最後一格為 +Inf）, 總和]
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), [list(counts), total]] for labels, (counts, total) in self._series.items()]
+
+
+class timer:
+    # with metrics.timer(HISTOGRAM, "label"): ...
+    def __init__(self, histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        self.histogram.observe(self.elapsed, *self.labels)
+
+
+HTTP_LATENCY = Histogram("yls_http_request_duration_seconds", "HTTP 請求處理時間", ("route", "method", "status"))
+SQL_LATENCY = Histogram("yls_sql_statement_duration_seconds", "SQL 語句執行時間（不含逐列讀取、不含 DDL）",
+                        ("operation", "table"), SQL_BUCKETS)
+SQL_ERRORS = Counter("yls_sql_errors_total", "SQL 錯誤次數", ("kind",))
+LINE_LATENCY = Histogram("yls_line_api_request_duration_seconds", "LINE Messaging API 請求時間", ("endpoint", "status"))
+LINE_ERRORS = Counter("yls_line_api_errors_total", "LINE Messaging API 失敗次數", ("endpoint", "reason"))
+EXPORT_LATENCY = Histogram("yls_export_duration_seconds", "Excel 匯出產生時間", ("kind",))
+EXPORT_SIZE = Histogram("yls_export_size_bytes", "Excel 匯出檔案大小", ("kind",), SIZE_BUCKETS)
+MQTT_MESSAGES = Counter("yls_mqtt_messages_total", "MQTT 收到的訊息（依處理結果）", ("result",))
+MQTT_BATCH_WRITE = Histogram("yls_mqtt_batch_write_seconds", "MQTT 批次寫入時間")
+LOG_EVENTS = Counter("yls_log_events_total", "紀錄事件次數（含未被抽樣輸出的）", ("event", "level"))
+
+
+# ---- SQL 正規化與計時 ----
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_COMMENT = re.compile(r"--[^\n]*")
+_CTE = re.compile(r"(\w+)\s*(?:\([^)]*\))?\s+AS\s*\(", re.I)
+_STATEMENT = re.compile(r"[()]|\b(?:SELECT|INSERT|UPDATE|DELETE)\b", re.I)
+_TARGET = {
+    "SELECT": re.compile(r"\b(?:FROM|JOIN)\s+(\w+)", re.I),
+    "INSERT": re.compile(r"\bINTO\s+(\w+)", re.I),
+    "REPLACE": re.compile(r"\bINTO\s+(\w+)", re.I),
+    "UPDATE": re.compile(r"\bUPDATE\s+(?:OR\s+\w+\s+)?(\w+)", re.I),
+    "DELETE": re.compile(r"\bFROM\s+(\w+)", re.I),
+    "COPY": re.compile(r"\bCOPY\s+(\w+)", re.I),
+}
+# 月份表（location_logs_202405）歸到 location_logs
+_PARTITION = re.compile(r"_\d{6}$")
+_normalized = {}
+_labels_seen = set()
+_query_lock = threading.Lock()
+
+
+def normalize_sql(sql):
+    # 回傳 (操作, 資料表) 或 None（DDL、PRAGMA、交易控制等不計時）；
+    # 每個月份表、每種批次長度都歸在同一組，標籤數量只跟資料表數量有關
+    label = _normalized.get(sql, False)
+    if label is not False:
+        return label
+    text = _COMMENT.sub(" ", _STRING.sub("''", sql)).strip()
+    operation = text.split(None, 1)[0].upper() if text else ""
+    ctes = ()
+    if operation == "WITH":
+        # 主語句是括號外的第一個 SELECT / INSERT / UPDATE / DELETE，CTE 的名稱不算資料表
+        ctes = {name.lower() for name in _CTE.findall(text)}
+        depth = 0
+        for match in _STATEMENT.finditer(text):
+            token = match.group(0)
+            depth += 1 if token == "(" else -1 if token == ")" else 0
+            if depth == 0 and token not in "()":
+                text, operation = text[match.start():], token.upper()
+                break
+    label = None
+    if operation in _TARGET:
+        tables = [t for t in _TARGET[operation].findall(text) if t.lower() not in ctes]
+        label = (operation, _PARTITION.sub("", tables[0].lower()) if tables else "-")
+        with _query_lock:
+            if label not in _labels_seen and len(_labels_seen) >= MAX_QUERIES:
+                label = (operation, "other")
+            else:
+                _labels_seen.add(label)
+    with _query_lock:
+        if len(_normalized) < MAX_QUERIES * 20:
+            _normalized[sql] = label
+    return label
+
+
+def record_sql(sql, started, error=None):
+    label = normalize_sql(sql)
+    if label is not None:
+        SQL_LATENCY.observe(time.perf_counter() - started, *label)
+    if error is not None:
+        SQL_ERRORS.inc("locked" if "locked" in str(error) else type(error).__name__)
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            result = super().execute(sql, parameters)
+        except sqlite3.Error as e:
+            record_sql(sql, started, e)
+            raise
+        record_sql(sql, started)
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            result = super().executemany(sql, seq_of_parameters)
+        except sqlite3.Error as e:
+            record_sql(sql, started, e)
+            raise
+        record_sql(sql, started)
+        return result
+
+
+class TimedConnection(sqlite3.Connection):
+    # db_pool 以 sqlite3.connect(factory=...) 建立，所有經由連線或游標執行的語句都會計時
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    return TimedConnection if SQL_TIMING else sqlite3.Connection
+
+
+# ---- Flask ----
+
+def init_app(app):
+    if not ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    def observe(status):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_LATENCY.observe(time.perf_counter() - started, route, request.method, status)
+
+    @app.after_request
+    def _observe(response):
+        observe(str(response.status_code))
+        maybe_flush()
+        return response
+
+    @app.teardown_request
+    def _observe_error(exc):
+        # 未處理的例外不會經過 after_request，以 500 記錄
+        observe("500")
+
+
+# ---- 多 worker 合併 ----
+
+_flush_lock = threading.Lock()
+_flushed_at = 0.0
+_pid = os.getpid()
+
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in _registry.items()}
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f"metrics-{pid}.json")
+
+
+def _check_fork():
+    # fork 前父行程累計的數字（例如啟動時的 migration）不屬於這個 worker
+    global _flushed_at, _pid
+    if _pid == os.getpid():
+        return
+    for metric in _registry.values():
+        metric.reset()
+    _pid = os.getpid()
+    _flushed_at = 0.0
+
+
+def maybe_flush(force=False):
+    # 寫到暫存檔再 rename，讀取端不會讀到寫一半的檔案
+    global _flushed_at
+    _check_fork()
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _flushed_at < FLUSH_INTERVAL:
+        return
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        _flushed_at = now
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot(), f)
+        os.replace(tmp_path, _snapshot_path(os.getpid()))
+    finally:
+        _flush_lock.release()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(total, snap):
+    for name, series in snap.items():
+        target = total.setdefault(name, {})
+        for labels, value in series:
+            key = tuple(labels)
+            current = target.get(key)
+            if current is None:
+                target[key] = value if not isinstance(value, list) else [list(value[0]), value[1]]
+            elif isinstance(value, list):
+                current[0] = [a + b for a, b in zip(current[0], value[0])]
+                current[1] += value[1]
+            else:
+                target[key] = current + value
+
+
+def collect():
+    # 回傳 {指標名稱: {標籤: 值}}，包含本行程與其他 worker 最近一次寫出的快照
+    _check_fork()
+    total = {}
+    _merge(total, snapshot())
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+            try:
+                pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            if not _alive(pid):
+                # 已結束的 worker：移除檔案（重新啟動後 counter 歸零，Prometheus 會當成 reset）
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    _merge(total, json.load(f))
+            except (OSError, ValueError):
+                continue
+    return total
+
+
+# ---- Prometheus 文字格式 ----
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    lines = []
+    data = collect()
+    for name, metric in _registry.items():
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for labels, value in sorted(data.get(name, {}).items()):
+            if metric.kind == "counter":
+                lines.append(f"{name}{_labels(metric.labelnames, labels)} {_number(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound if bound == "+Inf" else _number(bound)}"'
+                lines.append(f"{name}_bucket{_labels(metric.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric.labelnames, labels)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(metric.labelnames, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
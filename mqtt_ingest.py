@@ -0,0 +1,240 @@
+import json
+import os
+import queue
+import signal
+import ssl
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import metrics
+import owntracks
+from applog import log
+from db import init_db
+from db_pool import OperationalError
+from location_ingest import ingest
+from owntracks import PayloadError
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:  # 只有 MQTT 服務需要，網頁行程不必安裝
+    mqtt = None
+
+# OwnTracks MQTT 接收服務（獨立行程，不經過 HTTP worker）：
+# 訂閱 owntracks/+/+，沿用 owntracks.py 的解析與 location_ingest.ingest 的過濾與寫入，
+# 訊息先進本地佇列，每 BATCH_SIZE 筆或 FLUSH_INTERVAL 秒整批寫入並提交一次。
+# QoS 1 搭配固定 client id 與持久 session：服務停機期間的訊息由 broker 保留，
+# 支援手動 ack 的 paho（2.x）會在資料提交後才回 PUBACK，行程中斷時未提交的訊息會重送。
+# 用法：python mqtt_ingest.py（本機測試：mosquitto -v，再以 mosquitto_pub 發送）
+load_dotenv()
+
+MQTT_HOST = os.getenv("MQTT_HOST", "localhost")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+MQTT_USERNAME = os.getenv("MQTT_USERNAME")
+MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+MQTT_TLS = os.getenv("MQTT_TLS", "0") == "1"
+MQTT_CA_CERTS = os.getenv("MQTT_CA_CERTS") or None
+MQTT_TOPIC = os.getenv("MQTT_TOPIC", "owntracks/+/+")
+MQTT_QOS = int(os.getenv("MQTT_QOS", "1"))
+MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", "yls-ingest")
+MQTT_KEEPALIVE = int(os.getenv("MQTT_KEEPALIVE", "60"))
+BATCH_SIZE = int(os.getenv("MQTT_BATCH_SIZE", "500"))
+FLUSH_INTERVAL = float(os.getenv("MQTT_FLUSH_INTERVAL", "1.0"))
+# 佇列滿時暫停接收（不 ack 並斷線），佇列降到一半以下再重新連線，未 ack 的訊息由 broker 重送
+QUEUE_SIZE = int(os.getenv("MQTT_QUEUE_SIZE", "10000"))
+WRITE_ATTEMPTS = 5
+# 重試 WRITE_ATTEMPTS 次仍失敗時暫停接收，每輪等待 2、4、8…秒（最多 WRITE_BACKOFF_MAX 秒）再重寫同一批
+WRITE_BACKOFF_MAX = 60
+
+
+class MqttIngest:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._stopping = threading.Event()
+        self._paused = threading.Event()
+        self.manual_ack = False
+        self.client = self._new_client()
+
+    def _new_client(self):
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            # paho 2.x：回呼參數沿用 VERSION2，在資料提交後才 ack
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=MQTT_CLIENT_ID,
+                                 clean_session=False, manual_ack=True)
+            self.manual_ack = True
+        else:
+            client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False)
+        if MQTT_USERNAME:
+            client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        if MQTT_TLS:
+            client.tls_set(ca_certs=MQTT_CA_CERTS, tls_version=ssl.PROTOCOL_TLS_CLIENT)
+        client.max_inflight_messages_set(min(BATCH_SIZE, 65535))
+        client.reconnect_delay_set(min_delay=1, max_delay=60)
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_message
+        return client
+
+    # paho 1.x：(client, userdata, flags, rc)；2.x：(client, userdata, flags, reason_code, properties)
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if reason_code != 0:
+            log("mqtt.connect_failed", "error", reason=str(reason_code))
+            return
+        # 重新連線後也要再訂閱一次（broker 有保留 session 時不會重複收到）
+        client.subscribe(MQTT_TOPIC, qos=MQTT_QOS)
+        log("mqtt.connected", host=MQTT_HOST, port=MQTT_PORT, topic=MQTT_TOPIC)
+
+    def on_disconnect(self, client, userdata, *args):
+        if not self._stopping.is_set() and not self._paused.is_set():
+            log("mqtt.disconnected", "warning", reason=str(args[-2] if len(args) > 1 else args[0]))
+
+    def on_message(self, client, userdata, message):
+        if self._paused.is_set():
+            # 暫停後同一次讀取仍可能收到幾則，不 ack，恢復連線後由 broker 重送
+            return
+        try:
+            item = json.loads(message.payload)
+            kind = owntracks.message_type(item)
+            if kind is None:
+                raise PayloadError("訊息格式錯誤")
+            if kind != "location":
+                # transition / lwt / card 等非定位訊息不寫入
+                metrics.MQTT_MESSAGES.inc("ignored")
+                self._ack(message)
+                return
+            point = owntracks.parse_location(item, topic=message.topic)
+        except (ValueError, PayloadError) as e:
+            metrics.MQTT_MESSAGES.inc("invalid")
+            log("mqtt.invalid_message", "warning", sampled=True, topic=message.topic, error=str(e))
+            self._ack(message)
+            return
+        try:
+            # 這裡在 paho 的網路迴圈內執行，不可等待：等待期間送不出 PINGREQ，broker 會斷線並整批重送
+            self._queue.put_nowait((point, message))
+        except queue.Full:
+            metrics.MQTT_MESSAGES.inc("deferred")
+            self._pause(message)
+
+    def _pause(self, message):
+        self._paused.set()
+        if self.manual_ack:
+            log("mqtt.paused", "warning", queue=self._queue.qsize())
+        else:
+            # paho 1.x 回呼結束就自動 ack，這則無法再由 broker 重送
+            log("mqtt.dropped", "error", topic=message.topic, queue=self._queue.qsize())
+        # 斷線後 broker 把未 ack 的訊息留在持久 session；已進佇列的訊息照常寫入，
+        # 斷線期間送不出的 ack 會讓它們在重新連線後再送一次，由 tst 去重略過
+        self.client.disconnect()
+
+    def _hold(self, rows, failures):
+        # 資料庫持續無法寫入：這批不 ack，暫停接收讓之後的訊息留在 broker，退避後重寫同一批
+        if not self._paused.is_set():
+            self._paused.set()
+            self.client.disconnect()
+        delay = min(2 ** failures, WRITE_BACKOFF_MAX)
+        log("mqtt.write_paused", "error", rows=rows, failures=failures, retry_in=delay)
+        self._stopping.wait(delay)
+
+    def _resume(self):
+        self.client.loop_stop()
+        self._paused.clear()
+        self.client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+        self.client.loop_start()
+        log("mqtt.resumed", queue=self._queue.qsize())
+
+    def _ack(self, message):
+        if self.manual_ack and message.qos > 0:
+            self.client.ack(message.mid, message.qos)
+
+    def _drain(self):
+        # 等到第一筆後，再收集到 BATCH_SIZE 筆或 FLUSH_INTERVAL 秒為止
+        try:
+            batch = [self._queue.get(timeout=FLUSH_INTERVAL)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        points = [point for point, _ in batch]
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                with metrics.timer(metrics.MQTT_BATCH_WRITE):
+                    results = ingest(points, mode="sync")
+                break
+            except OperationalError as e:
+                # 寫入失敗的點已由 ingest 從過濾狀態中移除，重試時不會被當成重複
+                if attempt == WRITE_ATTEMPTS - 1:
+                    # 不 ack：手動 ack 模式下 broker 會在重新連線後重送
+                    log("mqtt.write_error", "error", rows=len(points), error=str(e))
+                    raise
+                time.sleep(0.5 * (attempt + 1))
+        for (_, message), result in zip(batch, results):
+            metrics.MQTT_MESSAGES.inc(result["status"])
+            self._ack(message)
+        log("mqtt.batch", sampled=True, count=len(batch),
+            success=sum(r["status"] == "success" for r in results))
+
+    def run(self):
+        init_db()
+        self.client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+        self.client.loop_start()
+        pending, failures = [], 0
+        try:
+            while not self._stopping.is_set():
+                batch = pending or self._drain()
+                if batch:
+                    try:
+                        self._write(batch)
+                        pending, failures = [], 0
+                    except OperationalError:
+                        pending, failures = batch, failures + 1
+                        self._hold(len(batch), failures)
+                        continue
+                if self._paused.is_set() and self._queue.qsize() <= QUEUE_SIZE // 2:
+                    self._resume()
+                metrics.maybe_flush()
+        finally:
+            # 停止前把已收到的訊息寫完再斷線；之後才到的訊息沒有 ack，下次連線時 broker 會重送
+            batch = pending + self._drain_nowait()
+            if batch:
+                try:
+                    self._write(batch)
+                except OperationalError:
+                    # 已記錄於 mqtt.write_error；未 ack 的訊息下次連線時由 broker 重送
+                    pass
+            self.client.disconnect()
+            self.client.loop_stop()
+            metrics.maybe_flush(force=True)
+
+    def _drain_nowait(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def stop(self, *args):
+        self._stopping.set()
+
+
+def main():
+    if mqtt is None:
+        raise SystemExit("⚠️ 需要 paho-mqtt：pip install paho-mqtt")
+    service = MqttIngest()
+    signal.signal(signal.SIGTERM, service.stop)
+    signal.signal(signal.SIGINT, service.stop)
+    service.run()
+
+
+if __name__ == "__main__":
+    main()
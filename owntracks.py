@@ -0,0 +1,82 @@
+import json
+from collections import namedtuple
+from datetime import datetime
+
+import pytz
+
+# OwnTracks 訊息解析：HTTP 內容可為單一 JSON、JSON 陣列或 NDJSON（每行一筆），
+# 依 _type 分派，只有 location 會寫入定位；transition / lwt / card 等其他訊息回報為 ignored。
+tz = pytz.timezone("Asia/Taipei")
+
+LocationPoint = namedtuple("LocationPoint", "employee_id latitude longitude tst timestamp")
+
+
+class PayloadError(ValueError):
+    # message 為回給用戶端的訊息，status 為 HTTP 狀態碼
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_body(text):
+    # 回傳 (訊息列表, 是否為批次)；單一 JSON 物件維持原本的單筆格式
+    text = (text or "").strip()
+    if not text:
+        raise PayloadError("缺少定位資料")
+    if text.startswith("["):
+        try:
+            items = json.loads(text)
+        except ValueError:
+            raise PayloadError("JSON 格式錯誤")
+        return items, True
+    try:
+        return [json.loads(text)], False
+    except ValueError:
+        pass
+    items = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            raise PayloadError(f"第 {number} 行 JSON 格式錯誤")
+    return items, True
+
+
+def message_type(item):
+    # 沒有 _type 但有座標的舊格式視為 location
+    if not isinstance(item, dict):
+        return None
+    return item.get("_type") or "location"
+
+
+def to_local_timestamp(tst=None):
+    if tst is None:
+        return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+    return datetime.fromtimestamp(tst, pytz.utc).astimezone(tz).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def employee_from_topic(topic):
+    # owntracks/{employee_id}/{device}
+    parts = (topic or "").split("/")
+    if len(parts) < 2:
+        raise PayloadError("無效的 topic 格式")
+    return parts[1]
+
+
+def parse_location(item, topic=None):
+    # 支援 lat/lon 或 latitude/longitude；topic 未在訊息內時可由呼叫端提供（例如 MQTT 主題）
+    lat_raw = item.get("lat") if item.get("lat") is not None else item.get("latitude")
+    lon_raw = item.get("lon") if item.get("lon") is not None else item.get("longitude")
+    if lat_raw is None or lon_raw is None:
+        raise PayloadError("缺少定位資料")
+    try:
+        latitude = float(lat_raw)
+        longitude = float(lon_raw)
+        tst = int(item["tst"]) if item.get("tst") is not None else None
+    except (TypeError, ValueError):
+        raise PayloadError("定位資料格式錯誤")
+    employee_id = employee_from_topic(item.get("topic") or topic)
+    return LocationPoint(employee_id, latitude, longitude, tst, to_local_timestamp(tst))
@@ -0,0 +1,410 @@
+import csv
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.pool
+    from psycopg2 import extensions
+except ImportError:  # 只有 DATABASE_URL 指向 PostgreSQL 時才需要
+    psycopg2 = None
+
+# PostgreSQL 儲存後端（DATABASE_URL=postgresql://... 時由 db_pool 啟用），讓多台主機共用同一個資料庫。
+# 連線包成與 sqlite3 相同的介面（execute / executemany / cursor / commit / in_transaction / total_changes），
+# SQL 沿用 ? 參數寫法，在這裡轉成 psycopg2 的 %s，其他模組不需要分兩套查詢。
+# 另外提供 SQLite 沒有的操作：COPY 大量寫入定位點、伺服器端游標逐批讀取匯出資料。
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+STATEMENT_TIMEOUT_MS = int(os.getenv("PG_STATEMENT_TIMEOUT_MS", "0"))
+
+# 與 db.MIGRATIONS 最新版本相同的結構；時間仍以 "YYYY-MM-DD HH:MM:SS" 文字儲存，查詢寫法與 SQLite 一致
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGSERIAL PRIMARY KEY,
+        line_id TEXT UNIQUE,
+        employee_id TEXT UNIQUE,
+        name TEXT,
+        bind_time TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS checkins (
+        id BIGSERIAL PRIMARY KEY,
+        employee_id TEXT,
+        line_id TEXT,
+        name TEXT,
+        check_type TEXT,
+        timestamp TEXT,
+        latitude DOUBLE PRECISION,
+        longitude DOUBLE PRECISION,
+        distance DOUBLE PRECISION,
+        result TEXT,
+        site_id INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_states (
+        line_id TEXT PRIMARY KEY,
+        state TEXT,
+        temp_employee_id TEXT,
+        last_updated TEXT
+    )
+    """,
+    # 定位的月份表由 location_partitions 依需要建立
+    "CREATE TABLE IF NOT EXISTS location_partitions (month TEXT PRIMARY KEY)",
+    """
+    CREATE TABLE IF NOT EXISTS sites (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        latitude DOUBLE PRECISION NOT NULL,
+        longitude DOUBLE PRECISION NOT NULL,
+        radius_m DOUBLE PRECISION NOT NULL DEFAULT 50,
+        active INTEGER NOT NULL DEFAULT 1
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS latest_location (
+        line_id TEXT PRIMARY KEY,
+        employee_id TEXT,
+        latitude DOUBLE PRECISION,
+        longitude DOUBLE PRECISION,
+        timestamp TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS daily_attendance (
+        employee_id TEXT NOT NULL,
+        date TEXT NOT NULL,
+        name TEXT,
+        first_in TEXT,
+        last_out TEXT,
+        in_result TEXT,
+        out_result TEXT,
+        worked_minutes INTEGER,
+        PRIMARY KEY (employee_id, date)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS calendar_dates (
+        source TEXT NOT NULL,
+        date TEXT NOT NULL,
+        PRIMARY KEY (source, date)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS compaction_log (
+        date TEXT PRIMARY KEY,
+        stage TEXT NOT NULL,
+        rows_before INTEGER,
+        rows_after INTEGER,
+        updated_at TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value BIGINT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS line_events (
+        event_id TEXT PRIMARY KEY,
+        received_at TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS onsite_daily (
+        employee_id TEXT NOT NULL,
+        date TEXT NOT NULL,
+        site_id INTEGER NOT NULL,
+        seconds BIGINT NOT NULL DEFAULT 0,
+        visits INTEGER NOT NULL DEFAULT 0,
+        first_arrival TEXT,
+        last_departure TEXT,
+        PRIMARY KEY (employee_id, date, site_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS onsite_state (
+        employee_id TEXT PRIMARY KEY,
+        last_ts TEXT NOT NULL,
+        site_id INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS export_jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        start_date TEXT NOT NULL,
+        end_date TEXT NOT NULL,
+        version TEXT,
+        status TEXT NOT NULL,
+        progress INTEGER NOT NULL DEFAULT 0,
+        path TEXT,
+        error TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    """,
+    "ALTER TABLE checkins ADD COLUMN IF NOT EXISTS work_date TEXT",
+    "ALTER TABLE location_partitions ADD COLUMN IF NOT EXISTS analyzed_id BIGINT NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS idx_checkins_employee_ts ON checkins(employee_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_checkins_ts ON checkins(timestamp)",
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_checkins_employee_work_date_type
+    ON checkins(employee_id, work_date, check_type)
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_line_events_received_at ON line_events(received_at)",
+    "CREATE INDEX IF NOT EXISTS idx_latest_location_employee ON latest_location(employee_id)",
+    "CREATE INDEX IF NOT EXISTS idx_latest_location_timestamp ON latest_location(timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_daily_attendance_date ON daily_attendance(date)",
+    "CREATE INDEX IF NOT EXISTS idx_onsite_daily_date ON onsite_daily(date)",
+    "CREATE INDEX IF NOT EXISTS idx_export_jobs_created_at ON export_jobs(created_at)",
+    """
+    INSERT INTO sites (name, latitude, longitude, radius_m)
+    SELECT '總部', 25.0478, 121.5319, 50 WHERE NOT EXISTS (SELECT 1 FROM sites)
+    """,
+    "INSERT INTO meta (key, value) VALUES ('users_version', 0) ON CONFLICT DO NOTHING",
+]
+
+_pool = None
+_pool_pid = None
+_slots = None
+_lock = threading.Lock()
+
+if psycopg2 is not None:
+    Error = psycopg2.Error
+    IntegrityError = psycopg2.IntegrityError
+    OperationalError = psycopg2.OperationalError
+else:
+    class Error(Exception):
+        pass
+
+    class IntegrityError(Error):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+
+def _get_pool():
+    global _pool, _pool_pid, _slots
+    if psycopg2 is None:
+        raise RuntimeError("DATABASE_URL 指向 PostgreSQL，需要安裝 psycopg2（pip install psycopg2-binary）")
+    if _pool_pid == os.getpid():
+        return _pool
+    with _lock:
+        if _pool_pid != os.getpid():
+            # gunicorn fork 之後不可沿用父行程的連線，父行程的 pool 直接捨棄
+            options = f"-c statement_timeout={STATEMENT_TIMEOUT_MS}" if STATEMENT_TIMEOUT_MS else None
+            _pool = psycopg2.pool.ThreadedConnectionPool(POOL_MIN, POOL_MAX, DATABASE_URL, options=options)
+            # ThreadedConnectionPool 用完時直接丟出例外，這裡改成等待
+            _slots = threading.BoundedSemaphore(POOL_MAX)
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def checkout():
+    pool = _get_pool()
+    _slots.acquire()
+    try:
+        return PgConnection(pool.getconn())
+    except BaseException:
+        _slots.release()
+        raise
+
+
+def checkin(conn):
+    pool = _get_pool()
+    try:
+        pool.putconn(conn.raw, close=bool(conn.raw.closed))
+    finally:
+        _slots.release()
+
+
+def close_all():
+    # 關閉後下次 checkout 重新建立連線池（測試切換資料庫時也會用到）
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = _pool_pid = None
+
+
+_PLACEHOLDER = re.compile(r"'(?:[^']|'')*'|\?|%")
+_translated = {}
+
+
+def translate(sql):
+    # ? -> %s，字面上的 % -> %%（psycopg2 連字串常數內的 % 也會解析；字串常數內的 ? 不動）
+    text = _translated.get(sql)
+    if text is None:
+        text = _PLACEHOLDER.sub(lambda m: {"?": "%s", "%": "%%"}.get(m.group(0), m.group(0).replace("%", "%%")), sql)
+        if len(_translated) < 2048:
+            _translated[sql] = text
+    return text
+
+
+class PgConnection:
+    def __init__(self, raw):
+        self.raw = raw
+        # sqlite3 的 total_changes：累計這條連線上 INSERT / UPDATE / DELETE 影響的筆數
+        self.total_changes = 0
+
+    def cursor(self):
+        return PgCursor(self)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+    @property
+    def in_transaction(self):
+        return self.raw.get_transaction_status() in (extensions.TRANSACTION_STATUS_INTRANS,
+                                                     extensions.TRANSACTION_STATUS_INERROR)
+
+    def stream(self, sql, params=(), size=5000):
+        # 伺服器端（具名）游標：每次只從資料庫取回 size 筆，匯出大範圍資料時不會整批載入記憶體
+        with self.raw.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = size
+            cursor.execute(translate(sql), tuple(params))
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    return
+                yield from rows
+
+    def copy_rows(self, table, columns, rows):
+        # 以 COPY ... FROM STDIN 寫入（CSV，None 寫成空欄位即 NULL），回傳筆數
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        buffer.seek(0)
+        started = time.perf_counter()
+        with self.raw.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        metrics.record_sql(f"COPY {table}", started)
+        return count
+
+
+class PgCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self._cursor = conn.raw.cursor()
+        self.lastrowid = None
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(translate(sql), tuple(params))
+        except psycopg2.Error as e:
+            metrics.record_sql(sql, started, e)
+            raise
+        metrics.record_sql(sql, started)
+        if self._cursor.description is None and self._cursor.rowcount > 0:
+            self.connection.total_changes += self._cursor.rowcount
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        # execute_batch 把多筆合併成少數幾次往返；rowcount 只有最後一批，需要筆數的呼叫端請用 COPY
+        started = time.perf_counter()
+        try:
+            psycopg2.extras.execute_batch(self._cursor, translate(sql), [tuple(p) for p in seq_of_params],
+                                          page_size=500)
+        except psycopg2.Error as e:
+            metrics.record_sql(sql, started, e)
+            raise
+        metrics.record_sql(sql, started)
+        return self
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self._cursor.arraysize)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+def init_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def insert_locations(conn, table, rows):
+    # COPY 到暫存表再 INSERT ... SELECT 到月份表，重複的 (employee_id, tst) 由唯一索引略過；回傳實際寫入筆數
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS location_stage (
+            line_id TEXT, employee_id TEXT, name TEXT,
+            latitude DOUBLE PRECISION, longitude DOUBLE PRECISION, timestamp TEXT, tst BIGINT
+        ) ON COMMIT DELETE ROWS
+    """)
+    columns = ("line_id", "employee_id", "name", "latitude", "longitude", "timestamp", "tst")
+    conn.copy_rows("location_stage", columns, rows)
+    inserted = conn.execute(f"""
+        INSERT INTO {table} ({', '.join(columns)})
+        SELECT {', '.join(columns)} FROM location_stage
+        ON CONFLICT (employee_id, tst) WHERE tst IS NOT NULL DO NOTHING
+    """).rowcount
+    # 同一個交易內可能還會再寫下一批
+    conn.execute("DELETE FROM location_stage")
+    return inserted
+
+
+@contextmanager
+def advisory_lock(name):
+    # 跨主機互斥（取代單機的檔案鎖）：另外取一條連線持有 session 級 advisory lock，取不到時回傳 False
+    conn = checkout()
+    try:
+        key = int.from_bytes(hashlib.sha256(name.encode("utf-8")).digest()[:8], "big", signed=True)
+        locked = conn.execute("SELECT pg_try_advisory_lock(?)", (key,)).fetchone()[0]
+        conn.commit()
+        try:
+            yield locked
+        finally:
+            if locked:
+                conn.execute("SELECT pg_advisory_unlock(?)", (key,))
+                conn.commit()
+    finally:
+        checkin(conn)
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from io import BytesIO
+
+from flask import Blueprint, abort, send_file
+
+from applog import log
+
+# Android 設定用 QR Code 快取：檔名為設定內容的雜湊值，內容相同就不必重新產生；
+# 先寫入暫存檔再 os.replace，多個 worker 同時產生同一張圖也不會讀到寫一半的檔案。
+# 圖檔網址包含雜湊值，內容不會變動，可讓 LINE 與瀏覽器長期快取。
+QR_DIR = os.getenv("QR_CACHE_DIR", "static/qr")
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://yls-checkin-bot.onrender.com").rstrip("/")
+CACHE_MAX_AGE = 365 * 24 * 3600
+
+qr_bp = Blueprint("qr", __name__)
+_key_pattern = re.compile(r"[0-9a-f]{32}")
+_counters = {"hits": 0, "generated": 0}
+
+
+def android_config(employee_id):
+    return {
+        "_type": "configuration",
+        "desc": f"YLS 打卡設定 - 工號 {employee_id}",
+        "url": f"{PUBLIC_BASE_URL}/location/webhook",
+        "ident": employee_id,
+        "trackerId": "ot",
+        "secret": False
+    }
+
+
+def cache_key(payload):
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def _path(key):
+    return os.path.join(QR_DIR, f"{key}.png")
+
+
+def ensure(employee_id):
+    # 回傳 QR Code 的快取鍵；圖檔已存在時不做任何影像處理
+    payload = json.dumps(android_config(employee_id))
+    key = cache_key(payload)
+    path = _path(key)
+    if os.path.exists(path):
+        _counters["hits"] += 1
+        return key
+    # qrcode 與 Pillow 只在第一次產生圖檔時載入，worker 啟動時不必匯入
+    import qrcode
+
+    buffer = BytesIO()
+    qrcode.make(payload).save(buffer, format="PNG")
+    os.makedirs(QR_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=QR_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(buffer.getvalue())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    _counters["generated"] += 1
+    return key
+
+
+def url_for_employee(employee_id):
+    return f"{PUBLIC_BASE_URL}/qr/{ensure(employee_id)}.png"
+
+
+def prefetch(employee_id):
+    # 綁定完成時在背景先產生圖檔，使用者輸入 Android 時即可直接送出
+    def run():
+        try:
+            ensure(employee_id)
+        except Exception as e:
+            log("qr.prefetch_error", "warning", employee_id=employee_id, error=str(e))
+    threading.Thread(target=run, name="qr-prefetch", daemon=True).start()
+
+
+def stats():
+    return dict(_counters, dir=QR_DIR)
+
+
+@qr_bp.route("/<key>.png")
+def serve(key):
+    if not _key_pattern.fullmatch(key) or not os.path.exists(_path(key)):
+        abort(404)
+    # 雜湊值即為 ETag；網址對應的內容永不改變，標記為 immutable
+    response = send_file(os.path.abspath(_path(key)), mimetype="image/png", etag=key,
+                         max_age=CACHE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import analytics  # noqa: E402
+import compaction  # noqa: E402
+import db  # noqa: E402
+import db_pool  # noqa: E402
+import export_jobs  # noqa: E402
+import geofence  # noqa: E402
+import identity_cache  # noqa: E402
+import location_cache  # noqa: E402
+import location_filter  # noqa: E402
+import pg_backend  # noqa: E402
+import qr_cache  # noqa: E402
+
+# 測試用的 PostgreSQL：每個測試開始前會清空整個 public schema，請指向專用的空資料庫，不可沿用 DATABASE_URL。
+# 沒有設定時只跑 SQLite；例：TEST_DATABASE_URL=postgresql://postgres@localhost/yls_test python -m pytest -q
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+
+def _clear_caches():
+    # 行程內的快取會跨測試殘留（資料庫每次都是新的）
+    identity_cache.clear()
+    location_cache.clear()
+    location_filter.clear()
+    geofence.invalidate()
+
+
+def _reset_postgres():
+    import psycopg2
+
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA public CASCADE")
+            cursor.execute("CREATE SCHEMA public")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(autouse=True)
+def _isolated_paths(tmp_path, monkeypatch):
+    # 沒有使用 backend 的測試也不可寫到預設的 checkin.db 或專案目錄下的快取
+    monkeypatch.setattr(db_pool, "BACKEND", "sqlite")
+    monkeypatch.setattr(db_pool, "DB_PATH", str(tmp_path / "checkin.db"))
+    monkeypatch.setattr(analytics, "LOCK_PATH", str(tmp_path / "analytics.lock"))
+    monkeypatch.setattr(compaction, "LOCK_PATH", str(tmp_path / "compaction.lock"))
+    monkeypatch.setattr(compaction, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(export_jobs, "CACHE_DIR", str(tmp_path / "export_cache"))
+    monkeypatch.setattr(qr_cache, "QR_DIR", str(tmp_path / "qr"))
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def backend(request, _isolated_paths, monkeypatch):
+    # 同一組測試分別在 SQLite 與 PostgreSQL 上執行，回傳後端名稱；資料庫已由 db.init_db() 建好最新結構
+    if request.param == "postgres":
+        if not TEST_DATABASE_URL:
+            pytest.skip("未設定 TEST_DATABASE_URL")
+        pytest.importorskip("psycopg2")
+        _reset_postgres()
+        monkeypatch.setattr(pg_backend, "DATABASE_URL", TEST_DATABASE_URL)
+    monkeypatch.setattr(db_pool, "BACKEND", request.param)
+    _clear_caches()
+    db.init_db()
+    yield request.param
+    db_pool.close_all()
+    _clear_caches()
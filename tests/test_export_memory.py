@@ -0,0 +1,42 @@
+import os
+import tracemalloc
+
+import pytest
+
+import exports
+from db import insert_locations
+from db_pool import connection
+
+pytest.importorskip("openpyxl")
+
+EMPLOYEES = 60
+DAYS = 30
+PER_DAY = 48
+# 一個月 60 人、每 30 分鐘一點（86,400 筆）的定位匯出，實測 Python 記憶體峰值約 1.8 MiB（SQLite 與 PostgreSQL 相近）；
+# 同樣的資料以 fetchall 一次讀入就要約 25 MiB，上限設在兩者之間
+MAX_PEAK_MIB = 4
+
+
+def _populate():
+    rows = []
+    for day in range(1, DAYS + 1):
+        for e in range(EMPLOYEES):
+            for i in range(PER_DAY):
+                tst = 1709222400 + (day - 1) * 86400 + i * 1800 + e
+                timestamp = f"2024-03-{day:02d} {i // 2:02d}:{i % 2 * 30:02d}:{e:02d}"
+                rows.append((f"U{e}", f"{e:03d}", f"emp{e}", 25.0478 + i * 1e-4, 121.5319 + e * 1e-4, timestamp, tst))
+    with connection() as conn:
+        insert_locations(conn, rows)
+    return len(rows)
+
+
+def test_locations_export_peak_memory(backend):
+    assert _populate() == EMPLOYEES * DAYS * PER_DAY
+    tracemalloc.start()
+    try:
+        path = exports.build_locations_xlsx("2024-03-01", "2024-03-31")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    os.remove(path)
+    assert peak < MAX_PEAK_MIB * 2 ** 20, f"{backend}: 定位匯出記憶體峰值 {peak / 2 ** 20:.2f} MiB"
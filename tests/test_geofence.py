@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import pytest
+
+from geofence import EARTH_RADIUS_M, SiteIndex, haversine_m
+
+# 沿經線移動 1 公尺對應的緯度（與 haversine 使用同一個地球半徑）
+DEG_PER_M = 180 / (math.pi * EARTH_RADIUS_M)
+HQ = (1, "總部", 25.0478, 121.5319, 50.0)
+
+
+def test_inside_edge_outside():
+    index = SiteIndex([HQ])
+    site, distance = index.match(25.0478, 121.5319)
+    assert site["id"] == 1 and distance == pytest.approx(0)
+    site, distance = index.match(25.0478 + 49.9 * DEG_PER_M, 121.5319)
+    assert site["name"] == "總部" and distance == pytest.approx(49.9, abs=0.01)
+    assert index.match(25.0478 + 50.1 * DEG_PER_M, 121.5319) == (None, None)
+    assert index.match(25.06, 121.55) == (None, None)
+
+
+def test_no_sites():
+    index = SiteIndex([])
+    assert index.match(25.0478, 121.5319) == (None, None)
+    site_ids, distances = index.match_many([25.0478], [121.5319])
+    assert site_ids.tolist() == [-1] and np.isnan(distances).all()
+
+
+@pytest.mark.parametrize("cell_size_m", [250, 40])
+def test_neighbouring_cell(cell_size_m):
+    # 工地中心緊貼格線下方，點落在上方的相鄰格（格子比半徑小時工地會登記到多格）
+    index = SiteIndex([HQ], cell_size_m=cell_size_m)
+    boundary = (math.floor(25.0478 / index.cell_deg) + 1) * index.cell_deg
+    center = boundary - 1e-7
+    index = SiteIndex([(1, "總部", center, 121.5319, 50.0)], cell_size_m=cell_size_m)
+    for offset in (1, 30, 49):
+        lat = center + offset * DEG_PER_M
+        assert index._cell(lat) != index._cell(center)
+        site, distance = index.match(lat, 121.5319)
+        assert site is not None and distance == pytest.approx(offset, abs=0.01)
+    # 經度方向：1 度經度的長度乘上 cos(緯度)
+    boundary = (math.floor(121.5319 / index.cell_deg) + 1) * index.cell_deg
+    center = boundary + 1e-7
+    index = SiteIndex([(1, "總部", 25.0478, center, 50.0)], cell_size_m=cell_size_m)
+    deg_per_m = DEG_PER_M / math.cos(math.radians(25.0478))
+    for offset in (1, 30, 49):
+        site, distance = index.match(25.0478, center - offset * deg_per_m)
+        assert site is not None and distance == pytest.approx(offset, abs=0.01)
+    assert index.match(25.0478, center - 51 * deg_per_m) == (None, None)
+
+
+def test_overlapping_sites_pick_nearest():
+    index = SiteIndex([HQ, (2, "倉庫", 25.0478 + 60 * DEG_PER_M, 121.5319, 100.0)])
+    assert index.match(25.0478 + 20 * DEG_PER_M, 121.5319)[0]["id"] == 1
+    assert index.match(25.0478 + 40 * DEG_PER_M, 121.5319)[0]["id"] == 2
+    assert index.match(25.0478 + 120 * DEG_PER_M, 121.5319)[0]["id"] == 2
+
+
+def test_match_many_agrees_with_match():
+    rng = np.random.default_rng(7)
+    sites = [(i + 1, f"工地{i}", 25.0 + rng.uniform(0, 0.05), 121.5 + rng.uniform(0, 0.05), rng.uniform(30, 400))
+             for i in range(40)]
+    index = SiteIndex(sites, cell_size_m=150)
+    lats = 25.0 + rng.uniform(-0.005, 0.055, 5000)
+    lngs = 121.5 + rng.uniform(-0.005, 0.055, 5000)
+    site_ids, distances = index.match_many(lats, lngs)
+    hits = 0
+    for lat, lng, site_id, distance in zip(lats, lngs, site_ids, distances):
+        site, expected = index.match(lat, lng)
+        if site is None:
+            assert site_id == -1 and np.isnan(distance)
+        else:
+            hits += 1
+            assert site_id == site["id"] and distance == pytest.approx(expected)
+    assert hits > 100
+    # 暴力比對全部工地，確認網格沒有漏掉候選
+    all_lats = np.array([s[2] for s in sites])
+    all_lngs = np.array([s[3] for s in sites])
+    radii = np.array([s[4] for s in sites])
+    brute = haversine_m(lats[:, None], lngs[:, None], all_lats[None, :], all_lngs[None, :])
+    inside = (brute <= radii).any(axis=1)
+    assert ((site_ids != -1) == inside).all()
+
+
+def test_match_many_empty():
+    site_ids, distances = SiteIndex([HQ]).match_many([], [])
+    assert len(site_ids) == 0 and len(distances) == 0
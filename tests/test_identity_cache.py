@@ -0,0 +1,81 @@
+import time
+
+import db
+import identity_cache
+from db_pool import connection
+
+
+def _counted():
+    before = identity_cache.stats()
+    return lambda: (identity_cache.stats()["hits"] - before["hits"], identity_cache.stats()["misses"] - before["misses"])
+
+
+def _rename_elsewhere(employee_id, name, bump_version):
+    # 模擬其他 worker 修改綁定資料：直接改資料庫，不清本行程的快取
+    with connection() as conn:
+        conn.execute("UPDATE users SET name = ? WHERE employee_id = ?", (name, employee_id))
+        if bump_version:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'users_version'")
+
+
+def test_lookup_by_both_keys(backend):
+    db.bind_user("U1", "001", "員工001")
+    counted = _counted()
+    assert identity_cache.get_by_line_id("U1") == ("U1", "001", "員工001")
+    # 以 line_id 查到後，以工號查詢同一人直接命中
+    assert identity_cache.get_by_employee_id("001") == ("U1", "員工001")
+    assert identity_cache.peek("U1") == ("U1", "001", "員工001")
+    assert identity_cache.peek_employee("001") == ("U1", "員工001")
+    assert counted() == (3, 1)
+
+
+def test_unbound_not_cached(backend):
+    assert identity_cache.get_by_line_id("U1") is None
+    assert identity_cache.get_by_employee_id("001") is None
+    db.bind_user("U1", "001", "員工001")
+    assert identity_cache.get_by_employee_id("001") == ("U1", "員工001")
+
+
+def test_version_change_invalidates(backend, monkeypatch):
+    monkeypatch.setattr(identity_cache, "VERSION_CHECK_INTERVAL", 60)
+    db.bind_user("U1", "001", "員工001")
+    assert identity_cache.get_by_line_id("U1")[2] == "員工001"
+    _rename_elsewhere("001", "改名", bump_version=True)
+    # 距離上次檢查版本還不到 VERSION_CHECK_INTERVAL，沿用快取
+    assert identity_cache.get_by_line_id("U1")[2] == "員工001"
+    monkeypatch.setattr(identity_cache, "VERSION_CHECK_INTERVAL", 0)
+    assert identity_cache.get_by_line_id("U1")[2] == "改名"
+    assert identity_cache.get_by_employee_id("001") == ("U1", "改名")
+
+
+def test_ttl_expiry(backend, monkeypatch):
+    monkeypatch.setattr(identity_cache, "VERSION_CHECK_INTERVAL", 60)
+    monkeypatch.setattr(identity_cache, "CACHE_TTL", 0.2)
+    db.bind_user("U1", "001", "員工001")
+    assert identity_cache.get_by_employee_id("001") == ("U1", "員工001")
+    # 版本號沒變（例如直接修改資料庫），最多 CACHE_TTL 秒後重新查詢
+    _rename_elsewhere("001", "改名", bump_version=False)
+    assert identity_cache.get_by_employee_id("001") == ("U1", "員工001")
+    time.sleep(0.25)
+    counted = _counted()
+    assert identity_cache.get_by_employee_id("001") == ("U1", "改名")
+    assert identity_cache.get_by_line_id("U1") == ("U1", "001", "改名")
+    assert counted() == (1, 1)
+
+
+def test_rebind_employee(backend, monkeypatch):
+    monkeypatch.setattr(identity_cache, "VERSION_CHECK_INTERVAL", 60)
+    db.bind_user("U1", "001", "員工001")
+    assert identity_cache.get_by_line_id("U1") == ("U1", "001", "員工001")
+    assert identity_cache.get_by_employee_id("001") == ("U1", "員工001")
+    # 刪除後以新的 LINE 帳號、新姓名重新綁定同一工號（同 admin 的 delete_user）
+    with connection() as conn:
+        conn.execute("DELETE FROM users WHERE employee_id = ?", ("001",))
+        identity_cache.invalidate(conn)
+    assert identity_cache.get_by_line_id("U1") is None
+    assert db.bind_user("U9", "001", "新員工")
+    assert identity_cache.get_by_employee_id("001") == ("U9", "新員工")
+    assert identity_cache.get_by_line_id("U9") == ("U9", "001", "新員工")
+    assert identity_cache.get_by_line_id("U1") is None
+    with connection() as conn:
+        assert conn.execute("SELECT value FROM meta WHERE key = 'users_version'").fetchone()[0] == 3
@@ -0,0 +1,36 @@
+import json
+
+import db
+import import_owntracks
+import location_filter
+from db_pool import connection
+
+TST = 1772409600
+
+
+def _import(path):
+    importer = import_owntracks.Importer(pause=0)
+    try:
+        importer.add(import_owntracks.parse_file((str(path), None)))
+        importer.flush()
+    finally:
+        importer.finish()
+    return importer.report
+
+
+def test_reimport_counts_duplicates_in_report_only(backend, tmp_path):
+    db.bind_user("U001", "001", "員工001")
+    path = tmp_path / "export.json"
+    path.write_text(json.dumps([
+        {"_type": "location", "lat": 25.0478 + i * 0.001, "lon": 121.5319, "tst": TST + i * 60,
+         "topic": "owntracks/001/phone"} for i in range(3)
+    ] + [{"_type": "lwt"}]))
+    before = location_filter.stats()["dropped_duplicate_db"]
+    report = _import(path)
+    assert (report["inserted"], report["duplicates"], report["ignored"]) == (3, 0, 1)
+    # 再匯入一次：全部由唯一索引略過，記在匯入報告，不算進即時過濾的統計
+    report = _import(path)
+    assert (report["inserted"], report["duplicates"]) == (0, 3)
+    assert location_filter.stats()["dropped_duplicate_db"] == before
+    with connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM location_logs").fetchone()[0] == 3
@@ -0,0 +1,85 @@
+import json
+from datetime import datetime
+
+import pytest
+
+import analytics
+import compaction
+import db
+import line_utils
+import location_partitions
+from db_pool import connection
+
+
+@pytest.fixture
+def client(backend, monkeypatch):
+    # app.py 匯入時會執行 init_db()，要在測試資料庫建好之後才匯入
+    import app
+
+    monkeypatch.setattr(analytics, "start_scheduler", lambda: None)
+    monkeypatch.setattr(compaction, "start_scheduler", lambda: None)
+    monkeypatch.setattr(location_partitions, "start_scheduler", lambda: None)
+    for line_id, employee_id in (("U1", "001"), ("U2", "002")):
+        db.bind_user(line_id, employee_id, f"員工{employee_id}")
+    now = datetime.now(line_utils.tz)
+    with connection() as conn:
+        db.insert_locations(conn, [(line_id, employee_id, f"員工{employee_id}", 25.0478, 121.5319,
+                                    now.strftime("%Y-%m-%d %H:%M:%S"), int(now.timestamp()))
+                                   for line_id, employee_id in (("U1", "001"), ("U2", "002"))])
+    return app.app.test_client()
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    # 送出的回覆（依使用者），不實際呼叫 LINE
+    sent = {}
+
+    def flush(buffer):
+        for line_id, messages in buffer.items():
+            sent.setdefault(line_id, []).extend(m["text"] for m in messages)
+
+    monkeypatch.setattr(line_utils.dispatcher, "flush", flush)
+    return sent
+
+
+def _event(event_id, line_id, text):
+    return {"type": "message", "webhookEventId": event_id, "source": {"type": "user", "userId": line_id},
+            "message": {"type": "text", "text": text}}
+
+
+def _checkins():
+    with connection() as conn:
+        return sorted(conn.execute("SELECT employee_id, check_type FROM checkins").fetchall())
+
+
+def _claimed():
+    with connection() as conn:
+        return sorted(r[0] for r in conn.execute("SELECT event_id FROM line_events").fetchall())
+
+
+def test_failed_user_rolled_back_and_redelivered(client, replies, monkeypatch):
+    body = json.dumps({"events": [_event("e1", "U1", "上班"), _event("e2", "U2", "上班"), _event("e3", "U2", "下班")]})
+    dispatch = line_utils.dispatch_event
+
+    def failing_dispatch(conn, line_id, event, preloaded=None):
+        # U2 的第二個事件在寫入下班卡之後才失敗
+        dispatch(conn, line_id, event, preloaded)
+        if event["webhookEventId"] == "e3":
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(line_utils, "dispatch_event", failing_dispatch)
+    response = client.post("/callback", data=body)
+    assert response.status_code == 500
+    assert _checkins() == [("001", "上班")]
+    assert _claimed() == ["e1"]
+    assert list(replies) == ["U1"]
+
+    # LINE 重送同一批：U1 的事件已登記而略過，只重新處理 U2
+    monkeypatch.setattr(line_utils, "dispatch_event", dispatch)
+    replies.clear()
+    response = client.post("/callback", data=body)
+    assert response.status_code == 200
+    assert _checkins() == [("001", "上班"), ("002", "上班"), ("002", "下班")]
+    assert _claimed() == ["e1", "e2", "e3"]
+    assert list(replies) == ["U2"]
+    assert "上班打卡成功" in replies["U2"][0] and "下班打卡成功" in replies["U2"][1]
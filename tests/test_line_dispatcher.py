@@ -0,0 +1,131 @@
+import threading
+import time
+
+import pytest
+
+import line_dispatcher
+from benchmarks import line_stub
+from line_dispatcher import LineDispatcher
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    # 本機 LINE stub（隨機埠），回傳 StubState
+    server = line_stub.serve(port=0)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    monkeypatch.setattr(line_dispatcher, "LINE_API_BASE", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(line_dispatcher, "BACKOFF_BASE", 0.01)
+    yield server.state
+    server.shutdown()
+    server.server_close()
+
+
+def _texts(count, prefix="m"):
+    return [{"type": "text", "text": f"{prefix}{i}"} for i in range(count)]
+
+
+def test_async_coalesces_per_user(stub):
+    dispatcher = LineDispatcher(workers=2, mode="async")
+    with dispatcher.collect():
+        for message in _texts(7):
+            dispatcher.send("U1", [message])
+        dispatcher.send("U2", _texts(3, "n"))
+    dispatcher.stop()
+    # 7 則合併成 5 + 2 兩次 push，同一位使用者依序送出
+    assert stub.pushes == 3
+    assert sorted(a[0] for a in stub.attempts) == ["U1", "U1", "U2"]
+    assert stub.by_user["U1"] == [f"m{i}" for i in range(7)]
+    assert stub.by_user["U2"] == ["n0", "n1", "n2"]
+    stats = dispatcher.stats()
+    assert (stats["pushes"], stats["sent_messages"], stats["coalesced"]) == (3, 10, 7)
+    assert stats["queued_messages"] == 0
+
+
+def test_sync_sends_before_returning(stub):
+    dispatcher = LineDispatcher(mode="sync")
+    dispatcher.send("U1", _texts(7))
+    assert stub.pushes == 2
+    assert stub.by_user["U1"] == [f"m{i}" for i in range(7)]
+    assert dispatcher._threads == []
+
+
+def test_capture_sends_only_on_flush(stub):
+    dispatcher = LineDispatcher(mode="sync")
+    with dispatcher.capture() as buffer:
+        dispatcher.send("U1", _texts(2))
+    assert stub.pushes == 0
+    dispatcher.flush(buffer)
+    assert stub.by_user["U1"] == ["m0", "m1"]
+
+
+def test_retry_reuses_retry_key(stub):
+    dispatcher = LineDispatcher(mode="sync")
+    stub.fail_next(500)
+    stub.fail_next(503)
+    dispatcher.send("U1", _texts(1))
+    dispatcher.send("U1", _texts(1, "n"))
+    first, second = stub.attempts[0][1], stub.attempts[3][1]
+    assert [a[1:] for a in stub.attempts] == [(first, 500), (first, 503), (first, 200), (second, 200)]
+    assert second != first
+    assert stub.by_user["U1"] == ["m0", "n0"]
+    assert dispatcher.stats()["retries"] == 2
+
+
+def test_lost_response_not_sent_twice(stub):
+    # LINE 已收下但回應遺失：以同一個 retry key 重送得到 409，視為成功，使用者只收到一次
+    dispatcher = LineDispatcher(mode="sync")
+    stub.fail_next(500, accepted=True)
+    dispatcher.send("U1", _texts(1))
+    assert [a[2] for a in stub.attempts] == [500, 409]
+    assert stub.by_user["U1"] == ["m0"]
+    stats = dispatcher.stats()
+    assert (stats["pushes"], stats["failed_pushes"]) == (1, 0)
+
+
+def test_honours_retry_after(stub):
+    dispatcher = LineDispatcher(mode="sync")
+    stub.fail_next(429, retry_after="1")
+    started = time.monotonic()
+    dispatcher.send("U1", _texts(1))
+    elapsed = time.monotonic() - started
+    assert 1.0 <= elapsed < 2.0
+    assert [a[2] for a in stub.attempts] == [429, 200]
+
+
+def test_backoff(monkeypatch):
+    monkeypatch.setattr(line_dispatcher, "BACKOFF_BASE", 0.5)
+    monkeypatch.setattr(line_dispatcher, "BACKOFF_MAX", 30)
+    dispatcher = LineDispatcher(mode="sync")
+    assert dispatcher._backoff(0, "2") == 2
+    assert dispatcher._backoff(0, "120") == 30
+    # 沒有 Retry-After（或不是秒數）時指數退避加上抖動
+    for attempt in range(4):
+        assert 0.25 * 2 ** attempt <= dispatcher._backoff(attempt, "Wed, 21 Oct 2015 07:28:00 GMT") <= 0.5 * 2 ** attempt
+    assert dispatcher._backoff(10) <= 30
+
+
+def test_gives_up(stub, monkeypatch):
+    monkeypatch.setattr(line_dispatcher, "MAX_RETRIES", 2)
+    dispatcher = LineDispatcher(mode="sync")
+    for _ in range(3):
+        stub.fail_next(503)
+    dispatcher.send("U1", _texts(1))
+    # 400 之類的錯誤不重送
+    stub.fail_next(400)
+    dispatcher.send("U2", _texts(1))
+    assert [a[2] for a in stub.attempts] == [503, 503, 503, 400]
+    assert stub.pushes == 0
+    stats = dispatcher.stats()
+    assert (stats["failed_pushes"], stats["failed_messages"], stats["retries"]) == (2, 2, 2)
+
+
+def test_counters_exact_with_many_workers(stub):
+    dispatcher = LineDispatcher(workers=8, mode="async")
+    for user in range(50):
+        for message in _texts(3):
+            dispatcher.send(f"U{user}", [message])
+    dispatcher.stop()
+    stats = dispatcher.stats()
+    assert stats["messages"] == stats["sent_messages"] == stub.messages == 150
+    assert stats["pushes"] == stub.pushes
@@ -0,0 +1,65 @@
+import pytest
+
+import location_cache
+from db import insert_locations
+from db_pool import connection, savepoint
+
+TST = 1772409600
+
+
+def _row(line_id, minute, lat=25.0478):
+    return (line_id, line_id[1:], f"員工{line_id}", lat, 121.5319, f"2026-03-02 08:{minute:02d}:00", TST + minute * 60)
+
+
+def test_lru_updated_only_after_commit(backend):
+    with pytest.raises(RuntimeError):
+        with connection() as conn:
+            insert_locations(conn, [_row("U001", 0)])
+            assert location_cache._lru.get("U001") is None
+            raise RuntimeError("rollback")
+    assert location_cache._lru.get("U001") is None
+    assert location_cache.get_latest("U001") is None
+
+    with connection() as conn:
+        insert_locations(conn, [_row("U001", 5)])
+        assert location_cache._lru.get("U001") is None
+    assert location_cache._lru["U001"][:3] == (25.0478, 121.5319, "2026-03-02 08:05:00")
+    hits = location_cache.stats()["hits"]
+    assert location_cache.get_latest("U001") == (25.0478, 121.5319, "2026-03-02 08:05:00")
+    assert location_cache.stats()["hits"] == hits + 1
+
+
+def test_savepoint_rollback_discards_lru_update(backend):
+    with connection() as conn:
+        insert_locations(conn, [_row("U001", 0)])
+        with pytest.raises(RuntimeError):
+            with savepoint(conn, "test"):
+                insert_locations(conn, [_row("U001", 5), _row("U002", 5)])
+                raise RuntimeError("rollback")
+    assert list(location_cache._lru) == ["U001"]
+    assert location_cache.get_latest("U001")[2] == "2026-03-02 08:00:00"
+    assert location_cache.get_latest("U002", refresh=True) is None
+
+
+def test_refresh_sees_other_worker_write(backend):
+    with connection() as conn:
+        insert_locations(conn, [_row("U001", 0)])
+    assert location_cache.get_latest("U001")[2] == "2026-03-02 08:00:00"
+    # 其他 worker 的寫入不會更新本行程的 LRU
+    with connection() as conn:
+        conn.execute("UPDATE latest_location SET timestamp = '2026-03-02 08:10:00' WHERE line_id = 'U001'")
+    assert location_cache.get_latest("U001")[2] == "2026-03-02 08:00:00"
+    assert location_cache.get_latest("U001", refresh=True)[2] == "2026-03-02 08:10:00"
+    assert location_cache.get_latest("U001")[2] == "2026-03-02 08:10:00"
+
+
+def test_warm_loads_most_recent(backend, monkeypatch):
+    monkeypatch.setattr(location_cache, "LRU_SIZE", 3)
+    with connection() as conn:
+        insert_locations(conn, [_row(f"U{i:03d}", i) for i in range(5)])
+    location_cache.clear()
+    location_cache.warm()
+    assert list(location_cache._lru) == ["U002", "U003", "U004"]
+    misses = location_cache.stats()["misses"]
+    assert location_cache.get_latest("U004")[2] == "2026-03-02 08:04:00"
+    assert location_cache.stats()["misses"] == misses
@@ -0,0 +1,92 @@
+import math
+
+import pytest
+
+import db
+import location_filter
+import location_ingest
+from db_pool import connection
+from owntracks import LocationPoint
+
+TST = 1772409600
+LAT, LNG = 25.0478, 121.5319
+# 沿經線移動 1 公尺對應的緯度
+DEG_PER_M = 180 / (math.pi * location_filter.EARTH_RADIUS_M)
+COUNTERS = ("accepted", "dropped_duplicate", "dropped_stationary", "dropped_duplicate_db")
+
+
+@pytest.fixture
+def counted():
+    # 計數器是累計值，回傳與測試開始時的差
+    location_filter.clear()
+    before = location_filter.stats()
+    return lambda: tuple(location_filter.stats()[key] - before[key] for key in COUNTERS)
+
+
+def test_duplicate_tst_dropped(counted):
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    # 重送的同一個 tst 即使位置不同也丟棄
+    assert location_filter.check("001", TST, LAT + 0.01, LNG) == "duplicate"
+    # 其他員工的同一個 tst 不受影響
+    assert location_filter.check("002", TST, LAT, LNG) is None
+    assert counted() == (2, 1, 0, 0)
+
+
+def test_stationary_dropped_within_distance_and_interval(counted):
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    assert location_filter.check("001", TST + 60, LAT + 19 * DEG_PER_M, LNG) == "stationary"
+    assert location_filter.check("001", TST + 299, LAT, LNG) == "stationary"
+    assert counted() == (1, 0, 2, 0)
+
+
+def test_moved_point_kept(counted):
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    assert location_filter.check("001", TST + 60, LAT + 21 * DEG_PER_M, LNG) is None
+    # 之後以剛收下的點為基準
+    assert location_filter.check("001", TST + 120, LAT + 30 * DEG_PER_M, LNG) == "stationary"
+    assert counted() == (2, 0, 1, 0)
+
+
+def test_point_after_interval_kept(counted):
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    assert location_filter.check("001", TST + 300, LAT, LNG) is None
+    assert location_filter.check("001", TST + 600, LAT, LNG) is None
+    assert counted() == (3, 0, 0, 0)
+
+
+def test_backfilled_point_not_stationary(counted):
+    # 比上一個收下的點更早的點是補傳的歷史資料，只檢查 tst 是否重複
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    assert location_filter.check("001", TST - 60, LAT, LNG) is None
+    assert location_filter.check("001", TST + 60, LAT, LNG) == "stationary"
+    assert counted() == (2, 0, 1, 0)
+
+
+def test_forget_allows_resend(counted):
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    location_filter.forget("001", TST)
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    assert counted() == (2, 0, 0, 0)
+
+
+def test_disabled(counted, monkeypatch):
+    monkeypatch.setattr(location_filter, "DEDUP_ENABLED", False)
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    assert location_filter.check("001", TST, LAT, LNG) is None
+    assert counted() == (2, 0, 0, 0)
+
+
+def test_ingest_reports_and_db_duplicates(backend, counted):
+    db.bind_user("U001", "001", "員工001")
+    points = [LocationPoint("001", LAT, LNG, TST, "2026-03-02 08:00:00"),
+              LocationPoint("001", LAT, LNG, TST, "2026-03-02 08:00:00"),
+              LocationPoint("001", LAT, LNG, TST + 60, "2026-03-02 08:01:00")]
+    results = location_ingest.ingest(points, mode="sync")
+    assert [r["status"] for r in results] == ["success", "skipped", "skipped"]
+    assert [r.get("reason") for r in results[1:]] == ["duplicate", "stationary"]
+    # 另一個 worker（記憶體狀態不同）重送同一點：由資料庫唯一索引擋下並計數
+    location_filter.clear()
+    location_ingest.ingest(points[:1], mode="sync")
+    assert counted() == (2, 1, 1, 1)
+    with connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM location_logs").fetchone()[0] == 1
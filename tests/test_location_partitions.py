@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import db
+import location_partitions
+from db_pool import connection
+
+
+def _months():
+    with connection() as conn:
+        return location_partitions.months(conn)
+
+
+def test_prepare_creates_current_and_next_month(backend):
+    now = location_partitions.tz.localize(datetime(2026, 12, 31, 23, 30))
+    assert location_partitions.prepare(now=now) == ["2026-12", "2027-01"]
+    assert location_partitions.prepare(now=now) == []
+    assert _months() == ["2026-12", "2027-01"]
+    with connection() as conn:
+        # 檢視表已包含預先建立的月份表
+        conn.execute("INSERT INTO location_logs_202701 (employee_id, timestamp, tst) VALUES ('001', '2027-01-01 00:00:05', 1)")
+        assert conn.execute("SELECT COUNT(*) FROM location_logs").fetchone()[0] == 1
+
+
+def test_write_after_prepare_skips_ddl(backend, monkeypatch):
+    location_partitions.prepare(now=location_partitions.tz.localize(datetime(2026, 3, 20)))
+
+    def refresh_view(conn):
+        raise AssertionError("寫入時重建檢視表")
+
+    # 月初第一筆寫入只做查詢，不在寫入交易內建表或重建檢視表
+    monkeypatch.setattr(location_partitions, "refresh_view", refresh_view)
+    with connection() as conn:
+        db.insert_locations(conn, [("U001", "001", "員工001", 25.0478, 121.5319, "2026-04-01 00:00:05", 1774972805)])
+    assert _months() == ["2026-03", "2026-04"]
+
+
+def test_ensure_still_creates_missing_month(backend):
+    with connection() as conn:
+        db.insert_locations(conn, [("U001", "001", "員工001", 25.0478, 121.5319, "2025-01-10 08:00:00", 1736467200)])
+        assert conn.execute("SELECT COUNT(*) FROM location_logs").fetchone()[0] == 1
+    assert _months() == ["2025-01"]
@@ -0,0 +1,132 @@
+import json
+import threading
+
+import pytest
+from flask import Flask
+
+import db
+import location_ingest
+import location_webhook
+import location_writer
+from db_pool import connection
+from location_webhook import location_bp
+from location_writer import LocationWriter
+
+TST = 1772409600
+
+
+@pytest.fixture
+def client(backend):
+    db.bind_user("U001", "001", "員工001")
+    app = Flask(__name__)
+    app.register_blueprint(location_bp, url_prefix="/location")
+    return app.test_client()
+
+
+@pytest.fixture
+def full_queue(monkeypatch):
+    # 緩衝模式、佇列已滿：寫入執行緒卡在第一筆，佇列唯一的空位也已占用
+    gate, entered = threading.Event(), threading.Event()
+    insert = location_writer.insert_locations
+
+    def blocked_insert(conn, rows):
+        entered.set()
+        gate.wait(10)
+        return insert(conn, rows)
+
+    monkeypatch.setattr(location_writer, "insert_locations", blocked_insert)
+    writer = LocationWriter(maxsize=1, batch_size=1, flush_interval=0.05, policy="reject")
+    monkeypatch.setattr(location_ingest, "writer", writer)
+    monkeypatch.setattr(location_webhook, "INGEST_MODE", "buffered")
+    monkeypatch.setattr(location_webhook, "ingest", lambda points: location_ingest.ingest(points, mode="buffered"))
+    row = ("U001", "001", "員工001", 25.0, 121.5, "2026-03-01 08:00:00", TST - 86400)
+    writer.submit(row)
+    assert entered.wait(5)
+    writer.submit(row[:5] + ("2026-03-01 08:01:00", TST - 86340))
+    yield writer
+    gate.set()
+    writer.stop()
+
+
+def _location(i, employee_id="001", **extra):
+    return {"_type": "location", "lat": 25.0478 + i * 0.01, "lon": 121.5319, "tst": TST + i * 600,
+            "topic": f"owntracks/{employee_id}/phone", **extra}
+
+
+def _stored():
+    with connection() as conn:
+        return [r[0] for r in conn.execute("SELECT tst FROM location_logs ORDER BY tst").fetchall()]
+
+
+def test_single_object(client):
+    response = client.post("/location/webhook", data=json.dumps(_location(0)))
+    assert response.status_code == 200
+    assert response.get_json() == {"status": "success", "message": "✅ 定位已成功記錄"}
+    # 同一點重送：回 200 並註明略過，不重複寫入
+    response = client.post("/location/webhook", data=json.dumps(_location(0)))
+    assert response.get_json()["skipped"] == "duplicate"
+    assert _stored() == [TST]
+
+
+def test_single_errors(client):
+    response = client.post("/location/webhook", data=json.dumps(_location(0, employee_id="999")))
+    assert response.status_code == 403
+    response = client.post("/location/webhook", data=json.dumps({"_type": "location", "lat": 25.0}))
+    assert response.status_code == 400
+    response = client.post("/location/webhook", data="")
+    assert response.status_code == 400
+    response = client.post("/location/webhook", data=json.dumps({"_type": "lwt", "tst": TST}))
+    assert (response.status_code, response.get_json()["ignored"]) == (200, "lwt")
+    assert _stored() == []
+
+
+def test_json_array_per_item_results(client):
+    items = [
+        _location(0),
+        {"_type": "transition", "event": "enter"},
+        _location(1, employee_id="999"),
+        {"_type": "location", "lat": "north", "lon": 121.5, "topic": "owntracks/001/phone"},
+        "not an object",
+        _location(2),
+        _location(2),
+    ]
+    response = client.post("/location/webhook", data=json.dumps(items))
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body["count"], body["success"], body["skipped"], body["ignored"], body["error"]) == (7, 2, 1, 1, 3)
+    results = body["results"]
+    assert [r["status"] for r in results] == ["success", "ignored", "error", "error", "error", "success", "skipped"]
+    assert results[1]["type"] == "transition"
+    assert [results[i]["code"] for i in (2, 3, 4)] == [403, 400, 400]
+    assert results[6]["reason"] == "duplicate"
+    assert _stored() == [TST, TST + 1200]
+
+
+def test_ndjson(client):
+    body = "\n".join(json.dumps(_location(i)) for i in range(3)) + "\n\n"
+    response = client.post("/location/webhook", data=body)
+    assert response.status_code == 200
+    assert [r["status"] for r in response.get_json()["results"]] == ["success"] * 3
+    assert _stored() == [TST, TST + 600, TST + 1200]
+    response = client.post("/location/webhook", data=json.dumps(_location(3)) + "\n{broken")
+    assert response.status_code == 400
+    assert "第 2 行" in response.get_json()["message"]
+    assert _stored() == [TST, TST + 600, TST + 1200]
+
+
+def test_queue_full_single_returns_503(client, full_queue):
+    response = client.post("/location/webhook", data=json.dumps(_location(0)))
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert full_queue.stats()["rejected"] == 1
+
+
+def test_queue_full_batch_returns_503(client, full_queue):
+    items = [_location(0), {"_type": "lwt"}, _location(1)]
+    response = client.post("/location/webhook", data=json.dumps(items))
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    body = response.get_json()
+    assert body["status"] == "error"
+    assert [r["status"] for r in body["results"]] == ["error", "ignored", "error"]
+    assert {body["results"][i]["code"] for i in (0, 2)} == {503}
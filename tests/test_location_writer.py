@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+
+import db
+import location_ingest
+import location_writer
+from db_pool import connection
+from location_writer import LocationWriter, QueueFull
+from owntracks import LocationPoint
+
+TST = 1772409600
+
+
+@pytest.fixture
+def gate(backend, monkeypatch):
+    # 讓背景寫入執行緒卡在第一批：gate.set() 之前佇列只進不出
+    gate, entered = threading.Event(), threading.Event()
+    insert = location_writer.insert_locations
+
+    def blocked_insert(conn, rows):
+        entered.set()
+        gate.wait(10)
+        return insert(conn, rows)
+
+    monkeypatch.setattr(location_writer, "insert_locations", blocked_insert)
+    gate.entered = entered
+    yield gate
+    gate.set()
+
+
+def _row(i):
+    return ("U001", "001", "員工001", 25.0478 + i * 0.01, 121.5319, f"2026-03-02 08:{i:02d}:00", TST + i * 600)
+
+
+def _start(writer, gate):
+    # 第一筆由寫入執行緒取走並卡住，之後佇列剩下 maxsize 個空位
+    writer.submit(_row(0))
+    assert gate.entered.wait(5)
+
+
+def _stored():
+    with connection() as conn:
+        return sorted(r[0] for r in conn.execute("SELECT tst FROM location_logs").fetchall())
+
+
+def test_reject(gate):
+    writer = LocationWriter(maxsize=5, batch_size=1, flush_interval=0.05, policy="reject")
+    _start(writer, gate)
+    for i in range(1, 6):
+        writer.submit(_row(i))
+    with pytest.raises(QueueFull):
+        writer.submit(_row(6))
+    gate.set()
+    writer.stop()
+    stats = writer.stats()
+    assert (stats["enqueued"], stats["rejected"], stats["dropped"], stats["written"]) == (6, 1, 0, 6)
+    assert stats["queue_depth"] == 0
+    assert _stored() == [TST + i * 600 for i in range(6)]
+
+
+def test_block_waits_for_space(gate):
+    writer = LocationWriter(maxsize=2, batch_size=1, flush_interval=0.05, policy="block", block_timeout=0.2)
+    _start(writer, gate)
+    writer.submit(_row(1))
+    writer.submit(_row(2))
+    started = time.monotonic()
+    with pytest.raises(QueueFull):
+        writer.submit(_row(3))
+    assert time.monotonic() - started >= 0.2
+    # 等待期間寫入執行緒取走一筆，就能收下
+    threading.Timer(0.05, gate.set).start()
+    writer.block_timeout = 5
+    writer.submit(_row(3))
+    writer.stop()
+    stats = writer.stats()
+    assert (stats["enqueued"], stats["rejected"], stats["written"]) == (4, 1, 4)
+    assert _stored() == [TST + i * 600 for i in range(4)]
+
+
+def test_drop_oldest(gate):
+    writer = LocationWriter(maxsize=2, batch_size=1, flush_interval=0.05, policy="drop_oldest")
+    _start(writer, gate)
+    for i in range(1, 5):
+        writer.submit(_row(i))
+    gate.set()
+    writer.stop()
+    stats = writer.stats()
+    assert (stats["enqueued"], stats["dropped"], stats["rejected"], stats["written"]) == (5, 2, 0, 3)
+    # 佇列中最舊的兩筆被丟棄
+    assert _stored() == [TST, TST + 3 * 600, TST + 4 * 600]
+
+
+def test_stop_flushes_queue(backend):
+    writer = LocationWriter(maxsize=100, batch_size=3, flush_interval=0.2)
+    for i in range(10):
+        writer.submit(_row(i))
+    writer.stop()
+    stats = writer.stats()
+    assert (stats["written"], stats["queue_depth"], stats["max_batch_size"]) == (10, 0, 3)
+    assert len(_stored()) == 10
+
+
+def test_write_failure_counted(backend, monkeypatch):
+    def fail(conn, rows):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(location_writer, "insert_locations", fail)
+    writer = LocationWriter(maxsize=10, batch_size=10, flush_interval=0.05)
+    writer.submit(_row(0))
+    writer.stop()
+    assert (writer.stats()["failed"], writer.stats()["written"]) == (1, 0)
+
+
+def test_buffered_ingest_rejects_then_accepts_resend(gate, monkeypatch):
+    # 8 個點進容量 5 的佇列：5 個收下、3 個回 503；重送時已收下的略過，其餘 3 個寫入
+    db.bind_user("U001", "001", "員工001")
+    writer = LocationWriter(maxsize=5, batch_size=1, flush_interval=0.05, policy="reject")
+    monkeypatch.setattr(location_ingest, "writer", writer)
+    _start(writer, gate)
+    points = [LocationPoint("001", 25.1 + i * 0.01, 121.5319, TST + 100000 + i * 600,
+                            f"2026-03-03 08:{i:02d}:00") for i in range(8)]
+    results = location_ingest.ingest(points, mode="buffered")
+    assert [r["status"] for r in results] == ["success"] * 5 + ["error"] * 3
+    assert {r["code"] for r in results[5:]} == {503}
+    gate.set()
+    writer.stop()
+    results = location_ingest.ingest(points, mode="buffered")
+    assert [r.get("reason") for r in results] == ["duplicate"] * 5 + [None] * 3
+    writer.stop()
+    assert writer.stats()["written"] == 9
+    assert _stored() == [TST] + [p.tst for p in points]
@@ -0,0 +1,141 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+import pytest
+
+mqtt = pytest.importorskip("paho.mqtt.client")
+
+import db  # noqa: E402
+import location_ingest  # noqa: E402
+import mqtt_ingest  # noqa: E402
+from db_pool import connection  # noqa: E402
+
+
+@pytest.fixture
+def service(backend, monkeypatch):
+    # 不連線 broker：記下 ack 與斷線，訊息直接交給 on_message
+    db.bind_user("U001", "001", "員工001")
+    service = mqtt_ingest.MqttIngest()
+    if not service.manual_ack:
+        pytest.skip("paho-mqtt 1.x 不支援手動 ack")
+    service.acked, service.calls = [], []
+    monkeypatch.setattr(service.client, "ack", lambda mid, qos: service.acked.append(mid))
+    for name in ("disconnect", "loop_stop", "loop_start", "connect_async"):
+        monkeypatch.setattr(service.client, name, lambda *args, name=name, **kwargs: service.calls.append(name))
+    monkeypatch.setattr(mqtt_ingest.time, "sleep", lambda seconds: None)
+    return service
+
+
+def _message(mid, payload, topic="owntracks/001/phone"):
+    message = mqtt.MQTTMessage(mid=mid, topic=topic.encode())
+    message.payload = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+    message.qos = 1
+    return message
+
+
+def _location(mid, tst):
+    return _message(mid, {"_type": "location", "lat": 25.0478 + tst * 1e-4, "lon": 121.5319, "tst": tst})
+
+
+def _stored():
+    with connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM location_logs").fetchone()[0]
+
+
+def test_invalid_and_ignored_acked_at_once(service):
+    service.on_message(service.client, None, _message(1, b"not json"))
+    service.on_message(service.client, None, _message(2, {"_type": "transition", "event": "enter"}))
+    assert service.acked == [1, 2]
+    assert service._queue.empty()
+
+
+def test_location_acked_after_commit(service):
+    service.on_message(service.client, None, _location(1, 1772409600))
+    service.on_message(service.client, None, _location(2, 1772409900))
+    assert service.acked == []
+    service._write(service._drain_nowait())
+    assert service.acked == [1, 2]
+    assert _stored() == 2
+
+
+def test_write_failure_not_acked(service, monkeypatch):
+    def fail(conn, rows):
+        raise sqlite3.OperationalError("database is locked")
+
+    service.on_message(service.client, None, _location(1, 1772409600))
+    batch = service._drain_nowait()
+    with monkeypatch.context() as patch:
+        patch.setattr(location_ingest, "insert_locations", fail)
+        patch.setattr(mqtt_ingest, "WRITE_ATTEMPTS", 2)
+        with pytest.raises(sqlite3.OperationalError):
+            service._write(batch)
+    assert service.acked == []
+    assert _stored() == 0
+    # broker 重送同一則時不可被過濾器當成重複
+    service._write(batch)
+    assert service.acked == [1]
+    assert _stored() == 1
+
+
+def test_queue_full_pauses_without_ack(service, monkeypatch):
+    monkeypatch.setattr(service, "_queue", queue.Queue(maxsize=1))
+    service.on_message(service.client, None, _location(1, 1772409600))
+    service.on_message(service.client, None, _location(2, 1772409900))
+    assert service._paused.is_set()
+    assert service.calls == ["disconnect"]
+    # 暫停期間收到的訊息也不 ack、不進佇列
+    service.on_message(service.client, None, _location(3, 1772410200))
+    assert service._queue.qsize() == 1
+    service._write(service._drain_nowait())
+    assert service.acked == [1]
+    service._resume()
+    assert not service._paused.is_set()
+    assert service.calls == ["disconnect", "loop_stop", "connect_async", "loop_start"]
+
+
+def test_run_holds_batch_while_writes_fail(service, monkeypatch):
+    # 資料庫持續寫入失敗：run() 不結束、不 ack、暫停接收，恢復後寫入同一批才 ack 並重新連線
+    failing = threading.Event()
+    failing.set()
+    attempts = []
+    insert = location_ingest.insert_locations
+
+    def flaky(conn, rows):
+        attempts.append(len(rows))
+        if failing.is_set():
+            raise sqlite3.OperationalError("disk I/O error")
+        return insert(conn, rows)
+
+    monkeypatch.setattr(location_ingest, "insert_locations", flaky)
+    monkeypatch.setattr(mqtt_ingest, "init_db", lambda: None)
+    monkeypatch.setattr(mqtt_ingest, "WRITE_ATTEMPTS", 2)
+    monkeypatch.setattr(mqtt_ingest, "WRITE_BACKOFF_MAX", 0.01)
+    monkeypatch.setattr(mqtt_ingest, "FLUSH_INTERVAL", 0.01)
+    service.on_message(service.client, None, _location(1, 1772409600))
+    thread = threading.Thread(target=service.run, daemon=True)
+    thread.start()
+    _wait(lambda: len(attempts) >= 6)
+    assert thread.is_alive()
+    assert service._paused.is_set()
+    assert service.acked == [] and _stored() == 0
+    assert service.calls == ["connect_async", "loop_start", "disconnect"]
+
+    failing.clear()
+    _wait(lambda: service.acked == [1])
+    _wait(lambda: not service._paused.is_set())
+    assert _stored() == 1
+    service.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert service.calls[3:6] == ["loop_stop", "connect_async", "loop_start"]
+
+
+def _wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        # time.sleep 已被 service 換成不等待
+        threading.Event().wait(0.005)
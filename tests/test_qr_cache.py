@@ -0,0 +1,60 @@
+import os
+
+import pytest
+from flask import Flask
+
+import qr_cache
+
+pytest.importorskip("qrcode")
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(qr_cache.qr_bp, url_prefix="/qr")
+    return app.test_client()
+
+
+def test_key_stable_per_employee(monkeypatch):
+    key = qr_cache.ensure("001")
+    assert key == qr_cache.ensure("001")
+    assert key != qr_cache.ensure("002")
+    # 設定內容變動（例如換了網域）才會換新的圖檔網址
+    monkeypatch.setattr(qr_cache, "PUBLIC_BASE_URL", "https://example.com")
+    assert qr_cache.ensure("001") != key
+
+
+def test_generated_once():
+    before = qr_cache.stats()
+    key = qr_cache.ensure("001")
+    mtime = os.stat(qr_cache._path(key)).st_mtime_ns
+    qr_cache.ensure("001")
+    after = qr_cache.stats()
+    assert (after["generated"] - before["generated"], after["hits"] - before["hits"]) == (1, 1)
+    assert os.stat(qr_cache._path(key)).st_mtime_ns == mtime
+    assert [name for name in os.listdir(qr_cache.QR_DIR) if name.endswith(".tmp")] == []
+
+
+def test_serve_etag_and_immutable(client):
+    key = qr_cache.ensure("001")
+    response = client.get(f"/qr/{key}.png")
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert response.data.startswith(b"\x89PNG")
+    assert response.headers["ETag"] == f'"{key}"'
+    cache_control = response.cache_control
+    assert cache_control.public and cache_control.immutable
+    assert cache_control.max_age == qr_cache.CACHE_MAX_AGE
+
+
+def test_not_modified(client):
+    key = qr_cache.ensure("001")
+    response = client.get(f"/qr/{key}.png", headers={"If-None-Match": f'"{key}"'})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert client.get(f"/qr/{key}.png", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_unknown_or_invalid_key(client):
+    assert client.get(f"/qr/{'0' * 32}.png").status_code == 404
+    assert client.get("/qr/..%2Fapp.png").status_code == 404
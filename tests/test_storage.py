@@ -0,0 +1,210 @@
+import fcntl
+import gzip
+import os
+from datetime import datetime
+
+import pytest
+
+import analytics
+import attendance
+import compaction
+import db
+import db_pool
+import exports
+import location_partitions
+import pg_backend
+from db_pool import connection
+
+
+def _checkin(employee_id, check_type, timestamp):
+    return db.save_checkin({
+        "employee_id": employee_id, "line_id": f"U{employee_id}", "name": f"員工{employee_id}",
+        "check_type": check_type, "timestamp": timestamp, "result": "正常",
+        "latitude": 25.0478, "longitude": 121.5319, "distance": 3.0,
+    })
+
+
+def _location(employee_id, timestamp, tst, lat=25.0478, lon=121.5319):
+    return (f"U{employee_id}", employee_id, f"員工{employee_id}", lat, lon, timestamp, tst)
+
+
+def _insert(rows):
+    with connection() as conn:
+        return db.insert_locations(conn, rows)
+
+
+def _count(table, where="1 = 1", params=()):
+    with connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}", params).fetchone()[0]
+
+
+def test_translate():
+    assert pg_backend.translate("SELECT * FROM t WHERE a = ? AND b = ?") == "SELECT * FROM t WHERE a = %s AND b = %s"
+    # 字串常數內的 ? 不是參數，字面上的 % 要跳脫
+    assert pg_backend.translate("SELECT '?', ? WHERE x LIKE 'a%' AND y % 2 = 0") == \
+        "SELECT '?', %s WHERE x LIKE 'a%%' AND y %% 2 = 0"
+    assert pg_backend.translate("SELECT 'it''s ?'") == "SELECT 'it''s ?'"
+
+
+def test_init_db_is_idempotent(backend):
+    db.init_db()
+    with connection() as conn:
+        assert db.schema_version(conn) == len(db.MIGRATIONS)
+
+
+def test_checkin_once_per_day(backend):
+    assert _checkin("001", "上班", "2026-03-02 08:01:00")
+    assert not _checkin("001", "上班", "2026-03-02 08:30:00")
+    assert _checkin("001", "下班", "2026-03-02 17:31:00")
+    assert _checkin("001", "上班", "2026-03-03 08:05:00")
+    with connection() as conn:
+        assert attendance.get_daily(conn, "001", "2026-03-02") == \
+            ("2026-03-02 08:01:00", "2026-03-02 17:31:00", "正常", "正常")
+        assert attendance.has_checkin(conn, "001", "2026-03-03", "上班")
+        assert not attendance.has_checkin(conn, "001", "2026-03-03", "下班")
+        minutes = conn.execute("SELECT worked_minutes FROM daily_attendance WHERE employee_id = ? AND date = ?",
+                               ("001", "2026-03-02")).fetchone()[0]
+    assert minutes == 570
+    assert _count("checkins") == 3
+
+
+def test_checkin_failure_rolls_back(backend):
+    with pytest.raises(RuntimeError):
+        with connection() as conn:
+            attendance.record_checkin(conn, "001", "員工001", "上班", "2026-03-02 08:01:00", "正常")
+            raise RuntimeError
+    assert _count("checkins") == 0
+    assert _count("daily_attendance") == 0
+
+
+def test_bind_user_unique(backend):
+    assert db.bind_user("U001", "001", "員工001")
+    assert not db.bind_user("U001", "002", "員工002")
+    assert not db.bind_user("U002", "001", "員工001")
+    assert db.get_employee_by_line_id("U001") == ("001", "員工001")
+
+
+def test_insert_locations_dedup(backend):
+    rows = [
+        _location("001", "2026-03-02 08:00:00", 1772409600),
+        _location("001", "2026-03-02 08:00:00", 1772409600),
+        _location("001", "2026-03-02 08:05:00", 1772409900),
+        _location("002", "2026-03-02 08:00:00", 1772409600),
+        # 跨月份：分到兩張月份表
+        _location("001", "2026-04-01 09:00:00", 1775005200),
+        # 沒有 tst 的點不參與去除重複
+        _location("003", "2026-03-02 09:00:00", None),
+        _location("003", "2026-03-02 09:00:00", None),
+    ]
+    assert _insert(rows) == 6
+    # 另一批重送相同的點：全部略過
+    assert _insert(rows[:5]) == 0
+    assert _insert([_location("001", "2026-03-02 08:10:00", 1772410200)]) == 1
+    with connection() as conn:
+        assert location_partitions.months(conn) == ["2026-03", "2026-04"]
+    assert _count("location_logs_202603") == 6
+    assert _count("location_logs_202604") == 1
+    assert _count("location_logs", "tst IS NULL") == 2
+    with connection() as conn:
+        latest = dict((r[0], r[1:]) for r in conn.execute(
+            "SELECT line_id, employee_id, timestamp FROM latest_location").fetchall())
+    assert latest == {"U001": ("001", "2026-04-01 09:00:00"), "U002": ("002", "2026-03-02 08:00:00"),
+                      "U003": ("003", "2026-03-02 09:00:00")}
+
+
+def test_insert_locations_twice_in_one_transaction(backend):
+    # PostgreSQL 的暫存表在同一個交易內重複使用
+    with connection() as conn:
+        assert db.insert_locations(conn, [_location("001", "2026-03-02 08:00:00", 1)]) == 1
+        assert db.insert_locations(conn, [_location("001", "2026-03-02 08:00:00", 1),
+                                          _location("001", "2026-03-02 08:01:00", 2)]) == 1
+    assert _count("location_logs_202603") == 2
+
+
+def test_stream(backend):
+    _insert([_location("001", f"2026-03-02 08:{i // 60:02d}:{i % 60:02d}", i) for i in range(250)])
+    with connection() as conn:
+        rows = list(db_pool.stream(conn, "SELECT tst FROM location_logs_202603 WHERE employee_id = ? ORDER BY tst",
+                                   ("001",), size=40))
+    assert [r[0] for r in rows] == list(range(250))
+
+
+def test_export_xlsx(backend):
+    openpyxl = pytest.importorskip("openpyxl")
+    for i in range(4):
+        emp = f"00{i}"
+        _checkin(emp, "上班", "2026-03-02 08:0%d:00" % i)
+        _checkin(emp, "下班", "2026-03-02 17:3%d:00" % i)
+        _insert([_location(emp, "2026-03-02 08:00:00", 1, lat=25.0), _location(emp, "2026-03-02 12:00:00", 2, lat=25.1),
+                 _location(emp, "2026-03-03 12:00:00", 3, lat=25.2)])
+    paths = [exports.build_checkins_xlsx("2026-03-01", "2026-03-31"),
+             exports.build_locations_xlsx("2026-03-01", "2026-03-31")]
+    try:
+        checkins = openpyxl.load_workbook(paths[0], read_only=True)
+        assert checkins.sheetnames == ["第1頁", "第2頁"]
+        rows = list(checkins["第1頁"].values)
+        assert rows[0][0] == "工號：000 姓名：員工000"
+        assert rows[2][:3] == ("2026/03/02", "08:00", "17:30")
+        locations = openpyxl.load_workbook(paths[1], read_only=True)
+        assert locations.sheetnames == ["定位1", "定位2", "工地停留"]
+        rows = list(locations["定位2"].values)
+        assert rows[0][0] == "工號：003 姓名：員工003"
+        # 每人每天最後一筆
+        assert rows[2][:3] == ("2026/03/02", 25.1, 121.5319)
+        assert rows[3][:3] == ("2026/03/03", 25.2, 121.5319)
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+def test_onsite_analytics(backend):
+    db.bind_user("U001", "001", "員工001")
+    _insert([_location("001", f"2026-03-02 08:{m:02d}:00", m) for m in range(0, 50, 5)])
+    assert analytics.run()["rows"] == 10
+    with connection() as conn:
+        assert analytics.daily(conn, "2026-03-01", "2026-03-31") == \
+            [("001", "員工001", "2026-03-02", 1, "總部", 2700, 1, "2026-03-02 08:00:00", "2026-03-02 08:45:00")]
+
+
+def test_compaction(backend, monkeypatch):
+    monkeypatch.setattr(compaction, "CHUNK_PAUSE", 0)
+    rows = [_location("001", "2026-01-15 08:00:00", 100), _location("001", "2026-01-15 18:00:00", 101)]
+    # 7/10：同一個 5 分鐘時間桶內、幾乎沒有移動的點只保留一點，當天最後一點必定保留
+    rows += [_location("001", f"2026-07-10 09:00:{s:02d}", 1000 + s, lon=121.5319 + s * 1e-6) for s in range(0, 60, 10)]
+    rows += [_location("001", "2026-07-10 09:00:59", 1059, lat=25.06)]
+    assert _insert(rows) == 9
+    report = compaction.run(today=datetime(2026, 9, 1))
+    assert report["archived_rows"] == 2
+    assert report["downsampled_rows"] == 5
+    assert report["deleted_rows"] == 7
+    with connection() as conn:
+        assert location_partitions.months(conn) == ["2026-07"]
+        assert dict(conn.execute("SELECT date, stage FROM compaction_log").fetchall()) == \
+            {"2026-01-15": "archived", "2026-07-10": "downsampled"}
+    assert _count("location_logs") == 2
+    with gzip.open(compaction.archive_path("2026-01"), "rt") as f:
+        assert len(f.readlines()) == 2
+    with gzip.open(compaction.archive_path("2026-07"), "rt") as f:
+        assert len(f.readlines()) == 5
+    # 匯出仍讀得到封存的定位
+    assert compaction.archived_last_fixes("2026-01-01", "2026-01-31") == \
+        {"001": [("001", "員工001", "2026-01-15 18:00:00", 25.0478, 121.5319)]}
+    # 再跑一次不重複處理
+    assert compaction.run(today=datetime(2026, 9, 1))["deleted_rows"] == 0
+
+
+def test_compaction_lock(backend):
+    # SQLite 為單機檔案鎖，PostgreSQL 為 advisory lock（另一條連線持有時取不到）
+    if backend == "postgres":
+        with pg_backend.advisory_lock("compaction") as locked:
+            assert locked
+            with pg_backend.advisory_lock("compaction") as again:
+                assert not again
+            assert compaction.run_locked() is None
+        with pg_backend.advisory_lock("compaction") as locked:
+            assert locked
+    else:
+        with open(compaction.LOCK_PATH, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            assert compaction.run_locked() is None
+    assert compaction.run_locked() is not None